@@ -0,0 +1,124 @@
+"""
+Benchmark for services.chunks.get_text_chunks.
+
+Compares the offset-based chunker against the previous implementation, which sliced
+the remaining token list on every iteration, and checks that both return identical chunks.
+
+    python -m benchmarks.bench_chunks
+    python -m benchmarks.bench_chunks --sizes 1KB 1MB --repeat 5
+"""
+
+import argparse
+import time
+from typing import Callable, List, Optional
+
+from services.chunks import (
+    CHUNK_SIZE,
+    MAX_NUM_CHUNKS,
+    MIN_CHUNK_LENGTH_TO_EMBED,
+    MIN_CHUNK_SIZE_CHARS,
+    get_text_chunks,
+    tokenizer,
+)
+
+SIZES = {"1KB": 1024, "1MB": 1024**2, "50MB": 50 * 1024**2}
+
+PARAGRAPH = (
+    "The retrieval plugin splits every document into chunks of roughly two hundred tokens. "
+    "Each chunk is embedded and written to the vector database together with its metadata!\n"
+    "Does the chunker cut at punctuation? It prefers the last period, question mark, "
+    "exclamation mark or newline after the minimum chunk length.\n"
+    "문서는 약 200 토큰 크기의 청크로 나뉘고, 각 청크는 임베딩되어 벡터 데이터베이스에 저장됩니다. "
+    "한국어 텍스트는 토큰 경계가 글자 중간에 걸릴 수 있습니다.\n\n"
+)
+
+
+def legacy_get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
+    """The previous implementation, kept as the reference for output and speed."""
+    if not text or text.isspace():
+        return []
+    tokens = tokenizer.encode(text, disallowed_special=())
+    chunks = []
+    chunk_size = chunk_token_size or CHUNK_SIZE
+    num_chunks = 0
+    while tokens and num_chunks < MAX_NUM_CHUNKS:
+        chunk = tokens[:chunk_size]
+        chunk_text = tokenizer.decode(chunk)
+        if not chunk_text or chunk_text.isspace():
+            tokens = tokens[len(chunk) :]
+            continue
+        last_punctuation = max(
+            chunk_text.rfind("."),
+            chunk_text.rfind("?"),
+            chunk_text.rfind("!"),
+            chunk_text.rfind("\n"),
+        )
+        if last_punctuation != -1 and last_punctuation > MIN_CHUNK_SIZE_CHARS:
+            chunk_text = chunk_text[: last_punctuation + 1]
+        chunk_text_to_append = chunk_text.replace("\n", " ").strip()
+        if len(chunk_text_to_append) > MIN_CHUNK_LENGTH_TO_EMBED:
+            chunks.append(chunk_text_to_append)
+        tokens = tokens[len(tokenizer.encode(chunk_text, disallowed_special=())) :]
+        num_chunks += 1
+    if tokens:
+        remaining_text = tokenizer.decode(tokens).replace("\n", " ").strip()
+        if len(remaining_text) > MIN_CHUNK_LENGTH_TO_EMBED:
+            chunks.append(remaining_text)
+    return chunks
+
+
+def make_text(size: int) -> str:
+    repeats = size // len(PARAGRAPH.encode("utf-8")) + 1
+    return (PARAGRAPH * repeats).encode("utf-8")[:size].decode("utf-8", "ignore")
+
+
+def best_of(fn: Callable[[], List[str]], repeat: int):
+    best = float("inf")
+    result: List[str] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", nargs="+", default=list(SIZES), choices=SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--chunk-token-size", type=int, default=None)
+    parser.add_argument(
+        "--skip-legacy",
+        action="store_true",
+        help="only time the current chunker (the legacy one takes minutes on 50MB)",
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'size':>6} {'chunks':>8} {'current (s)':>12} {'legacy (s)':>12} {'speedup':>8}"
+    )
+    for name in args.sizes:
+        text = make_text(SIZES[name])
+        current_time, current = best_of(
+            lambda: get_text_chunks(text, args.chunk_token_size), args.repeat
+        )
+        if args.skip_legacy:
+            print(
+                f"{name:>6} {len(current):>8} {current_time:>12.3f} {'-':>12} {'-':>8}"
+            )
+            continue
+
+        # the legacy chunker is run once on large inputs
+        legacy_repeat = args.repeat if SIZES[name] <= 1024**2 else 1
+        legacy_time, legacy = best_of(
+            lambda: legacy_get_text_chunks(text, args.chunk_token_size), legacy_repeat
+        )
+        assert current == legacy, f"chunks differ from the legacy chunker on {name}"
+        print(
+            f"{name:>6} {len(current):>8} {current_time:>12.3f} {legacy_time:>12.3f} "
+            f"{legacy_time / current_time:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
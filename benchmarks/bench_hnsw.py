@@ -0,0 +1,144 @@
+"""
+Recall-vs-latency benchmark for datastore.providers.hnsw_datastore.
+
+Writes the same random clustered embeddings to a LocalDataStore (exact search) and to an
+HnswDataStore, then measures recall@k of the graph search against the exact results and the
+latency of both, for a range of ef_search values, with and without a metadata filter.
+
+    python -m benchmarks.bench_hnsw
+    python -m benchmarks.bench_hnsw --rows 1000000 --dimension 768 --ef 16 64 256
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from datastore.providers.hnsw_datastore import HnswDataStore
+from datastore.providers.local_datastore import LocalDataStore
+from models.models import DocumentChunk, DocumentChunkMetadata, DocumentMetadataFilter
+
+UPSERT_ROWS = 10000  # rows written per upsert call
+
+
+def make_embeddings(
+    rng: np.random.Generator, rows: int, dimension: int, clusters: int
+) -> np.ndarray:
+    """Embeddings spread around a few centers, closer to real text embeddings than uniform noise."""
+    centers = rng.normal(size=(clusters, dimension)).astype(np.float32)
+    assignments = rng.integers(0, clusters, size=rows)
+    return centers[assignments] + 0.5 * rng.normal(size=(rows, dimension)).astype(
+        np.float32
+    )
+
+
+async def fill(store: LocalDataStore, embeddings: np.ndarray, sources: int) -> float:
+    start = time.perf_counter()
+    for batch_start in range(0, len(embeddings), UPSERT_ROWS):
+        chunks: Dict[str, List[DocumentChunk]] = {}
+        for row in range(batch_start, min(batch_start + UPSERT_ROWS, len(embeddings))):
+            doc_id = f"doc{row // 10}"
+            chunks.setdefault(doc_id, []).append(
+                DocumentChunk(
+                    id=f"{doc_id}_{row}",
+                    text="",
+                    metadata=DocumentChunkMetadata(
+                        document_id=doc_id, source_id=f"source{row % sources}"
+                    ),
+                    embedding=embeddings[row].tolist(),
+                )
+            )
+        await store._upsert(chunks)
+    return time.perf_counter() - start
+
+
+def search(
+    store: LocalDataStore,
+    queries: np.ndarray,
+    filter: Optional[DocumentMetadataFilter],
+    top_k: int,
+) -> Tuple[List[List[int]], List[float]]:
+    """One query at a time, as /query sends them, returning the rows and per-query latencies."""
+    rows, latencies = [], []
+    embeddings = store._normalize(queries)
+    for embedding in embeddings:
+        start = time.perf_counter()
+        mask = store._get_filter_mask(filter, store.count)
+        matches = store._search(embedding[None, :], [mask], [top_k], store.count)[0]
+        latencies.append(time.perf_counter() - start)
+        rows.append([row for row, _ in matches])
+    return rows, latencies
+
+
+def recall(results: List[List[int]], expected: List[List[int]]) -> float:
+    found = sum(len(set(r) & set(e)) for r, e in zip(results, expected))
+    return found / max(sum(len(e) for e in expected), 1)
+
+
+def report(name: str, latencies: List[float], recall_at_k: Optional[float]):
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+    qps = len(latencies) / sum(latencies)
+    recall_text = f"{recall_at_k:>9.3f}" if recall_at_k is not None else f"{'-':>9}"
+    print(f"{name:>16} {recall_text} {p50:>9.2f} {p99:>9.2f} {qps:>9.0f}")
+
+
+async def run(args):
+    rng = np.random.default_rng(args.seed)
+    embeddings = make_embeddings(rng, args.rows, args.dimension, args.clusters)
+    queries = make_embeddings(rng, args.queries, args.dimension, args.clusters)
+
+    with tempfile.TemporaryDirectory() as path:
+        exact = LocalDataStore(dimension=args.dimension, path=f"{path}/local")
+        graph = HnswDataStore(
+            dimension=args.dimension,
+            path=f"{path}/hnsw",
+            m=args.m,
+            ef_construction=args.ef_construction,
+        )
+        for store in (exact, graph):
+            await store.setup()
+            elapsed = await fill(store, embeddings, args.sources)
+            print(f"{type(store).__name__}: wrote {args.rows} rows in {elapsed:.1f}s")
+
+        filters = {"no filter": None}
+        if args.sources > 1:
+            # matches 1/sources of the rows
+            filters["filtered"] = DocumentMetadataFilter(source_id="source0")
+        for filter_name, filter in filters.items():
+            print(f"\n{filter_name}, top_k={args.top_k}")
+            print(
+                f"{'search':>16} {'recall':>9} {'p50 (ms)':>9} {'p99 (ms)':>9} {'qps':>9}"
+            )
+            expected, latencies = search(exact, queries, filter, args.top_k)
+            report("exact", latencies, None)
+            for ef in args.ef:
+                graph.ef_search = ef
+                results, latencies = search(graph, queries, filter, args.top_k)
+                report(f"hnsw ef={ef}", latencies, recall(results, expected))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--dimension", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--clusters", type=int, default=100)
+    parser.add_argument(
+        "--sources",
+        type=int,
+        default=10,
+        help="distinct source_id values, the filtered run matches one of them",
+    )
+    parser.add_argument("--m", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--ef", type=int, nargs="+", default=[16, 32, 64, 128, 256])
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
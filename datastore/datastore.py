@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Union
 import asyncio
+import os
 
 from models.models import (
     Document,
@@ -10,57 +11,304 @@ from models.models import (
     QueryResult,
     QueryWithEmbedding,
 )
-from services.chunks import get_document_chunks
-from services.gemini import get_embeddings
+from services.chunks import (
+    SegmentedDocument,
+    diff_document_chunks,
+    iter_document_chunks,
+)
+from services.gemini import (
+    EMBEDDINGS_BATCH_SIZE,
+    EMBEDDINGS_CONCURRENCY,
+    get_embeddings,
+)
+from services.query_cache import QueryCache, get_query_cache_key
+
+UPSERT_PIPELINE_DEPTH = int(
+    os.environ.get("UPSERT_PIPELINE_DEPTH", 4)
+)  # The number of chunk batches buffered between the ingestion stages
+UPSERT_WRITE_CONCURRENCY = int(
+    os.environ.get("UPSERT_WRITE_CONCURRENCY", 2)
+)  # The number of batches written to the datastore at a time
+# How upsert replaces the chunks already stored for a document:
+#   "replace": delete all of them before writing the new chunks
+#   "overwrite": write the new chunks over the old ones with the same (deterministic) ids, then delete
+#                the old chunks that were not overwritten.
+#   "incremental": like "overwrite", but the stored chunks whose hash matches a new chunk are kept as
+#                  they are, so only new or changed chunks are embedded and written.
+# "overwrite" and "incremental" fall back to "replace" for datastores that do not overwrite by id.
+UPSERT_MODES = ["replace", "overwrite", "incremental"]
+UPSERT_MODE = os.environ.get("UPSERT_MODE", "replace")
+assert (
+    UPSERT_MODE in UPSERT_MODES
+), "UPSERT_MODE must be one of 'replace' / 'overwrite' / 'incremental'."
+
+
+class UpsertError(Exception):
+    """
+    Raised when some documents could not be written.
+    failures maps each failed document id to its error, and ids lists the documents that were written.
+    """
+
+    def __init__(self, failures: Dict[str, str], ids: Optional[List[str]] = None):
+        super().__init__(
+            f"Failed to upsert {len(failures)} documents: "
+            + "; ".join(f"{doc_id}: {error}" for doc_id, error in failures.items())
+        )
+        self.failures = failures
+        self.ids = ids or []
 
 
 class DataStore(ABC):
+    # Whether writing a chunk replaces the stored chunk with the same id, see UPSERT_MODE
+    overwrites_by_id = False
+    # The number of chunks the upsert pipeline gathers for one _upsert call, None writes each embedded batch as it is
+    write_batch_size: Optional[int] = None
+
+    async def setup(self) -> None:
+        """
+        Prepares the datastore (connections, indexes) before it is used. Called once by get_datastore().
+        """
+
+    async def close(self) -> None:
+        """
+        Releases the connections of the datastore. Called when the server shuts down.
+        """
+
+    @property
+    def query_cache(self) -> QueryCache:
+        # Providers do not call super().__init__(), so the cache is created lazily
+        if not hasattr(self, "_query_cache"):
+            self._query_cache = QueryCache()
+        return self._query_cache
+
     async def upsert(
-        self, documents: List[Document], chunk_token_size: Optional[int] = None
+        self,
+        documents: List[Union[Document, SegmentedDocument]],
+        chunk_token_size: Optional[int] = None,
+        on_progress: Optional[Callable[[str, int], None]] = None,
     ) -> List[str]:
         """
         Takes in a list of documents and inserts them into the database.
-        First deletes all the existing vectors with the document id (if necessary, depends on the vector db), then inserts the new ones.
+        Existing vectors with the document ids are replaced as configured by UPSERT_MODE: either deleted
+        with a single batched delete before the new ones are inserted, or overwritten by chunk id with
+        only the stale trailing chunks deleted afterwards, or diffed against the new chunks by hash so
+        that unchanged chunks are kept and only the changed ones are embedded.
+        on_progress, if given, is called with ("embedded", n) and ("written", n) as batches of n chunks go through the pipeline,
+        and with ("reused", n) for the n unchanged chunks kept from the stored version of a document.
         Return a list of document ids.
         """
-        # Delete any existing vectors for documents with the input document ids
-        result = await asyncio.gather(
-            *[
-                self.delete(
-                    filter=DocumentMetadataFilter(
-                        document_id=document.id,
-                    ),
-                    delete_all=False,
+        document_ids = [document.id for document in documents if document.id]
+        overwrite = UPSERT_MODE != "replace" and self.overwrites_by_id
+        existing_ids = set(document_ids)
+        if document_ids and not overwrite:
+            # Delete any existing vectors for documents with the input document ids, in one call
+            await self.delete(ids=document_ids)
+
+        # hashes of the chunks already stored for the documents, diffed against the new chunks
+        stored_hashes = (
+            await self._get_chunk_hashes(document_ids)
+            if document_ids and overwrite and UPSERT_MODE == "incremental"
+            else None
+        )
+
+        # ids of the chunks written for each input document
+        chunk_ids: Dict[str, List[str]] = {}
+        written: List[str] = []
+        try:
+            try:
+                written = await self._upsert_pipeline(
+                    documents, chunk_token_size, on_progress, chunk_ids, stored_hashes
                 )
-                for document in documents
-                if document.id
-            ]
+                return written
+            except UpsertError as e:
+                written = e.ids
+                raise
+            finally:
+                if overwrite:
+                    # the chunks a written document no longer has, such as the tail of a shortened document
+                    # or, in incremental mode, the chunks that changed or vanished
+                    stale = {
+                        doc_id: chunk_ids[doc_id]
+                        for doc_id in written
+                        if doc_id in chunk_ids and doc_id in existing_ids
+                    }
+                    if stale:
+                        await self._delete_stale_chunks(stale)
+        finally:
+            # even a failed upsert may have written some of the chunks
+            self.query_cache.invalidate()
+
+    async def _upsert_pipeline(
+        self,
+        documents: List[Union[Document, SegmentedDocument]],
+        chunk_token_size: Optional[int],
+        on_progress: Optional[Callable[[str, int], None]] = None,
+        chunk_ids: Optional[Dict[str, List[str]]] = None,
+        stored_hashes: Optional[Dict[str, Dict[str, Optional[str]]]] = None,
+    ) -> List[str]:
+        """
+        Chunks, embeds and writes the documents as three stages connected by bounded queues.
+        Writing a batch overlaps with embedding the next ones, and only a few batches of
+        EMBEDDINGS_BATCH_SIZE chunks (or write_batch_size chunks per writer) are held in memory
+        however large the request is.
+        chunk_ids, if given, is filled with the ids of the chunks of each document.
+        stored_hashes, if given, maps document ids to the hashes of their stored chunks; the chunks
+        that match one of them are not embedded nor written, and their stored ids go into chunk_ids.
+        Return a list of document ids, or raise UpsertError if some documents could not be written.
+        """
+        embed_queue: "asyncio.Queue[Optional[List[DocumentChunk]]]" = asyncio.Queue(
+            maxsize=UPSERT_PIPELINE_DEPTH
         )
-        chunks = get_document_chunks(documents, chunk_token_size)
-        return await self._upsert(chunks)
+        write_queue: "asyncio.Queue[Optional[List[DocumentChunk]]]" = asyncio.Queue(
+            maxsize=UPSERT_PIPELINE_DEPTH
+        )
+        doc_ids: List[str] = []
+        failures: Dict[str, str] = {}
+
+        async def chunk_stage():
+            batch: List[DocumentChunk] = []
+            # a document that is diffed against its stored chunks needs all of its parts
+            doc_parts: List[DocumentChunk] = []
+            first_part = True
+            async for doc_chunks, doc_id, last in iter_document_chunks(
+                documents, chunk_token_size
+            ):
+                if first_part:
+                    doc_ids.append(doc_id)
+                    if chunk_ids is not None:
+                        chunk_ids[doc_id] = []
+                first_part = last
+                kept_ids: List[str] = []
+                if stored_hashes is not None and doc_id in stored_hashes:
+                    doc_parts.extend(doc_chunks)
+                    if not last:
+                        continue
+                    doc_chunks, kept_ids = diff_document_chunks(
+                        doc_parts, stored_hashes[doc_id]
+                    )
+                    doc_parts = []
+                    if kept_ids and on_progress is not None:
+                        on_progress("reused", len(kept_ids))
+                if chunk_ids is not None:
+                    chunk_ids[doc_id] += kept_ids + [chunk.id for chunk in doc_chunks]
+                for chunk in doc_chunks:
+                    batch.append(chunk)
+                    if len(batch) == EMBEDDINGS_BATCH_SIZE:
+                        await embed_queue.put(batch)
+                        batch = []
+            if batch:
+                await embed_queue.put(batch)
+            for _ in range(EMBEDDINGS_CONCURRENCY):
+                await embed_queue.put(None)
+
+        async def embed_worker():
+            while (batch := await embed_queue.get()) is not None:
+                embeddings = await get_embeddings([chunk.text for chunk in batch])
+                for chunk, embedding in zip(batch, embeddings):
+                    chunk.embedding = embedding
+                if on_progress is not None:
+                    on_progress("embedded", len(batch))
+                await write_queue.put(batch)
+
+        async def embed_stage():
+            # a failing worker cancels the others, which would otherwise wait on embed_queue forever
+            await run_stages(*[embed_worker() for _ in range(EMBEDDINGS_CONCURRENCY)])
+            for _ in range(UPSERT_WRITE_CONCURRENCY):
+                await write_queue.put(None)
+
+        async def write_worker():
+            done = False
+            while not done:
+                # gather embedded batches up to the write batch size of the datastore
+                batch: List[DocumentChunk] = []
+                while len(batch) < (self.write_batch_size or 1):
+                    embedded = await write_queue.get()
+                    if embedded is None:
+                        done = True
+                        break
+                    batch += embedded
+                if not batch:
+                    continue
+                chunks: Dict[str, List[DocumentChunk]] = {}
+                for chunk in batch:
+                    doc_id = chunk.metadata.document_id or ""
+                    chunks.setdefault(doc_id, []).append(chunk)
+                try:
+                    await self._upsert(chunks)
+                except UpsertError as e:
+                    # keep writing the other batches and report the failed documents at the end
+                    failures.update(e.failures)
+                    continue
+                if on_progress is not None:
+                    on_progress("written", len(batch))
+
+        await run_stages(
+            chunk_stage(),
+            embed_stage(),
+            *[write_worker() for _ in range(UPSERT_WRITE_CONCURRENCY)],
+        )
+        if failures:
+            raise UpsertError(
+                failures, ids=[doc_id for doc_id in doc_ids if doc_id not in failures]
+            )
+        return doc_ids
 
     @abstractmethod
     async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
         """
         Takes in a list of list of document chunks and inserts them into the database.
         Return a list of document ids.
+        Raise UpsertError to report documents whose chunks could not be written.
         """
 
         raise NotImplementedError
 
-    async def query(self, queries: List[Query]) -> List[QueryResult]:
+    async def query(
+        self, queries: List[Query], use_cache: bool = True
+    ) -> List[QueryResult]:
         """
         Takes in a list of queries and filters and returns a list of query results with matching document chunks and scores.
+        Results are served from the query cache when possible, unless use_cache is False.
         """
+        generation = self.query_cache.generation
+        keys = [get_query_cache_key(query) for query in queries]
+        results: List[Optional[QueryResult]] = [
+            self.query_cache.get(key) if use_cache else None for key in keys
+        ]
+        # only the queries that missed the cache are embedded and sent to the datastore
+        missing = [i for i, result in enumerate(results) if result is None]
+        if not missing:
+            return results  # type: ignore
+
         # get a list of of just the queries from the Query list
-        query_texts = [query.query for query in queries]
-        query_embeddings = get_embeddings(query_texts)
+        query_texts = [queries[i].query for i in missing]
+        query_embeddings = await get_embeddings(query_texts)
         # hydrate the queries with embeddings
         queries_with_embeddings = [
-            QueryWithEmbedding(**query.dict(), embedding=embedding)
-            for query, embedding in zip(queries, query_embeddings)
+            QueryWithEmbedding(**queries[i].dict(), embedding=embedding)
+            for i, embedding in zip(missing, query_embeddings)
         ]
-        return await self._query(queries_with_embeddings)
+        query_results = await self._query(queries_with_embeddings)
+        for i, result in zip(missing, query_results):
+            results[i] = result
+            self.query_cache.put(keys[i], result, generation)
+        return results  # type: ignore
+
+    async def _get_chunk_hashes(
+        self, document_ids: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        """
+        Returns the chunks stored for the documents, as document id -> chunk id -> chunk hash.
+        Only called on datastores that set overwrites_by_id.
+        """
+        raise NotImplementedError
+
+    async def _delete_stale_chunks(self, chunk_ids: Dict[str, List[str]]) -> None:
+        """
+        Takes in a dict of document ids to the ids of the chunks just written for them, and removes the
+        other chunks stored for those documents. Only called on datastores that set overwrites_by_id.
+        """
+        raise NotImplementedError
 
     @abstractmethod
     async def _query(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
@@ -69,12 +317,27 @@ class DataStore(ABC):
         """
         raise NotImplementedError
 
-    @abstractmethod
     async def delete(
         self,
         ids: Optional[List[str]] = None,
         filter: Optional[DocumentMetadataFilter] = None,
         delete_all: Optional[bool] = None,
+    ) -> bool:
+        """
+        Removes vectors by ids, filter, or everything in the datastore.
+        Multiple parameters can be used at once.
+        Returns whether the operation was successful.
+        """
+        success = await self._delete(ids=ids, filter=filter, delete_all=delete_all)
+        self.query_cache.invalidate()
+        return success
+
+    @abstractmethod
+    async def _delete(
+        self,
+        ids: Optional[List[str]] = None,
+        filter: Optional[DocumentMetadataFilter] = None,
+        delete_all: Optional[bool] = None,
     ) -> bool:
         """
         Removes vectors by ids, filter, or everything in the datastore.
@@ -82,3 +345,25 @@ class DataStore(ABC):
         Returns whether the operation was successful.
         """
         raise NotImplementedError
+
+
+async def run_stages(*stages: Coroutine[Any, Any, None]) -> None:
+    """
+    Run the stages of a pipeline concurrently until all of them finish.
+    If any stage fails (or the caller is cancelled) the other stages are cancelled, so none of them stays blocked on a queue.
+    """
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    for task in done:
+        # re-raise the first exception, if any
+        task.result()
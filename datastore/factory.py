@@ -1,24 +1,42 @@
 from datastore.datastore import DataStore
+from services.gemini import get_embedding_dimension
 import os
 
 
 async def get_datastore() -> DataStore:
+    datastore = await _create_datastore()
+    await datastore.setup()
+    return datastore
+
+
+async def _create_datastore() -> DataStore:
     datastore = os.environ.get("DATASTORE")
     assert datastore is not None
 
+    # Indexes are created with, or validated against, the dimension of the configured embedding model
+    dimension = await get_embedding_dimension()
+
     match datastore:
         case "pinecone":
             from datastore.providers.pinecone_datastore import PineconeDataStore
 
-            return PineconeDataStore()
+            return PineconeDataStore(dimension=dimension)
         case "elasticsearch":
             from datastore.providers.elasticsearch_datastore import (
                 ElasticsearchDataStore,
             )
 
-            return ElasticsearchDataStore()
+            return ElasticsearchDataStore(vector_size=dimension)
+        case "local":
+            from datastore.providers.local_datastore import LocalDataStore
+
+            return LocalDataStore(dimension=dimension)
+        case "hnsw":
+            from datastore.providers.hnsw_datastore import HnswDataStore
+
+            return HnswDataStore(dimension=dimension)
         case _:
             raise ValueError(
                 f"Unsupported vector database: {datastore}. "
-                f"Try one of the following: llama, elasticsearch, pinecone, weaviate, milvus, zilliz, redis, azuresearch, or qdrant"
+                f"Try one of the following: local, hnsw, llama, elasticsearch, pinecone, weaviate, milvus, zilliz, redis, azuresearch, or qdrant"
             )
@@ -1,15 +1,20 @@
+import asyncio
+import math
 import os
-from typing import Dict, List, Any, Optional
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Any, Optional, Tuple
 
 import elasticsearch
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import AsyncElasticsearch, helpers
 from loguru import logger
 
-from datastore.datastore import DataStore
+from datastore.datastore import DataStore, UpsertError
 from models.models import (
     DocumentChunk,
     DocumentChunkWithScore,
     DocumentMetadataFilter,
+    QueryMode,
     QueryResult,
     QueryWithEmbedding,
 )
@@ -25,11 +30,85 @@ ELASTICSEARCH_INDEX = os.environ.get("ELASTICSEARCH_INDEX")
 ELASTICSEARCH_REPLICAS = int(os.environ.get("ELASTICSEARCH_REPLICAS", "1"))
 ELASTICSEARCH_SHARDS = int(os.environ.get("ELASTICSEARCH_SHARDS", "1"))
 
-VECTOR_SIZE = 1536
+ELASTICSEARCH_CONNECTIONS_PER_NODE = int(
+    os.environ.get("ELASTICSEARCH_CONNECTIONS_PER_NODE", "10")
+)
+ELASTICSEARCH_REQUEST_TIMEOUT = float(
+    os.environ.get("ELASTICSEARCH_REQUEST_TIMEOUT", "30")
+)
+ELASTICSEARCH_MAX_RETRIES = int(os.environ.get("ELASTICSEARCH_MAX_RETRIES", "3"))
+
+ELASTICSEARCH_BULK_MAX_BYTES = int(
+    os.environ.get("ELASTICSEARCH_BULK_MAX_BYTES", 10 * 1024 * 1024)
+)
+ELASTICSEARCH_BULK_CONCURRENCY = int(
+    os.environ.get("ELASTICSEARCH_BULK_CONCURRENCY", "4")
+)
+ELASTICSEARCH_BULK_MAX_RETRIES = int(
+    os.environ.get("ELASTICSEARCH_BULK_MAX_RETRIES", "3")
+)
+
+# kNN candidates considered per shard: top_k * ELASTICSEARCH_NUM_CANDIDATES_FACTOR,
+# at least ELASTICSEARCH_MIN_NUM_CANDIDATES and at most MAX_NUM_CANDIDATES
+ELASTICSEARCH_NUM_CANDIDATES_FACTOR = int(
+    os.environ.get("ELASTICSEARCH_NUM_CANDIDATES_FACTOR", "10")
+)
+ELASTICSEARCH_MIN_NUM_CANDIDATES = int(
+    os.environ.get("ELASTICSEARCH_MIN_NUM_CANDIDATES", "100")
+)
+MAX_NUM_CANDIDATES = 10000
+# Whether query results include the stored embeddings
+ELASTICSEARCH_RETURN_EMBEDDINGS = (
+    os.environ.get("ELASTICSEARCH_RETURN_EMBEDDINGS", "false").lower() == "true"
+)
+
+# Query mode used when a query does not set one: "vector" (kNN only) or "hybrid" (kNN + BM25 fused with RRF)
+ELASTICSEARCH_QUERY_MODE = QueryMode(
+    os.environ.get("ELASTICSEARCH_QUERY_MODE", QueryMode.vector.value)
+)
+# Reciprocal rank fusion constant and the number of hits fetched per ranking, as a multiple of top_k
+ELASTICSEARCH_RRF_K = int(os.environ.get("ELASTICSEARCH_RRF_K", "60"))
+ELASTICSEARCH_RRF_WINDOW_FACTOR = int(
+    os.environ.get("ELASTICSEARCH_RRF_WINDOW_FACTOR", "2")
+)
+
+# Startup only deletes the existing index when this is set, use reindex() (POST /reindex) to change its settings instead
+ELASTICSEARCH_RECREATE_INDEX = (
+    os.environ.get("ELASTICSEARCH_RECREATE_INDEX", "false").lower() == "true"
+)
+ELASTICSEARCH_REINDEX_POLL_INTERVAL = float(
+    os.environ.get("ELASTICSEARCH_REINDEX_POLL_INTERVAL", "5")
+)
+# Chunks updated up to this many seconds before a reindex started are copied again when it catches up,
+# to allow for clock differences between the servers writing to the index
+ELASTICSEARCH_REINDEX_CLOCK_SKEW = int(
+    os.environ.get("ELASTICSEARCH_REINDEX_CLOCK_SKEW", "60")
+)
+
+# How embeddings are stored:
+#   "none": float32 vectors
+#   "byte": int8 vectors (element_type byte), quantized here; requires cosine or dot_product similarity
+#   "int8_hnsw": float32 vectors with an int8-quantized HNSW graph, quantized by Elasticsearch (8.12+)
+QUANTIZATIONS = ["none", "byte", "int8_hnsw"]
+SIMILARITIES = ["cosine", "l2_norm", "dot_product"]
+ELASTICSEARCH_VECTOR_QUANTIZATION = os.environ.get(
+    "ELASTICSEARCH_VECTOR_QUANTIZATION", "none"
+)
+
+# Gemini models/embedding-001, get_datastore() passes the probed dimension
+VECTOR_SIZE = 768
 UPSERT_BATCH_SIZE = 100
+# Bulk item statuses that are worth retrying
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Metadata fields matched exactly by filters and deletes, mapped as keyword so ids are not analyzed
+FILTER_FIELDS = ["document_id", "source", "source_id", "author"]
+KEYWORD_FIELDS = FILTER_FIELDS + ["url", "chunk_hash"]
 
 
 class ElasticsearchDataStore(DataStore):
+    # Chunks are indexed with their id as the document _id, so writing a chunk replaces the stored one
+    overwrites_by_id = True
+
     def __init__(
         self,
         index_name: Optional[str] = None,
@@ -37,7 +116,8 @@ class ElasticsearchDataStore(DataStore):
         similarity: str = "cosine",
         replicas: int = ELASTICSEARCH_REPLICAS,
         shards: int = ELASTICSEARCH_SHARDS,
-        recreate_index: bool = True,
+        recreate_index: bool = ELASTICSEARCH_RECREATE_INDEX,
+        quantization: str = ELASTICSEARCH_VECTOR_QUANTIZATION,
     ):
         """
         Args:
@@ -45,6 +125,9 @@ class ElasticsearchDataStore(DataStore):
             vector_size: Size of the embedding stored in a collection
             similarity:
                 Any of "cosine" / "l2_norm" / "dot_product".
+            recreate_index: Whether to delete the existing index and start with an empty one.
+            quantization:
+                Any of "none" / "byte" / "int8_hnsw", see ELASTICSEARCH_VECTOR_QUANTIZATION.
 
         """
         assert similarity in [
@@ -52,6 +135,12 @@ class ElasticsearchDataStore(DataStore):
             "l2_norm",
             "dot_product",
         ], "Similarity must be one of 'cosine' / 'l2_norm' / 'dot_product'."
+        assert (
+            quantization in QUANTIZATIONS
+        ), "Quantization must be one of 'none' / 'byte' / 'int8_hnsw'."
+        assert not (
+            quantization == "byte" and similarity == "l2_norm"
+        ), "Byte quantization requires 'cosine' or 'dot_product' similarity."
         assert replicas > 0, "Replicas must be greater than or equal to 0."
         assert shards > 0, "Shards must be greater than or equal to 0."
 
@@ -67,49 +156,146 @@ class ElasticsearchDataStore(DataStore):
         ), "Please provide an index name."
         self.index_name = index_name or ELASTICSEARCH_INDEX or ""
 
-        replicas = replicas or ELASTICSEARCH_REPLICAS
-        shards = shards or ELASTICSEARCH_SHARDS
+        self.vector_size = vector_size
+        self.similarity = similarity
+        self.replicas = replicas or ELASTICSEARCH_REPLICAS
+        self.shards = shards or ELASTICSEARCH_SHARDS
+        self.recreate_index = recreate_index
+        self.quantization = quantization
+        # Field queried for each metadata field that is not mapped as keyword, see get_filter_fields()
+        self._filter_fields: Dict[str, str] = {}
+        # Writes in progress, and whether new ones wait until reindex() has swapped the indices
+        self._writes = 0
+        self._writes_paused = False
+        self._writes_changed = asyncio.Condition()
+        # Queries of the deletes run while reindex() copies the index, replayed on the new index, None when not reindexing
+        self._reindex_deletes: Optional[List[Dict[str, Any]]] = None
+
+    async def setup(self) -> None:
+        """
+        Checks the connection and sets up the index so the documents might be inserted or queried.
+        """
+        try:
+            await self.client.info()
+        except Exception as e:
+            logger.error(f"Error connecting to Elasticsearch: {e}")
+            raise e
+
+        await self._set_up_index(
+            self.vector_size,
+            self.similarity,
+            self.replicas,
+            self.shards,
+            self.recreate_index,
+        )
 
-        # Set up the collection so the documents might be inserted or queried
-        self._set_up_index(vector_size, similarity, replicas, shards, recreate_index)
+    async def close(self) -> None:
+        await self.client.close()
 
     async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
         """
         Takes in a list of document chunks and inserts them into the database.
-        Return a list of document ids.
+        Chunks are sent in bulk requests of at most UPSERT_BATCH_SIZE chunks and ELASTICSEARCH_BULK_MAX_BYTES,
+        ELASTICSEARCH_BULK_CONCURRENCY requests at a time. Failed items with a retryable status are sent again.
+        Return a list of document ids, or raise UpsertError with the documents that could not be written.
         """
-        actions = []
-        for _, chunkList in chunks.items():
-            for chunk in chunkList:
-                actions = (
-                    actions
-                    + self._convert_document_chunk_to_es_document_operation(chunk)
+        chunks_by_id = {
+            chunk.id: chunk for chunk_list in chunks.values() for chunk in chunk_list
+        }
+        # Chunks that failed with a status that is not worth retrying, kept across attempts
+        failed: Dict[str, Tuple[int, str]] = {}
+        retryable: Dict[str, Tuple[int, str]] = {}
+        pending = list(chunks_by_id.values())
+        for attempt in range(ELASTICSEARCH_BULK_MAX_RETRIES + 1):
+            if attempt > 0:
+                logger.warning(
+                    f"Retrying {len(pending)} failed chunks (attempt {attempt})"
                 )
-
-        self.client.bulk(operations=actions, index=self.index_name)
+                await asyncio.sleep(min(2**attempt, 30))
+            retryable = {}
+            for chunk_id, (status, error) in (await self._bulk_index(pending)).items():
+                if status in RETRYABLE_STATUSES:
+                    retryable[chunk_id] = (status, error)
+                else:
+                    failed[chunk_id] = (status, error)
+            pending = [chunks_by_id[chunk_id] for chunk_id in retryable]
+            if not pending:
+                break
+        # Chunks that still fail with a retryable status after the last attempt
+        failed.update(retryable)
+
+        if failed:
+            failures: Dict[str, str] = {}
+            for chunk_id, (_, error) in failed.items():
+                doc_id = chunks_by_id[chunk_id].metadata.document_id or ""
+                failures.setdefault(doc_id, error)
+            logger.error(f"Error upserting {len(failed)} chunks: {failures}")
+            raise UpsertError(
+                failures,
+                ids=[doc_id for doc_id in chunks.keys() if doc_id not in failures],
+            )
         return list(chunks.keys())
 
+    async def _bulk_index(
+        self, chunks: List[DocumentChunk]
+    ) -> Dict[str, Tuple[int, str]]:
+        """
+        Indexes the chunks with concurrent streaming bulk requests.
+        Return the status and error of each chunk that failed, by chunk id.
+        """
+        # The consumers share one generator, so every action is sent exactly once
+        actions = self._iter_es_actions(chunks)
+        failed: Dict[str, Tuple[int, str]] = {}
+
+        async def consume():
+            async for ok, item in helpers.async_streaming_bulk(
+                self.client,
+                actions,
+                chunk_size=UPSERT_BATCH_SIZE,
+                max_chunk_bytes=ELASTICSEARCH_BULK_MAX_BYTES,
+                raise_on_error=False,
+                raise_on_exception=False,
+            ):
+                if not ok:
+                    result = item["index"]
+                    failed[result["_id"]] = (
+                        result.get("status", 500),
+                        str(result.get("error") or result.get("exception")),
+                    )
+
+        async with self._write():
+            await asyncio.gather(
+                *[consume() for _ in range(ELASTICSEARCH_BULK_CONCURRENCY)]
+            )
+        return failed
+
     async def _query(
         self,
         queries: List[QueryWithEmbedding],
     ) -> List[QueryResult]:
         """
         Takes in a list of queries with embeddings and filters and returns a list of query results with matching document chunks and scores.
+        Hybrid queries send a kNN and a BM25 search in the same msearch and fuse both rankings with reciprocal rank fusion.
         """
         searches = self._convert_queries_to_msearch_query(queries)
-        results = self.client.msearch(searches=searches)
-        return [
-            QueryResult(
-                query=query.query,
-                results=[
+        results = await self.client.msearch(searches=searches)
+        responses = iter(results["responses"])
+
+        query_results = []
+        for query in queries:
+            knn_hits = next(responses)["hits"]["hits"]
+            if self._get_query_mode(query) == QueryMode.hybrid:
+                text_hits = next(responses)["hits"]["hits"]
+                chunks = self._fuse_hits([knn_hits, text_hits], query.top_k)
+            else:
+                chunks = [
                     self._convert_hit_to_document_chunk_with_score(hit)
-                    for hit in result["hits"]["hits"]
-                ],
-            )
-            for query, result in zip(queries, results["responses"])
-        ]
+                    for hit in knn_hits
+                ]
+            query_results.append(QueryResult(query=query.query, results=chunks))
+        return query_results
 
-    async def delete(
+    async def _delete(
         self,
         ids: Optional[List[str]] = None,
         filter: Optional[DocumentMetadataFilter] = None,
@@ -124,9 +310,7 @@ class ElasticsearchDataStore(DataStore):
         if delete_all:
             try:
                 logger.info(f"Deleting all vectors from index")
-                self.client.delete_by_query(
-                    index=self.index_name, query={"match_all": {}}
-                )
+                await self._delete_by_query({"match_all": {}})
                 logger.info(f"Deleted all vectors successfully")
                 return True
             except Exception as e:
@@ -139,7 +323,7 @@ class ElasticsearchDataStore(DataStore):
         if es_filters != {}:
             try:
                 logger.info(f"Deleting vectors with filter {es_filters}")
-                self.client.delete_by_query(index=self.index_name, query=es_filters)
+                await self._delete_by_query(es_filters)
                 logger.info(f"Deleted vectors with filter successfully")
             except Exception as e:
                 logger.error(f"Error deleting vectors with filter: {e}")
@@ -149,9 +333,12 @@ class ElasticsearchDataStore(DataStore):
             try:
                 documents_to_delete = [doc_id for doc_id in ids]
                 logger.info(f"Deleting {len(documents_to_delete)} documents")
-                res = self.client.delete_by_query(
-                    index=self.index_name,
-                    query={"terms": {"metadata.document_id": documents_to_delete}},
+                await self._delete_by_query(
+                    {
+                        "terms": {
+                            self._get_filter_field("document_id"): documents_to_delete
+                        }
+                    },
                 )
                 logger.info(f"Deleted documents successfully")
             except Exception as e:
@@ -160,6 +347,95 @@ class ElasticsearchDataStore(DataStore):
 
         return True
 
+    async def _get_chunk_hashes(
+        self, document_ids: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        """
+        Scrolls through the chunks of the documents, fetching only their document id and chunk hash.
+        """
+        hashes: Dict[str, Dict[str, Optional[str]]] = {}
+        async for hit in helpers.async_scan(
+            self.client,
+            index=self.index_name,
+            query={
+                "query": {
+                    "terms": {self._get_filter_field("document_id"): document_ids}
+                },
+                "_source": ["metadata.document_id", "metadata.chunk_hash"],
+            },
+        ):
+            metadata = hit["_source"].get("metadata", {})
+            chunk_hash = metadata.get("chunk_hash")
+            hashes.setdefault(metadata.get("document_id"), {})[hit["_id"]] = chunk_hash
+        return hashes
+
+    async def _delete_stale_chunks(self, chunk_ids: Dict[str, List[str]]) -> None:
+        """
+        Removes the chunks of the documents that are not among the chunk ids just written, with a single delete_by_query.
+        """
+        document_id_field = self._get_filter_field("document_id")
+        try:
+            logger.info(f"Deleting stale chunks of {len(chunk_ids)} documents")
+            await self._delete_by_query(
+                {
+                    "bool": {
+                        "filter": [{"terms": {document_id_field: list(chunk_ids)}}],
+                        "must_not": [
+                            {
+                                "ids": {
+                                    "values": [
+                                        chunk_id
+                                        for ids in chunk_ids.values()
+                                        for chunk_id in ids
+                                    ]
+                                }
+                            }
+                        ],
+                    }
+                },
+            )
+            logger.info(f"Deleted stale chunks successfully")
+        except Exception as e:
+            logger.error(f"Error deleting stale chunks: {e}")
+            raise e
+
+    async def _delete_by_query(self, query: Dict[str, Any]) -> None:
+        async with self._write():
+            await self.client.delete_by_query(index=self.index_name, query=query)
+            if self._reindex_deletes is not None:
+                self._reindex_deletes.append(query)
+
+    @asynccontextmanager
+    async def _write(self) -> AsyncIterator[None]:
+        """
+        Counts a write to the index for the duration of the block, waiting first while reindex() has paused writes.
+        """
+        async with self._writes_changed:
+            await self._writes_changed.wait_for(lambda: not self._writes_paused)
+            self._writes += 1
+        try:
+            yield
+        finally:
+            async with self._writes_changed:
+                self._writes -= 1
+                self._writes_changed.notify_all()
+
+    @asynccontextmanager
+    async def _pause_writes(self) -> AsyncIterator[None]:
+        """
+        Holds back new writes for the duration of the block, once the writes in progress are done.
+        """
+        async with self._writes_changed:
+            self._writes_paused = True
+        try:
+            async with self._writes_changed:
+                await self._writes_changed.wait_for(lambda: self._writes == 0)
+            yield
+        finally:
+            async with self._writes_changed:
+                self._writes_paused = False
+                self._writes_changed.notify_all()
+
     def _get_es_filters(
         self, filter: Optional[DocumentMetadataFilter] = None
     ) -> Dict[str, Any]:
@@ -187,67 +463,144 @@ class ElasticsearchDataStore(DataStore):
                     )
                 else:
                     es_filters["bool"]["must"].append(
-                        {"term": {f"metadata.{field}": value}}
+                        {"term": {self._get_filter_field(field): value}}
                     )
 
         return es_filters
 
-    def _convert_document_chunk_to_es_document_operation(
+    def _get_filter_field(self, field: str) -> str:
+        return self._filter_fields.get(field, f"metadata.{field}")
+
+    def _iter_es_actions(self, chunks: List[DocumentChunk]) -> Iterator[Dict]:
+        for chunk in chunks:
+            yield self._convert_document_chunk_to_es_action(chunk)
+
+    def _convert_document_chunk_to_es_action(
         self, document_chunk: DocumentChunk
-    ) -> List[Dict]:
+    ) -> Dict:
         created_at = (
             to_unix_timestamp(document_chunk.metadata.created_at)
             if document_chunk.metadata.created_at is not None
             else None
         )
 
-        action_and_metadata = {
-            "index": {
-                "_index": self.index_name,
-                "_id": document_chunk.id,
-            }
-        }
-
-        source = {
-            "id": document_chunk.id,
-            "text": document_chunk.text,
-            "metadata": document_chunk.metadata.dict(),
-            "created_at": created_at,
-            "embedding": document_chunk.embedding,
+        return {
+            "_op_type": "index",
+            "_index": self.index_name,
+            "_id": document_chunk.id,
+            "_source": {
+                "id": document_chunk.id,
+                "text": document_chunk.text,
+                "metadata": document_chunk.metadata.dict(),
+                "created_at": created_at,
+                # when the chunk was written, so reindex() can copy the chunks written while it runs again
+                "updated_at": int(time.time()),
+                "embedding": self._convert_embedding_to_es_vector(
+                    document_chunk.embedding
+                ),
+            },
         }
 
-        return [action_and_metadata, source]
-
     def _convert_queries_to_msearch_query(self, queries: List[QueryWithEmbedding]):
         searches = []
+        source = (
+            True if ELASTICSEARCH_RETURN_EMBEDDINGS else {"excludes": ["embedding"]}
+        )
 
         for query in queries:
+            hybrid = self._get_query_mode(query) == QueryMode.hybrid
+            # Each ranking of a hybrid query fetches a wider window, so documents ranked
+            # a little lower by one of them can still make the fused top_k
+            size = (
+                (query.top_k or 1) * ELASTICSEARCH_RRF_WINDOW_FACTOR
+                if hybrid
+                else query.top_k
+            )
+
+            knn = {
+                "field": "embedding",
+                "query_vector": self._convert_embedding_to_es_vector(query.embedding),
+                "k": size,
+                "num_candidates": self._get_num_candidates(size),
+            }
+            # Metadata filters are applied while searching the graph, not on the top_k hits
+            es_filters = self._get_es_filters(query.filter)
+            if es_filters != {}:
+                knn["filter"] = es_filters
+
             searches.append({"index": self.index_name})
-            searches.append(
-                {
-                    "_source": True,
-                    "knn": {
-                        "field": "embedding",
-                        "query_vector": query.embedding,
-                        "k": query.top_k,
-                        "num_candidates": query.top_k,
-                    },
-                    "size": query.top_k,
+            searches.append({"_source": source, "knn": knn, "size": size})
+
+            if hybrid:
+                text_query: Dict[str, Any] = {
+                    "bool": {"must": [{"match": {"text": query.query}}]}
                 }
-            )
+                if es_filters != {}:
+                    text_query["bool"]["filter"] = [es_filters]
+                searches.append({"index": self.index_name})
+                searches.append({"_source": source, "query": text_query, "size": size})
 
         return searches
 
+    def _convert_embedding_to_es_vector(
+        self, embedding: Optional[List[float]]
+    ) -> Optional[List[float]]:
+        if embedding is None or self.quantization != "byte":
+            return embedding
+        # Scale to unit length, then to the int8 range. Cosine and dot product only depend on the
+        # direction of the vectors, which this keeps up to rounding.
+        norm = math.sqrt(sum(value * value for value in embedding)) or 1.0
+        return [max(-127, min(127, round(value / norm * 127))) for value in embedding]
+
+    def _get_query_mode(self, query: QueryWithEmbedding) -> QueryMode:
+        return query.mode or ELASTICSEARCH_QUERY_MODE
+
+    def _fuse_hits(
+        self, rankings: List[List[Dict]], top_k: Optional[int]
+    ) -> List[DocumentChunkWithScore]:
+        """
+        Fuses rankings of hits with reciprocal rank fusion: score = sum of 1 / (ELASTICSEARCH_RRF_K + rank).
+        """
+        scores: Dict[str, float] = {}
+        hits: Dict[str, Dict] = {}
+        for ranking in rankings:
+            for rank, hit in enumerate(ranking, start=1):
+                scores[hit["_id"]] = scores.get(hit["_id"], 0.0) + 1.0 / (
+                    ELASTICSEARCH_RRF_K + rank
+                )
+                hits.setdefault(hit["_id"], hit)
+
+        fused = sorted(scores, key=scores.__getitem__, reverse=True)[: top_k or 1]
+        return [
+            self._convert_hit_to_document_chunk_with_score(
+                {**hits[hit_id], "_score": scores[hit_id]}
+            )
+            for hit_id in fused
+        ]
+
+    def _get_num_candidates(self, top_k: Optional[int]) -> int:
+        top_k = top_k or 1
+        return max(
+            top_k,
+            min(
+                max(
+                    top_k * ELASTICSEARCH_NUM_CANDIDATES_FACTOR,
+                    ELASTICSEARCH_MIN_NUM_CANDIDATES,
+                ),
+                MAX_NUM_CANDIDATES,
+            ),
+        )
+
     def _convert_hit_to_document_chunk_with_score(self, hit) -> DocumentChunkWithScore:
         return DocumentChunkWithScore(
             id=hit["_id"],
             text=hit["_source"]["text"],  # type: ignore
             metadata=hit["_source"]["metadata"],  # type: ignore
-            embedding=hit["_source"]["embedding"],  # type: ignore
+            embedding=hit["_source"].get("embedding"),  # type: ignore
             score=hit["_score"],
         )
 
-    def _set_up_index(
+    async def _set_up_index(
         self,
         vector_size: int,
         similarity: str,
@@ -255,64 +608,362 @@ class ElasticsearchDataStore(DataStore):
         shards: int,
         recreate_index: bool,
     ) -> None:
+        """
+        Makes sure the index exists. index_name is an alias pointing at a versioned index ("<index_name>_v<n>"),
+        so the index can later be rebuilt with reindex() without downtime.
+        An existing concrete index named index_name is used as it is, until the first reindex() turns it into an alias.
+        """
         if recreate_index:
-            self._recreate_index(similarity, vector_size, replicas, shards)
+            await self._recreate_index(similarity, vector_size, replicas, shards)
+            return
+
+        try:
+            properties = await self._get_mapping_properties()
+        except elasticsearch.exceptions.NotFoundError:
+            logger.info(f"Index {self.index_name} not found, creating it")
+            await self._recreate_index(similarity, vector_size, replicas, shards)
+            return
+
+        mapping = properties["embedding"]
+        self._filter_fields = get_filter_fields(properties)
+        if self._filter_fields:
+            logger.warning(
+                f"Index {self.index_name} maps metadata fields as text, filtering on their keyword subfields. "
+                f"Call `reindex()` to map them as keyword."
+            )
+
+        current_similarity = mapping["similarity"]
+        current_vector_size = mapping["dims"]
+        current_quantization = get_mapping_quantization(mapping)
+
+        if current_similarity != similarity:
+            raise ValueError(
+                f"Collection '{self.index_name}' already exists in Elasticsearch, "
+                f"but it is configured with a similarity '{current_similarity}'. "
+                f"If you want to use that collection, but with a different "
+                f"similarity, please reindex it first (POST /reindex on a server started with the current settings) "
+                f"or set `recreate_index=True` argument."
+            )
+
+        if current_vector_size != vector_size:
+            raise ValueError(
+                f"Collection '{self.index_name}' already exists in Elasticsearch, "
+                f"but it is configured with a vector size '{current_vector_size}'. "
+                f"If you want to use that collection, but with a different "
+                f"vector size, please set `recreate_index=True` argument."
+            )
+
+        if current_quantization != self.quantization:
+            raise ValueError(
+                f"Collection '{self.index_name}' already exists in Elasticsearch, "
+                f"but it is configured with quantization '{current_quantization}'. "
+                f"If you want to use that collection, but with a different "
+                f"quantization, please reindex it first (POST /reindex on a server started with the current settings, "
+                f"between 'none' and 'int8_hnsw') "
+                f"or set `recreate_index=True` argument."
+            )
+
+    async def _recreate_index(
+        self, similarity: str, vector_size: int, replicas: int, shards: int
+    ) -> None:
+        """
+        Deletes the indices behind index_name and points index_name at a new, empty versioned index.
+        """
+        old_indices = await self._get_backing_indices()
+        is_alias = await self.client.indices.exists_alias(name=self.index_name)
+
+        new_index = await self._next_index_name()
+        await self._create_index(
+            new_index, similarity, vector_size, replicas, shards, self.quantization
+        )
+
+        actions: List[Dict[str, Any]] = [
+            {"add": {"index": new_index, "alias": self.index_name}}
+        ]
+        actions += [
+            {"remove_index": {"index": index}}
+            for index in old_indices
+            if is_alias or index == self.index_name
+        ]
+        await self.client.indices.update_aliases(actions=actions)
+        self._filter_fields = {}
+        logger.info(f"Index {self.index_name} now points at empty index {new_index}")
+
+    async def reindex(
+        self,
+        similarity: Optional[str] = None,
+        replicas: Optional[int] = None,
+        shards: Optional[int] = None,
+        vector_size: Optional[int] = None,
+        quantization: Optional[str] = None,
+        delete_old_index: bool = True,
+    ) -> str:
+        """
+        Builds a new versioned index with the given settings (the current ones by default), copies every chunk into it
+        with the server-side reindex API (without re-embedding) and atomically points the index_name alias at it.
+        Queries and writes keep working against the old index while the copy runs. Once it is done, writes are paused
+        while the new index catches up: the deletes run during the copy are run again on it, the chunks written since
+        the copy started (by updated_at) are copied again, and the alias is swapped before writes resume.
+        Writes are only paused in this process, so the writes of other server processes between the catch-up and
+        the swap, and their deletes during the copy, may be missed.
+
+        Args:
+            similarity: Similarity of the new index.
+            replicas: Number of replicas of the new index.
+            shards: Number of shards of the new index.
+            vector_size: Size of the embeddings. Stored vectors are copied as they are, so it must match the current one.
+            quantization: Quantization of the new index. Float vectors can switch between "none" and "int8_hnsw",
+                but cannot be converted to or from "byte" vectors without re-embedding.
+            delete_old_index: Whether to delete the old index after the swap.
+
+        Returns:
+            The name of the new index.
+        """
+        if similarity is not None and similarity not in SIMILARITIES:
+            raise ValueError(
+                f"Similarity must be one of {', '.join(SIMILARITIES)}, not '{similarity}'."
+            )
+        if quantization is not None and quantization not in QUANTIZATIONS:
+            raise ValueError(
+                f"Quantization must be one of {', '.join(QUANTIZATIONS)}, not '{quantization}'."
+            )
+        mapping = await self._get_embedding_mapping()
+        if (
+            similarity == "l2_norm"
+            and (quantization or get_mapping_quantization(mapping)) == "byte"
+        ):
+            raise ValueError(
+                "Byte quantization requires 'cosine' or 'dot_product' similarity."
+            )
+        if vector_size is not None and vector_size != mapping["dims"]:
+            raise ValueError(
+                f"Collection '{self.index_name}' stores vectors of size '{mapping['dims']}', "
+                f"they cannot be copied into an index with vector size '{vector_size}'. "
+                f"Please re-embed the documents into a new index instead."
+            )
+        current_quantization = get_mapping_quantization(mapping)
+        quantization = quantization or current_quantization
+        if (quantization == "byte") != (current_quantization == "byte"):
+            raise ValueError(
+                f"Collection '{self.index_name}' uses quantization '{current_quantization}', "
+                f"its vectors cannot be copied into an index with quantization '{quantization}'. "
+                f"Please re-embed the documents into a new index instead."
+            )
 
+        old_indices = await self._get_backing_indices()
+        is_alias = await self.client.indices.exists_alias(name=self.index_name)
+        new_index = await self._next_index_name()
+        replicas = replicas or self.replicas
+        await self._create_index(
+            new_index,
+            similarity or mapping["similarity"],
+            mapping["dims"],
+            # no replicas and no refreshes while the index is loaded
+            0,
+            shards or self.shards,
+            quantization,
+            refresh_interval="-1",
+        )
+
+        logger.info(f"Copying {self.index_name} into {new_index}")
+        copy_started = int(time.time()) - ELASTICSEARCH_REINDEX_CLOCK_SKEW
+        self._reindex_deletes = []
         try:
-            index_mapping = self.client.indices.get_mapping(index=self.index_name)
-            current_similarity = index_mapping[self.index_name]["mappings"]["properties"]["embedding"]["similarity"]  # type: ignore
-            current_vector_size = index_mapping[self.index_name]["mappings"]["properties"]["embedding"]["dims"]  # type: ignore
-
-            if current_similarity != similarity:
-                raise ValueError(
-                    f"Collection '{self.index_name}' already exists in Elasticsearch, "
-                    f"but it is configured with a similarity '{current_similarity}'. "
-                    f"If you want to use that collection, but with a different "
-                    f"similarity, please set `recreate_index=True` argument."
+            await self._copy_index(self.index_name, new_index)
+            await self.client.indices.put_settings(
+                index=new_index,
+                settings={
+                    "index": {"number_of_replicas": replicas, "refresh_interval": "1s"}
+                },
+            )
+
+            async with self._pause_writes():
+                # catch up with the writes to the old index during the copy, deletes first so that
+                # the chunks written again after a delete are copied back
+                await self.client.indices.refresh(
+                    index=f"{self.index_name},{new_index}"
+                )
+                for query in self._reindex_deletes:
+                    await self.client.delete_by_query(
+                        index=new_index, query=query, conflicts="proceed", refresh=True
+                    )
+                await self._copy_index(
+                    self.index_name,
+                    new_index,
+                    query={"range": {"updated_at": {"gte": copy_started}}},
                 )
 
-            if current_vector_size != vector_size:
-                raise ValueError(
-                    f"Collection '{self.index_name}' already exists in Elasticsearch, "
-                    f"but it is configured with a vector size '{current_vector_size}'. "
-                    f"If you want to use that collection, but with a different "
-                    f"vector size, please set `recreate_index=True` argument."
+                if is_alias:
+                    remove_actions = [
+                        {"remove": {"index": index, "alias": self.index_name}}
+                        for index in old_indices
+                    ]
+                else:
+                    # A concrete index cannot be swapped for an alias with the same name without deleting it
+                    remove_actions = [{"remove_index": {"index": self.index_name}}]
+                await self.client.indices.update_aliases(
+                    actions=[
+                        {"add": {"index": new_index, "alias": self.index_name}},
+                        *remove_actions,
+                    ]
                 )
+        finally:
+            self._reindex_deletes = None
+
+        if is_alias and delete_old_index:
+            await self.client.indices.delete(index=",".join(old_indices))
+
+        self.similarity = similarity or mapping["similarity"]
+        self.replicas = replicas
+        self.shards = shards or self.shards
+        self.quantization = quantization
+        self._filter_fields = {}
+        self.query_cache.invalidate()
+        logger.info(f"Index {self.index_name} now points at {new_index}")
+        return new_index
+
+    async def _copy_index(
+        self, source: str, dest: str, query: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """
+        Copies the documents of source (those matching query, if given) into dest with the reindex API,
+        replacing the documents with the same id, and waits for the task to finish.
+        """
+        source_options: Dict[str, Any] = {"index": source}
+        if query is not None:
+            source_options["query"] = query
+        response = await self.client.reindex(
+            source=source_options,
+            dest={"index": dest},
+            slices="auto",
+            wait_for_completion=False,
+        )
+        task_id = response["task"]
+        while True:
+            task = await self.client.tasks.get(task_id=task_id)
+            if task["completed"]:
+                break
+            status = task["task"]["status"]
+            logger.info(
+                f"Reindexing {source} into {dest}: "
+                f"{status.get('created', 0)}/{status.get('total', 0)}"
+            )
+            await asyncio.sleep(ELASTICSEARCH_REINDEX_POLL_INTERVAL)
+
+        if "error" in task:
+            raise RuntimeError(
+                f"Reindexing {source} into {dest} failed: {task['error']}"
+            )
+        failures = task.get("response", {}).get("failures", [])
+        if failures:
+            raise RuntimeError(f"Reindexing {source} into {dest} failed: {failures}")
+
+    async def _get_embedding_mapping(self) -> Dict[str, Any]:
+        return (await self._get_mapping_properties())["embedding"]
+
+    async def _get_mapping_properties(self) -> Dict[str, Any]:
+        index_mapping = await self.client.indices.get_mapping(index=self.index_name)
+        # The response is keyed by the concrete index, which differs from index_name when it is an alias
+        mappings = next(iter(index_mapping.values()))["mappings"]
+        return mappings["properties"]
+
+    async def _get_backing_indices(self) -> List[str]:
+        try:
+            return list((await self.client.indices.get(index=self.index_name)).keys())
         except elasticsearch.exceptions.NotFoundError:
-            self._recreate_index(similarity, vector_size, replicas, shards)
+            return []
 
-    def _recreate_index(
-        self, similarity: str, vector_size: int, replicas: int, shards: int
+    async def _next_index_name(self) -> str:
+        try:
+            indices = await self.client.indices.get(index=f"{self.index_name}_v*")
+        except elasticsearch.exceptions.NotFoundError:
+            indices = {}
+        prefix = f"{self.index_name}_v"
+        versions = [
+            int(index[len(prefix) :])
+            for index in indices.keys()
+            if index[len(prefix) :].isdigit()
+        ]
+        return f"{prefix}{max(versions, default=0) + 1}"
+
+    async def _create_index(
+        self,
+        index: str,
+        similarity: str,
+        vector_size: int,
+        replicas: int,
+        shards: int,
+        quantization: str,
+        refresh_interval: str = "1s",
     ) -> None:
         settings = {
             "index": {
                 "number_of_shards": shards,
                 "number_of_replicas": replicas,
-                "refresh_interval": "1s",
+                "refresh_interval": refresh_interval,
             }
         }
+        embedding_mapping: Dict[str, Any] = {
+            "type": "dense_vector",
+            "dims": vector_size,
+            "index": True,
+            "similarity": similarity,
+        }
+        if quantization == "byte":
+            embedding_mapping["element_type"] = "byte"
+        elif quantization == "int8_hnsw":
+            embedding_mapping["index_options"] = {"type": "int8_hnsw"}
         mappings = {
             "properties": {
-                "embedding": {
-                    "type": "dense_vector",
-                    "dims": vector_size,
-                    "index": True,
-                    "similarity": similarity,
-                }
+                "embedding": embedding_mapping,
+                "updated_at": {"type": "long"},
+                "metadata": {
+                    "properties": {
+                        field: {"type": "keyword"} for field in KEYWORD_FIELDS
+                    }
+                },
             }
         }
 
-        self.client.indices.delete(
-            index=self.index_name, ignore_unavailable=True, allow_no_indices=True
-        )
-        self.client.indices.create(
-            index=self.index_name, mappings=mappings, settings=settings
+        await self.client.indices.create(
+            index=index, mappings=mappings, settings=settings
         )
 
 
+def get_mapping_quantization(mapping: Dict[str, Any]) -> str:
+    """Returns the quantization of an embedding field mapping, see QUANTIZATIONS."""
+    if mapping.get("element_type") == "byte":
+        return "byte"
+    if mapping.get("index_options", {}).get("type") == "int8_hnsw":
+        return "int8_hnsw"
+    return "none"
+
+
+def get_filter_fields(properties: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Returns the field to query for each filter field of an index mapping that is not mapped as keyword.
+    Indices created before the metadata fields were mapped explicitly have dynamic text mappings,
+    which split ids on "-" and lowercase them, so those are queried on their keyword subfield.
+    """
+    metadata = properties.get("metadata", {}).get("properties", {})
+    fields = {}
+    for field in FILTER_FIELDS:
+        mapping = metadata.get(field, {})
+        if mapping.get("type") == "text" and "keyword" in mapping.get("fields", {}):
+            fields[field] = f"metadata.{field}.keyword"
+    return fields
+
+
 def connect_to_elasticsearch(
-    elasticsearch_url=None, cloud_id=None, api_key=None, username=None, password=None
-):
+    elasticsearch_url=None,
+    cloud_id=None,
+    api_key=None,
+    username=None,
+    password=None,
+    connections_per_node=ELASTICSEARCH_CONNECTIONS_PER_NODE,
+    request_timeout=ELASTICSEARCH_REQUEST_TIMEOUT,
+    max_retries=ELASTICSEARCH_MAX_RETRIES,
+) -> AsyncElasticsearch:
     # Check if both elasticsearch_url and cloud_id are defined
     if elasticsearch_url and cloud_id:
         raise ValueError(
@@ -320,7 +971,13 @@ def connect_to_elasticsearch(
         )
 
     # Initialize connection parameters dictionary
-    connection_params = {}
+    # Connections are pooled per node and kept alive between requests
+    connection_params = {
+        "connections_per_node": connections_per_node,
+        "request_timeout": request_timeout,
+        "max_retries": max_retries,
+        "retry_on_timeout": True,
+    }
 
     # Define the connection based on the provided parameters
     if elasticsearch_url:
@@ -340,12 +997,5 @@ def connect_to_elasticsearch(
             "No authentication details provided. Please consider using an api_key or username and password to secure your connection."
         )
 
-    # Establish the Elasticsearch client connection
-    es_client = Elasticsearch(**connection_params)
-    try:
-        es_client.info()
-    except Exception as e:
-        logger.error(f"Error connecting to Elasticsearch: {e}")
-        raise e
-
-    return es_client
+    # Create the Elasticsearch client, the connection is checked in ElasticsearchDataStore.setup()
+    return AsyncElasticsearch(**connection_params)
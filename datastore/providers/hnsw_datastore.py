@@ -0,0 +1,251 @@
+import asyncio
+import json
+import os
+from typing import List, Optional, Tuple
+
+import hnswlib
+import numpy as np
+from loguru import logger
+
+from datastore.providers.local_datastore import (
+    LOCAL_DATASTORE_BLOCK_ROWS,
+    LOCAL_DATASTORE_DTYPE,
+    VECTOR_SIZE,
+    LocalDataStore,
+)
+
+# HNSW 데이터스토어 설정
+HNSW_DATASTORE_PATH = os.environ.get(
+    "HNSW_DATASTORE_PATH", ".hnsw_datastore"
+)  # Directory holding the embedding matrix, the chunk metadata and the graph
+HNSW_M = int(
+    os.environ.get("HNSW_M", 16)
+)  # Links per node: higher improves recall and costs memory and insert time
+HNSW_EF_CONSTRUCTION = int(
+    os.environ.get("HNSW_EF_CONSTRUCTION", 200)
+)  # Candidate list size while inserting, higher builds a better graph more slowly
+HNSW_EF_SEARCH = int(
+    os.environ.get("HNSW_EF_SEARCH", 64)
+)  # Candidate list size while searching (at least top_k), trades latency for recall
+HNSW_EXACT_FILTER_ROWS = int(
+    os.environ.get("HNSW_EXACT_FILTER_ROWS", 10000)
+)  # Filters matching at most this many rows are searched exactly instead of through the graph
+HNSW_SAVE_ROWS = int(
+    os.environ.get("HNSW_SAVE_ROWS", 10000)
+)  # The graph is saved after this many inserted or deleted rows, and on shutdown
+
+
+class HnswDataStore(LocalDataStore):
+    """
+    LocalDataStore와 같은 파일에 청크를 저장하고, 전체 스캔 대신 HNSW 그래프 (hnswlib) 로 근사 최근접 이웃을 찾는 데이터스토어.
+    행은 그래프에 바로 추가되고, 삭제된 행은 그래프에 삭제 표시 (tombstone) 만 한다.
+    LocalDataStore가 삭제된 행을 압축할 때 그래프를 다시 만든다.
+
+    필터가 있는 쿼리는 필터와 일치하는 행만 그래프 탐색 대상으로 삼는다.
+    일치하는 행이 HNSW_EXACT_FILTER_ROWS 개 이하이면 그 행들만 정확하게 검색하는 것이 더 빠르고 정확하다.
+
+    파일 (LocalDataStore의 파일에 추가):
+        hnsw.bin: 그래프, HNSW_SAVE_ROWS 행이 바뀔 때마다와 종료할 때 저장한다
+        hnsw.json: 그래프에 들어 있는 행 수와 그 행들의 메타데이터 파일.
+            시작할 때 그 뒤에 추가된 행만 그래프에 넣는다
+    """
+
+    def __init__(
+        self,
+        dimension: int = VECTOR_SIZE,
+        path: str = HNSW_DATASTORE_PATH,
+        dtype: str = LOCAL_DATASTORE_DTYPE,
+        m: int = HNSW_M,
+        ef_construction: int = HNSW_EF_CONSTRUCTION,
+        ef_search: int = HNSW_EF_SEARCH,
+    ):
+        super().__init__(dimension=dimension, path=path, dtype=dtype)
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+
+        self._index: Optional[hnswlib.Index] = None
+        self._indexed = 0  # 그래프에 들어 있는 행 수, 행 번호가 그래프의 레이블
+        self._unsaved_rows = 0
+
+    async def close(self) -> None:
+        async with self._lock:
+            if self._embeddings_file is not None:
+                self._unsaved_rows = HNSW_SAVE_ROWS
+                await asyncio.to_thread(self._save_state)
+
+    def _search(
+        self,
+        embeddings: np.ndarray,
+        masks: List[Optional[np.ndarray]],
+        top_ks: List[int],
+        n: int,
+    ) -> List[List[Tuple[int, float]]]:
+        assert self._index is not None
+        alive = self._alive[:n]
+        live = int(alive.sum())
+        results: List[List[Tuple[int, float]]] = [[] for _ in top_ks]
+
+        # 필터가 없는 쿼리는 한 번에 그래프를 탐색한다
+        unfiltered = [
+            i
+            for i, (mask, top_k) in enumerate(zip(masks, top_ks))
+            if mask is None and top_k
+        ]
+        if unfiltered and live:
+            k = min(max(top_ks[i] for i in unfiltered), live)
+            for i, matches in zip(
+                unfiltered, self._knn_query(embeddings[unfiltered], k, alive, None, n)
+            ):
+                results[i] = matches[: top_ks[i]]
+
+        for i, (mask, top_k) in enumerate(zip(masks, top_ks)):
+            if mask is None or not top_k:
+                continue
+            allowed = mask & alive
+            matching = int(allowed.sum())
+            if matching == 0:
+                continue
+            if matching <= HNSW_EXACT_FILTER_ROWS:
+                results[i] = self._search_rows(
+                    embeddings[i], np.flatnonzero(allowed), top_k
+                )
+            else:
+                results[i] = self._knn_query(
+                    embeddings[i : i + 1], min(top_k, matching), allowed, allowed, n
+                )[0]
+        return results
+
+    def _knn_query(
+        self,
+        embeddings: np.ndarray,
+        k: int,
+        alive: np.ndarray,
+        allowed: Optional[np.ndarray],
+        n: int,
+    ) -> List[List[Tuple[int, float]]]:
+        assert self._index is not None
+        self._index.set_ef(max(self.ef_search, k))
+        try:
+            labels, distances = self._index.knn_query(
+                embeddings,
+                k=k,
+                filter=(
+                    (lambda row: bool(allowed[row])) if allowed is not None else None
+                ),
+            )
+        except RuntimeError as e:
+            # 삭제 표시가 많거나 ef가 작아 그래프에서 k개를 찾지 못한 경우
+            logger.warning(
+                f"HNSW search returned fewer than {k} rows, searching exactly: {e}"
+            )
+            return super()._search(
+                embeddings,
+                [allowed] * len(embeddings),
+                [k] * len(embeddings),
+                n,
+            )
+        # 내적 공간의 거리는 1 - 내적 (정규화한 벡터의 코사인 유사도)
+        return [
+            [
+                (int(row), 1.0 - float(distance))
+                for row, distance in zip(rows, row_distances)
+            ]
+            for rows, row_distances in zip(labels, distances)
+        ]
+
+    def _search_rows(
+        self, embedding: np.ndarray, rows: np.ndarray, k: int
+    ) -> List[Tuple[int, float]]:
+        """주어진 행만 정확하게 검색한다"""
+        scores = self._embeddings[rows].astype(np.float32, copy=False) @ embedding
+        if len(rows) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            rows, scores = rows[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return [(int(rows[j]), float(scores[j])) for j in order]
+
+    def _load(self) -> None:
+        super()._load()
+        # 그래프를 저장한 뒤에 삭제된 행에 삭제 표시를 한다
+        assert self._index is not None
+        for row in np.flatnonzero(~self._alive[: self.count]):
+            try:
+                self._index.mark_deleted(int(row))
+            except RuntimeError:
+                pass  # 이미 삭제 표시된 행
+
+    def _save_state(self) -> None:
+        super()._save_state()
+        if self._index is not None and self._unsaved_rows >= HNSW_SAVE_ROWS:
+            self._save_index()
+
+    def _save_index(self) -> None:
+        assert self._index is not None
+        index_path = os.path.join(self.path, "hnsw.bin")
+        self._index.save_index(index_path + ".tmp")
+        os.replace(index_path + ".tmp", index_path)
+        meta_path = os.path.join(self.path, "hnsw.json")
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump({"metadata_file": self._metadata_file, "count": self._indexed}, f)
+        os.replace(meta_path + ".tmp", meta_path)
+        self._unsaved_rows = 0
+
+    def _open_index(self) -> None:
+        """저장된 그래프가 현재 메타데이터 파일의 행과 맞으면 불러오고, 아니면 빈 그래프를 만든다"""
+        index_path = os.path.join(self.path, "hnsw.bin")
+        meta_path = os.path.join(self.path, "hnsw.json")
+        if os.path.exists(index_path) and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if (
+                meta["metadata_file"] == self._metadata_file
+                and meta["count"] <= self.capacity
+            ):
+                self._index = hnswlib.Index(space="ip", dim=self.dimension)
+                self._index.load_index(index_path, max_elements=self.capacity)
+                self._indexed = meta["count"]
+                logger.info(
+                    f"Loaded HNSW graph of {self._indexed} rows from {self.path}"
+                )
+                return
+            logger.info(f"HNSW graph in {self.path} is out of date, rebuilding it")
+        self._new_index()
+
+    def _new_index(self) -> None:
+        self._index = hnswlib.Index(space="ip", dim=self.dimension)
+        self._index.init_index(
+            max_elements=max(self.capacity, 1),
+            M=self.m,
+            ef_construction=self.ef_construction,
+        )
+        self._indexed = 0
+
+    def _on_rows_added(self, start: int, end: int) -> None:
+        if self._index is None:
+            self._open_index()
+        assert self._index is not None
+        if end > self._index.get_max_elements():
+            self._index.resize_index(max(self.capacity, end))
+        # 저장된 그래프에 이미 들어 있는 행은 건너뛴다
+        for block_start in range(
+            max(start, self._indexed), end, LOCAL_DATASTORE_BLOCK_ROWS
+        ):
+            block_end = min(block_start + LOCAL_DATASTORE_BLOCK_ROWS, end)
+            self._index.add_items(
+                self._embeddings[block_start:block_end].astype(np.float32, copy=False),
+                np.arange(block_start, block_end),
+            )
+            self._unsaved_rows += block_end - block_start
+        self._indexed = max(self._indexed, end)
+
+    def _on_rows_deleted(self, rows: np.ndarray) -> None:
+        assert self._index is not None
+        for row in rows:
+            self._index.mark_deleted(int(row))
+        self._unsaved_rows += len(rows)
+
+    def _on_reset(self) -> None:
+        # 압축하거나 모두 삭제하면 남은 행으로 그래프를 새로 만들고 저장한다
+        self._new_index()
+        self._unsaved_rows = HNSW_SAVE_ROWS
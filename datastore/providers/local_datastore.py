@@ -0,0 +1,611 @@
+import asyncio
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from datastore.datastore import DataStore
+from models.models import (
+    DocumentChunk,
+    DocumentChunkMetadata,
+    DocumentChunkWithScore,
+    DocumentMetadataFilter,
+    QueryResult,
+    QueryWithEmbedding,
+    Source,
+)
+from services.date import to_unix_timestamp
+
+# 로컬 데이터스토어 설정
+LOCAL_DATASTORE_PATH = os.environ.get(
+    "LOCAL_DATASTORE_PATH", ".local_datastore"
+)  # Directory holding the embedding matrix and the chunk metadata
+LOCAL_DATASTORE_DTYPE = os.environ.get(
+    "LOCAL_DATASTORE_DTYPE", "float32"
+)  # How embeddings are stored: "float32" or "float16" (half the memory and disk, scored in float32)
+LOCAL_DATASTORE_BLOCK_ROWS = int(
+    os.environ.get("LOCAL_DATASTORE_BLOCK_ROWS", 65536)
+)  # The number of rows scored at a time, bounds the memory of a query batch
+LOCAL_DATASTORE_COMPACT_RATIO = float(
+    os.environ.get("LOCAL_DATASTORE_COMPACT_RATIO", 0.25)
+)  # Deleted rows are dropped from the files once they are this fraction of all rows
+
+DTYPES = ["float32", "float16"]
+# 필터에 쓰이는 문자열 메타데이터 필드, 정수 코드 배열로 저장한다
+CATEGORICAL_FIELDS = ["document_id", "source", "source_id", "author"]
+SOURCE_VALUES = {source.value for source in Source}
+MIN_CAPACITY = 1024
+
+# Gemini models/embedding-001, get_datastore() passes the probed dimension
+VECTOR_SIZE = 768
+
+
+class LocalDataStore(DataStore):
+    """
+    서버 프로세스 안에서 동작하는 데이터스토어. 작은 테넌트나 네트워크 없는 벤치마크용.
+    임베딩은 메모리 맵 파일에 연속된 float32/float16 행렬로 저장하고 (코사인 유사도를 위해 정규화),
+    메타데이터는 컬럼별 배열로 저장한다. 쿼리는 블록 단위 행렬 곱과 argpartition으로 top-k를 구한다.
+
+    파일:
+        embeddings-<n>.bin: (capacity, dimension) 행렬, 용량이 부족하거나 압축할 때 새 파일로 바꾼다
+        metadata-<n>.jsonl: 행 순서대로 청크 하나당 한 줄, upsert할 때 뒤에 추가만 한다
+        alive-<n>.npy: 삭제되지 않은 행, 상태를 저장할 때마다 새 파일에 쓴다
+        state.json: 행 수, 용량, 현재 파일 이름. 쓰기가 끝날 때마다 원자적으로 교체한다
+    """
+
+    # 같은 청크 ID로 upsert하면 이전 행을 대체한다
+    overwrites_by_id = True
+
+    def __init__(
+        self,
+        dimension: int = VECTOR_SIZE,
+        path: str = LOCAL_DATASTORE_PATH,
+        dtype: str = LOCAL_DATASTORE_DTYPE,
+    ):
+        assert dtype in DTYPES, "Dtype must be one of 'float32' / 'float16'."
+        self.dimension = dimension
+        self.path = path
+        self.dtype = np.dtype(dtype)
+
+        self.count = 0
+        self.capacity = 0
+        self._file_index = 0
+        self._embeddings_file: Optional[str] = None
+        self._metadata_file: Optional[str] = None
+        self._alive_file: Optional[str] = None
+        self._stale_files: List[Optional[str]] = []
+        self._embeddings = np.zeros((0, dimension), dtype=self.dtype)
+        self._alive = np.zeros(0, dtype=bool)
+        self._created_at = np.zeros(0, dtype=np.float64)
+        self._codes: Dict[str, np.ndarray] = {
+            field: np.zeros(0, dtype=np.int32) for field in CATEGORICAL_FIELDS
+        }
+        # 코드 <-> 값 사전, 코드 -1은 값이 없음을 뜻한다
+        self._vocab: Dict[str, Dict[str, int]] = {
+            field: {} for field in CATEGORICAL_FIELDS
+        }
+        self._values: Dict[str, List[str]] = {field: [] for field in CATEGORICAL_FIELDS}
+        self._chunk_ids: List[str] = []
+        self._texts: List[str] = []
+        # 필터에 쓰이지 않는 나머지 메타데이터 필드 (url, chunk_hash 등)
+        self._other_metadata: List[Dict[str, Any]] = []
+        self._created_at_text: List[Optional[str]] = []
+        self._rows: Dict[str, int] = {}  # 청크 ID -> 살아 있는 행
+
+        # 압축은 행 번호를 바꾸므로 쓰기와 쿼리를 하나씩 실행한다.
+        # 쿼리는 요청 안의 모든 쿼리를 한 번의 스캔으로 처리하고, 행렬 곱은 BLAS 스레드를 모두 사용한다.
+        self._lock = asyncio.Lock()
+
+    async def setup(self) -> None:
+        await asyncio.to_thread(self._load)
+
+    async def close(self) -> None:
+        async with self._lock:
+            if self._embeddings_file is not None:
+                await asyncio.to_thread(self._save_state)
+
+    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+        """
+        document ID에서 document 청크의 목록으로 딕셔너리를 받아 행렬 끝에 추가
+        document ID 목록을 반환
+        """
+        doc_chunks = [chunk for chunk_list in chunks.values() for chunk in chunk_list]
+        async with self._lock:
+            await asyncio.to_thread(self._append, doc_chunks)
+        return list(chunks.keys())
+
+    async def _query(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
+        """
+        임베딩 및 필터가 포함된 쿼리 목록을 받아 일치하는 문서 청크 및 점수가 포함된 쿼리 결과 목록을 반환
+        모든 쿼리를 한 번의 행렬 스캔으로 처리한다.
+        """
+        async with self._lock:
+            return await asyncio.to_thread(self._search_queries, queries)
+
+    async def _delete(
+        self,
+        ids: Optional[List[str]] = None,
+        filter: Optional[DocumentMetadataFilter] = None,
+        delete_all: Optional[bool] = None,
+    ) -> bool:
+        """
+        Removes vectors by ids, filter, or everything from the datastore.
+        """
+        async with self._lock:
+            await asyncio.to_thread(self._delete_rows, ids, filter, delete_all)
+        return True
+
+    async def _get_chunk_hashes(
+        self, document_ids: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        async with self._lock:
+            return await asyncio.to_thread(self._stored_chunk_hashes, document_ids)
+
+    async def _delete_stale_chunks(self, chunk_ids: Dict[str, List[str]]) -> None:
+        async with self._lock:
+            await asyncio.to_thread(self._delete_stale_rows, chunk_ids)
+
+    def _search_queries(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
+        n = self.count
+        matches = self._search(
+            self._normalize(np.asarray([query.embedding for query in queries])),
+            [self._get_filter_mask(query.filter, n) for query in queries],
+            [query.top_k or 0 for query in queries],
+            n,
+        )
+        return [
+            QueryResult(
+                query=query.query,
+                results=[
+                    self._convert_row_to_document_chunk_with_score(row, score)
+                    for row, score in query_matches
+                ],
+            )
+            for query, query_matches in zip(queries, matches)
+        ]
+
+    def _search(
+        self,
+        embeddings: np.ndarray,
+        masks: List[Optional[np.ndarray]],
+        top_ks: List[int],
+        n: int,
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        정확한 검색: 첫 n개 행을 LOCAL_DATASTORE_BLOCK_ROWS 행씩 점수를 매기고, 블록마다 구한 top-k를 합친다.
+        쿼리마다 점수 내림차순 (행, 점수) 목록을 반환한다.
+        """
+        k_max = max(top_ks, default=0)
+        if n == 0 or k_max == 0:
+            return [[] for _ in top_ks]
+
+        best_rows = np.zeros((len(top_ks), 0), dtype=np.int64)
+        best_scores = np.zeros((len(top_ks), 0), dtype=np.float32)
+        for start in range(0, n, LOCAL_DATASTORE_BLOCK_ROWS):
+            end = min(start + LOCAL_DATASTORE_BLOCK_ROWS, n)
+            block = self._embeddings[start:end]
+            if block.dtype != np.float32:
+                block = block.astype(np.float32)
+            scores = embeddings @ block.T
+
+            scores[:, ~self._alive[start:end]] = -np.inf
+            for i, mask in enumerate(masks):
+                if mask is not None:
+                    scores[i, ~mask[start:end]] = -np.inf
+
+            rows = np.broadcast_to(np.arange(start, end, dtype=np.int64), scores.shape)
+            best_rows, best_scores = self._top_k(
+                np.concatenate([best_rows, rows], axis=1),
+                np.concatenate([best_scores, scores], axis=1),
+                k_max,
+            )
+
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        return [
+            [
+                (int(row), float(score))
+                for row, score in zip(best_rows[i, :top_k], best_scores[i, :top_k])
+                if score > -np.inf
+            ]
+            for i, top_k in enumerate(top_ks)
+        ]
+
+    def _top_k(
+        self, rows: np.ndarray, scores: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # argpartition은 정렬 없이 가장 높은 점수 k개를 고른다
+        if scores.shape[1] <= k:
+            return rows, scores
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        return np.take_along_axis(rows, top, axis=1), np.take_along_axis(
+            scores, top, axis=1
+        )
+
+    def _get_filter_mask(
+        self, filter: Optional[DocumentMetadataFilter], n: int
+    ) -> Optional[np.ndarray]:
+        """
+        필터와 일치하는 첫 n개 행의 마스크를 반환한다. 필터가 비어 있으면 None을 반환한다.
+        """
+        if filter is None:
+            return None
+
+        mask: Optional[np.ndarray] = None
+        for field, value in filter.dict().items():
+            if value is None:
+                continue
+            if field == "start_date":
+                # 생성 날짜가 없는 행 (NaN) 은 날짜 조건과 일치하지 않는다
+                field_mask = self._created_at[:n] >= to_unix_timestamp(value)
+            elif field == "end_date":
+                field_mask = self._created_at[:n] <= to_unix_timestamp(value)
+            else:
+                code = self._vocab[field].get(value)
+                if code is None:
+                    field_mask = np.zeros(n, dtype=bool)
+                else:
+                    field_mask = self._codes[field][:n] == code
+            mask = field_mask if mask is None else mask & field_mask
+        return mask
+
+    def _convert_row_to_document_chunk_with_score(
+        self, row: int, score: float
+    ) -> DocumentChunkWithScore:
+        metadata = {
+            field: self._values[field][code] if code >= 0 else None
+            for field, code in (
+                (field, int(self._codes[field][row])) for field in CATEGORICAL_FIELDS
+            )
+        }
+        # If the source is not a valid Source in the Source enum, set it to None
+        if metadata["source"] not in SOURCE_VALUES:
+            metadata["source"] = None
+
+        return DocumentChunkWithScore(
+            id=self._chunk_ids[row],
+            score=score,
+            text=self._texts[row],
+            metadata=DocumentChunkMetadata(
+                created_at=self._created_at_text[row],
+                **self._other_metadata[row],
+                **metadata,
+            ),
+        )
+
+    def _append(self, chunks: List[DocumentChunk]) -> None:
+        if not chunks:
+            return
+        vectors = self._normalize(
+            np.asarray([chunk.embedding for chunk in chunks], dtype=np.float32)
+        )
+        if vectors.shape[1] != self.dimension:
+            raise ValueError(
+                f"Embeddings have dimension {vectors.shape[1]}, "
+                f"but the datastore stores vectors of dimension {self.dimension}."
+            )
+
+        start = self.count
+        end = start + len(chunks)
+        if end > self.capacity:
+            self._resize(max(end, 2 * self.capacity, MIN_CAPACITY))
+
+        # 같은 청크 ID로 저장된 이전 행은 삭제한다
+        replaced = [self._rows[chunk.id] for chunk in chunks if chunk.id in self._rows]
+        if replaced:
+            self._alive[replaced] = False
+            self._on_rows_deleted(np.asarray(replaced, dtype=np.int64))
+
+        self._embeddings[start:end] = vectors
+        self._alive[start:end] = True
+        with open(os.path.join(self.path, self._metadata_file), "a") as f:
+            for row, chunk in enumerate(chunks, start):
+                metadata = chunk.metadata.dict()
+                self._set_row(row, chunk.id, chunk.text, metadata)
+                f.write(
+                    json.dumps(
+                        {"id": chunk.id, "text": chunk.text, "metadata": metadata}
+                    )
+                    + "\n"
+                )
+        self.count = end
+        self._on_rows_added(start, end)
+        # 대체된 행도 삭제된 행이므로 압축 대상이다
+        self._compact_or_save_state()
+
+    def _set_row(
+        self, row: int, chunk_id: str, text: str, metadata: Dict[str, Any]
+    ) -> None:
+        self._chunk_ids.append(chunk_id)
+        self._texts.append(text)
+        self._other_metadata.append(
+            {
+                field: value
+                for field, value in metadata.items()
+                if value is not None
+                and field not in CATEGORICAL_FIELDS
+                and field != "created_at"
+            }
+        )
+        created_at = metadata.get("created_at")
+        self._created_at_text.append(created_at)
+        self._created_at[row] = (
+            to_unix_timestamp(created_at) if created_at is not None else np.nan
+        )
+        for field in CATEGORICAL_FIELDS:
+            value = metadata.get(field)
+            if value is None:
+                self._codes[field][row] = -1
+                continue
+            code = self._vocab[field].get(value)
+            if code is None:
+                code = self._vocab[field][value] = len(self._values[field])
+                self._values[field].append(value)
+            self._codes[field][row] = code
+        self._rows[chunk_id] = row
+
+    def _delete_rows(
+        self,
+        ids: Optional[List[str]],
+        filter: Optional[DocumentMetadataFilter],
+        delete_all: Optional[bool],
+    ) -> None:
+        if delete_all:
+            logger.info(f"Deleting all vectors from {self.path}")
+            self._rewrite(np.zeros((0, self.dimension), dtype=np.float32), [])
+            return
+
+        n = self.count
+        deleted = np.zeros(n, dtype=bool)
+        mask = self._get_filter_mask(filter, n)
+        if mask is not None:
+            deleted |= mask
+        if ids:
+            codes = [
+                self._vocab["document_id"][id]
+                for id in ids
+                if id in self._vocab["document_id"]
+            ]
+            deleted |= np.isin(self._codes["document_id"][:n], codes)
+        self._remove_rows(np.flatnonzero(deleted & self._alive[:n]))
+
+    def _stored_chunk_hashes(
+        self, document_ids: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        n = self.count
+        codes = [
+            self._vocab["document_id"][id]
+            for id in document_ids
+            if id in self._vocab["document_id"]
+        ]
+        hashes: Dict[str, Dict[str, Optional[str]]] = {}
+        for row in np.flatnonzero(
+            np.isin(self._codes["document_id"][:n], codes) & self._alive[:n]
+        ):
+            document_id = self._values["document_id"][self._codes["document_id"][row]]
+            chunk_hash = self._other_metadata[row].get("chunk_hash")
+            hashes.setdefault(document_id, {})[self._chunk_ids[row]] = chunk_hash
+        return hashes
+
+    def _delete_stale_rows(self, chunk_ids: Dict[str, List[str]]) -> None:
+        n = self.count
+        codes = [
+            self._vocab["document_id"][id]
+            for id in chunk_ids
+            if id in self._vocab["document_id"]
+        ]
+        keep = {chunk_id for ids in chunk_ids.values() for chunk_id in ids}
+        rows = np.flatnonzero(
+            np.isin(self._codes["document_id"][:n], codes) & self._alive[:n]
+        )
+        self._remove_rows(
+            np.asarray(
+                [row for row in rows if self._chunk_ids[row] not in keep],
+                dtype=np.int64,
+            )
+        )
+
+    def _remove_rows(self, rows: np.ndarray) -> None:
+        """살아 있는 행을 삭제하고, 삭제된 행이 많아지면 압축한다"""
+        if len(rows) == 0:
+            return
+        self._alive[rows] = False
+        for row in rows:
+            self._rows.pop(self._chunk_ids[row], None)
+        self._on_rows_deleted(rows)
+        self._compact_or_save_state()
+
+    def _compact_or_save_state(self) -> None:
+        """삭제된 행이 LOCAL_DATASTORE_COMPACT_RATIO 이상이면 압축하고, 아니면 상태만 저장한다"""
+        n = self.count
+        if n and n - int(self._alive[:n].sum()) >= LOCAL_DATASTORE_COMPACT_RATIO * n:
+            # 삭제된 행을 빼고 파일을 다시 쓴다
+            keep = np.flatnonzero(self._alive[:n])
+            logger.info(f"Compacting {self.path}: keeping {len(keep)}/{n} rows")
+            self._rewrite(
+                np.asarray(self._embeddings[keep]),
+                [self._row_to_json(row) for row in keep],
+            )
+        else:
+            self._save_state()
+
+    def _rewrite(self, embeddings: np.ndarray, chunks: List[Dict[str, Any]]) -> None:
+        """
+        주어진 행만으로 새 임베딩 파일과 메타데이터 파일을 쓰고, state.json을 교체해 한 번에 바꾼다.
+        """
+        self.count = 0
+        self._chunk_ids, self._texts, self._created_at_text = [], [], []
+        self._other_metadata = []
+        self._rows = {}
+        self._vocab = {field: {} for field in CATEGORICAL_FIELDS}
+        self._values = {field: [] for field in CATEGORICAL_FIELDS}
+        self._on_reset()
+
+        self._resize(max(len(chunks), MIN_CAPACITY))
+        self._embeddings[: len(chunks)] = embeddings
+        self._alive[: len(chunks)] = True
+        self._stale_files.append(self._metadata_file)
+        self._metadata_file = self._new_file_name("metadata", "jsonl")
+        with open(os.path.join(self.path, self._metadata_file), "w") as f:
+            for row, chunk in enumerate(chunks):
+                self._set_row(row, chunk["id"], chunk["text"], chunk["metadata"])
+                f.write(json.dumps(chunk) + "\n")
+        self.count = len(chunks)
+        self._on_rows_added(0, self.count)
+        self._save_state()
+
+    def _row_to_json(self, row: int) -> Dict[str, Any]:
+        metadata: Dict[str, Any] = {
+            field: (
+                self._values[field][self._codes[field][row]]
+                if self._codes[field][row] >= 0
+                else None
+            )
+            for field in CATEGORICAL_FIELDS
+        }
+        metadata.update(self._other_metadata[row])
+        metadata["created_at"] = self._created_at_text[row]
+        return {
+            "id": self._chunk_ids[row],
+            "text": self._texts[row],
+            "metadata": metadata,
+        }
+
+    def _resize(self, capacity: int) -> None:
+        """
+        용량이 capacity인 새 임베딩 파일에 기존 행을 복사하고 컬럼 배열을 늘린다.
+        이전 파일은 state.json이 새 파일을 가리킨 뒤에 지운다.
+        """
+        if self._embeddings_file is not None:
+            self._stale_files.append(self._embeddings_file)
+        self._embeddings_file = self._new_file_name("embeddings", "bin")
+        embeddings = np.memmap(
+            os.path.join(self.path, self._embeddings_file),
+            dtype=self.dtype,
+            mode="w+",
+            shape=(capacity, self.dimension),
+        )
+        rows = min(self.count, capacity)
+        embeddings[:rows] = self._embeddings[:rows]
+        self._embeddings = embeddings
+
+        def resized(array: np.ndarray, fill: Any) -> np.ndarray:
+            result = np.full(capacity, fill, dtype=array.dtype)
+            result[:rows] = array[:rows]
+            return result
+
+        self._alive = resized(self._alive, False)
+        self._created_at = resized(self._created_at, np.nan)
+        self._codes = {
+            field: resized(codes, -1) for field, codes in self._codes.items()
+        }
+        self.capacity = capacity
+
+    def _new_file_name(self, prefix: str, extension: str) -> str:
+        self._file_index += 1
+        return f"{prefix}-{self._file_index}.{extension}"
+
+    def _save_state(self) -> None:
+        self._embeddings.flush()
+        # state.json이 가리키는 alive 파일은 덮어쓰지 않는다. 교체 전에 종료되어도 행 수와 맞는 이전 파일이 남는다
+        alive_file = self._new_file_name("alive", "npy")
+        with open(os.path.join(self.path, alive_file), "wb") as f:
+            np.save(f, self._alive[: self.count])
+        self._stale_files.append(self._alive_file)
+        self._alive_file = alive_file
+        state = {
+            "dimension": self.dimension,
+            "dtype": self.dtype.name,
+            "count": self.count,
+            "capacity": self.capacity,
+            "embeddings_file": self._embeddings_file,
+            "metadata_file": self._metadata_file,
+            "alive_file": self._alive_file,
+            "file_index": self._file_index,
+        }
+        state_path = os.path.join(self.path, "state.json")
+        with open(state_path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(state_path + ".tmp", state_path)
+
+        for file in self._stale_files:
+            if file is not None and os.path.exists(os.path.join(self.path, file)):
+                os.remove(os.path.join(self.path, file))
+        self._stale_files = []
+
+    def _load(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        state_path = os.path.join(self.path, "state.json")
+        if not os.path.exists(state_path):
+            logger.info(f"Creating local datastore in {self.path}")
+            self._rewrite(np.zeros((0, self.dimension), dtype=np.float32), [])
+            return
+
+        with open(state_path) as f:
+            state = json.load(f)
+        if state["dimension"] != self.dimension:
+            raise ValueError(
+                f"Local datastore {self.path} has dimension {state['dimension']}, "
+                f"but the embedding model produces vectors of dimension {self.dimension}."
+            )
+        if state["dtype"] != self.dtype.name:
+            raise ValueError(
+                f"Local datastore {self.path} stores {state['dtype']} vectors, "
+                f"but LOCAL_DATASTORE_DTYPE is {self.dtype.name}."
+            )
+
+        count = state["count"]
+        self.capacity = state["capacity"]
+        self._file_index = state["file_index"]
+        self._embeddings_file = state["embeddings_file"]
+        self._metadata_file = state["metadata_file"]
+        self._alive_file = state.get("alive_file", "alive.npy")
+        self._embeddings = np.memmap(
+            os.path.join(self.path, self._embeddings_file),
+            dtype=self.dtype,
+            mode="r+",
+            shape=(self.capacity, self.dimension),
+        )
+        self._alive = np.zeros(self.capacity, dtype=bool)
+        self._alive[:count] = np.load(os.path.join(self.path, self._alive_file))
+        # 저장 도중 종료되어 state.json이 가리키지 않는 alive 파일은 지운다
+        for file in os.listdir(self.path):
+            if file.startswith("alive-") and file != self._alive_file:
+                os.remove(os.path.join(self.path, file))
+        self._created_at = np.full(self.capacity, np.nan, dtype=np.float64)
+        self._codes = {
+            field: np.full(self.capacity, -1, dtype=np.int32)
+            for field in CATEGORICAL_FIELDS
+        }
+
+        # state.json보다 뒤에 쓰인 줄 (저장 도중 종료된 upsert) 은 잘라낸다
+        with open(os.path.join(self.path, self._metadata_file), "rb+") as f:
+            lines = [f.readline() for _ in range(count)]
+            f.truncate(f.tell())
+        for row, line in enumerate(lines):
+            chunk = json.loads(line)
+            self._set_row(row, chunk["id"], chunk["text"], chunk["metadata"])
+            if not self._alive[row]:
+                self._rows.pop(chunk["id"], None)
+        self.count = count
+        self._on_rows_added(0, count)
+        logger.info(f"Loaded {int(self._alive[:count].sum())} chunks from {self.path}")
+
+    def _normalize(self, vectors: np.ndarray) -> np.ndarray:
+        # 정규화한 벡터의 내적은 코사인 유사도
+        vectors = vectors.astype(np.float32, copy=False)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    def _on_rows_added(self, start: int, end: int) -> None:
+        """행 start..end가 추가된 뒤 호출된다. 별도의 검색 인덱스를 유지하는 하위 클래스가 재정의한다."""
+
+    def _on_rows_deleted(self, rows: np.ndarray) -> None:
+        """행이 삭제된 (alive가 False가 된) 뒤 호출된다."""
+
+    def _on_reset(self) -> None:
+        """모든 행이 지워진 뒤 호출된다. 압축할 때는 남은 행으로 _on_rows_added가 이어서 호출된다."""
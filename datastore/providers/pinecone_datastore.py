@@ -1,11 +1,14 @@
+import json
 import os
-from typing import Any, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import pinecone
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 import asyncio
 from loguru import logger
 
-from datastore.datastore import DataStore
+from datastore.datastore import DataStore, UpsertError
 from models.models import (
     DocumentChunk,
     DocumentChunkMetadata,
@@ -28,12 +31,37 @@ assert PINECONE_INDEX is not None
 # API 키와 환경으로 Pinecone 초기화
 pinecone.init(api_key=PINECONE_API_KEY, environment=PINECONE_ENVIRONMENT)
 
-# 벡터 업서트의 배치 크기를 Pinecone으로 설정
-UPSERT_BATCH_SIZE = 5
+# 업서트 요청 하나의 크기 제한 (Pinecone의 요청 제한은 2MB, 벡터 1000개)
+PINECONE_MAX_REQUEST_BYTES = int(
+    os.environ.get("PINECONE_MAX_REQUEST_BYTES", 2 * 1024 * 1024)
+)
+UPSERT_BATCH_SIZE = int(os.environ.get("PINECONE_UPSERT_BATCH_SIZE", 1000))
+# 동시에 보내는 업서트 요청 수와 블로킹 클라이언트를 실행하는 스레드 수
+PINECONE_UPSERT_CONCURRENCY = int(os.environ.get("PINECONE_UPSERT_CONCURRENCY", 8))
+PINECONE_POOL_THREADS = int(os.environ.get("PINECONE_POOL_THREADS", 16))
+PINECONE_QUERY_CONCURRENCY = int(os.environ.get("PINECONE_QUERY_CONCURRENCY", 8))
+# JSON으로 직렬화한 float 하나의 최대 크기 추정치 (쉼표 포함)
+FLOAT_JSON_BYTES = 24
+
+
+# Source enum의 유효한 값
+SOURCE_VALUES = {source.value for source in Source}
+
+# Gemini models/embedding-001 임베딩의 차원
+VECTOR_SIZE = 768
 
 
 class PineconeDataStore(DataStore):
-    def __init__(self):
+    # upsert 파이프라인이 UPSERT_BATCH_SIZE 개의 청크를 모아 _upsert에 넘기므로,
+    # 요청 크기에 맞춘 여러 배치를 PINECONE_UPSERT_CONCURRENCY 개씩 동시에 보낼 수 있다
+    write_batch_size = UPSERT_BATCH_SIZE
+
+    def __init__(self, dimension: int = VECTOR_SIZE):
+        # 블로킹 Pinecone 클라이언트 호출을 이벤트 루프 밖에서 실행하는 스레드 풀
+        self.executor = ThreadPoolExecutor(max_workers=PINECONE_POOL_THREADS)
+        # 쿼리 전용 스레드 풀, 동시에 실행하는 쿼리 수를 PINECONE_QUERY_CONCURRENCY로 제한
+        self.query_executor = ThreadPoolExecutor(max_workers=PINECONE_QUERY_CONCURRENCY)
+
         # 인덱스 이름이 지정되어 있고 Pinecone에 존재하는지 확인
         if PINECONE_INDEX and PINECONE_INDEX not in pinecone.list_indexes():
             # 메타데이터 객체의 모든 필드를 목록으로 가져오기
@@ -44,7 +72,7 @@ class PineconeDataStore(DataStore):
                 logger.info(f"인덱스 {PINECONE_INDEX} 이하와 같은 {fields_to_index}로 생성")
                 pinecone.create_index(
                     PINECONE_INDEX,
-                    dimension=768,  # Gemini models/embedding-001 임베딩의 차원
+                    dimension=dimension,
                     metadata_config={"indexed": fields_to_index},
                 )
                 self.index = pinecone.Index(PINECONE_INDEX)
@@ -62,19 +90,77 @@ class PineconeDataStore(DataStore):
                 logger.error(f"인덱스 {PINECONE_INDEX}에 연결하는데 실패함: {e}")
                 raise e
 
-    @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(3))
+            # 기존 인덱스의 차원이 임베딩 모델의 차원과 같은지 확인
+            index_dimension = pinecone.describe_index(PINECONE_INDEX).dimension
+            if index_dimension != dimension:
+                raise ValueError(
+                    f"Index {PINECONE_INDEX} has dimension {index_dimension}, "
+                    f"but the embedding model produces vectors of dimension {dimension}."
+                )
+
     async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
         """
         document ID에서 document 청크의 목록으로 딕셔너리를 받아 인덱스에 삽입
-        document ID 목록을 반환합니다.
+        재시도는 배치 단위로 하므로, 일시적인 오류가 나도 실패한 배치만 다시 전송한다.
+        document ID 목록을 반환하고, 재시도 후에도 실패한 배치가 있으면 해당 문서들로 UpsertError를 발생시킨다.
         """
         # 반환할 ID 목록 초기화
-        doc_ids: List[str] = []
-        # upsert 할 벡터 목록을 초기화
-        vectors = []
+        doc_ids: List[str] = list(chunks.keys())
+        # 요청 크기 제한에 맞춘 배치를 PINECONE_UPSERT_CONCURRENCY 개씩 동시에 전송
+        semaphore = asyncio.Semaphore(PINECONE_UPSERT_CONCURRENCY)
+
+        async def _upsert_batch(batch: List[Tuple[str, List[float], Dict[str, Any]]]):
+            async with semaphore:
+                try:
+                    logger.info(f"Upserting batch of size {len(batch)}")
+                    await self._call(self.index.upsert, vectors=batch)
+                    logger.info(f"Upserted batch successfully")
+                except Exception as e:
+                    logger.error(f"Error upserting batch: {e}")
+                    raise e
+
+        batches = self._get_upsert_batches(self._iter_vectors(chunks))
+        results = await asyncio.gather(
+            *[_upsert_batch(batch) for batch in batches], return_exceptions=True
+        )
+
+        # 완료된 배치는 그대로 두고, 실패한 배치의 문서만 보고한다
+        failures: Dict[str, str] = {}
+        for batch, result in zip(batches, results):
+            if isinstance(result, BaseException):
+                for _, _, metadata in batch:
+                    failures.setdefault(metadata["document_id"], str(result))
+        if failures:
+            raise UpsertError(
+                failures, ids=[doc_id for doc_id in doc_ids if doc_id not in failures]
+            )
+
+        return doc_ids
+
+    @retry(
+        wait=wait_random_exponential(min=1, max=20),
+        stop=stop_after_attempt(3),
+        reraise=True,
+    )
+    async def _call(
+        self, fn, *args, executor: Optional[ThreadPoolExecutor] = None, **kwargs
+    ):
+        """
+        블로킹 Pinecone 클라이언트 호출 하나를 스레드 풀에서 실행하고, 실패하면 그 호출만 재시도한다
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor or self.executor, partial(fn, *args, **kwargs)
+        )
+
+    async def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.query_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _iter_vectors(
+        self, chunks: Dict[str, List[DocumentChunk]]
+    ) -> Iterator[Tuple[str, List[float], Dict[str, Any]]]:
         for doc_id, chunk_list in chunks.items():
-            # 아이디 목록에 아이디를 추가
-            doc_ids.append(doc_id)
             logger.info(f"Upserting document_id: {doc_id}")
             for chunk in chunk_list:
                 # (아이디, 임베딩, 메타데이터)의 벡터 튜플을 생성
@@ -83,25 +169,43 @@ class PineconeDataStore(DataStore):
                 # 메타데이터 딕셔너리에 텍스트와 문서 ID를 추가
                 pinecone_metadata["text"] = chunk.text
                 pinecone_metadata["document_id"] = doc_id
-                vector = (chunk.id, chunk.embedding, pinecone_metadata)
-                vectors.append(vector)
-        # 벡터 목록을 지정된 크기의 배치로 분할
-        batches = [
-            vectors[i : i + UPSERT_BATCH_SIZE]
-            for i in range(0, len(vectors), UPSERT_BATCH_SIZE)
-        ]
-        for batch in batches:
-            try:
-                logger.info(f"Upserting batch of size {len(batch)}")
-                self.index.upsert(vectors=batch)
-                logger.info(f"Upserted batch successfully")
-            except Exception as e:
-                logger.error(f"Error upserting batch: {e}")
-                raise e
+                yield (chunk.id, chunk.embedding, pinecone_metadata)
 
-        return doc_ids
+    def _get_upsert_batches(
+        self, vectors: Iterator[Tuple[str, List[float], Dict[str, Any]]]
+    ) -> List[List[Tuple[str, List[float], Dict[str, Any]]]]:
+        """
+        직렬화한 요청 크기가 PINECONE_MAX_REQUEST_BYTES, 벡터 수가 UPSERT_BATCH_SIZE를 넘지 않도록 벡터를 배치로 나눈다
+        """
+        batches = []
+        batch: List[Tuple[str, List[float], Dict[str, Any]]] = []
+        batch_bytes = 0
+        for vector in vectors:
+            vector_bytes = self._estimate_vector_bytes(vector)
+            if batch and (
+                batch_bytes + vector_bytes > PINECONE_MAX_REQUEST_BYTES
+                or len(batch) >= UPSERT_BATCH_SIZE
+            ):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(vector)
+            batch_bytes += vector_bytes
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _estimate_vector_bytes(
+        self, vector: Tuple[str, List[float], Dict[str, Any]]
+    ) -> int:
+        id, values, metadata = vector
+        # 벡터 값은 개수로 추정하고, 메타데이터(텍스트 포함)만 실제로 직렬화한다
+        return (
+            len(id.encode("utf-8"))
+            + FLOAT_JSON_BYTES * len(values or [])
+            + len(json.dumps(metadata).encode("utf-8"))
+            + 64
+        )
 
-    @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(3))
     async def _query(
         self,
         queries: List[QueryWithEmbedding],
@@ -118,8 +222,11 @@ class PineconeDataStore(DataStore):
             pinecone_filter = self._get_pinecone_filter(query.filter)
 
             try:
-                # Query the index with the query embedding, filter, and top_k
-                query_response = self.index.query(
+                # Query the index with the query embedding, filter, and top_k.
+                # Queries run on their own thread pool, so they do not wait behind upsert batches.
+                query_response = await self._call(
+                    self.index.query,
+                    executor=self.query_executor,
                     # namespace=namespace,
                     top_k=query.top_k,
                     vector=query.embedding,
@@ -130,46 +237,41 @@ class PineconeDataStore(DataStore):
                 logger.error(f"Error querying index: {e}")
                 raise e
 
-            query_results: List[DocumentChunkWithScore] = []
-            for result in query_response.matches:
-                score = result.score
-                metadata = result.metadata
-                # Remove document id and text from metadata and store it in a new variable
-                metadata_without_text = (
-                    {key: value for key, value in metadata.items() if key != "text"}
-                    if metadata
-                    else None
-                )
-
-                # If the source is not a valid Source in the Source enum, set it to None
-                if (
-                    metadata_without_text
-                    and "source" in metadata_without_text
-                    and metadata_without_text["source"] not in Source.__members__
-                ):
-                    metadata_without_text["source"] = None
-
-                # Create a document chunk with score object with the result data
-                result = DocumentChunkWithScore(
-                    id=result.id,
-                    score=score,
-                    text=str(metadata["text"])
-                    if metadata and "text" in metadata
-                    else "",
-                    metadata=metadata_without_text,
-                )
-                query_results.append(result)
-            return QueryResult(query=query.query, results=query_results)
+            return QueryResult(
+                query=query.query,
+                results=[
+                    self._convert_match_to_document_chunk_with_score(match)
+                    for match in query_response.matches
+                ],
+            )
 
-        # Use asyncio.gather to run multiple _single_query coroutines concurrently and collect their results
+        # Use asyncio.gather to run multiple _single_query coroutines concurrently and collect their results.
+        # The blocking client calls run on the query thread pool, so the queries really overlap.
         results: List[QueryResult] = await asyncio.gather(
             *[_single_query(query) for query in queries]
         )
 
         return results
 
-    @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(3))
-    async def delete(
+    def _convert_match_to_document_chunk_with_score(
+        self, match: Any
+    ) -> DocumentChunkWithScore:
+        # The metadata dict of the response is not used elsewhere, so the text is popped out of it in place
+        metadata = match.metadata or {}
+        text = metadata.pop("text", "")
+
+        # If the source is not a valid Source in the Source enum, set it to None
+        if "source" in metadata and metadata["source"] not in SOURCE_VALUES:
+            metadata["source"] = None
+
+        return DocumentChunkWithScore(
+            id=match.id,
+            score=match.score,
+            text=str(text),
+            metadata=metadata,
+        )
+
+    async def _delete(
         self,
         ids: Optional[List[str]] = None,
         filter: Optional[DocumentMetadataFilter] = None,
@@ -182,7 +284,7 @@ class PineconeDataStore(DataStore):
         if delete_all:
             try:
                 logger.info(f"Deleting all vectors from index")
-                self.index.delete(delete_all=True)
+                await self._call(self.index.delete, delete_all=True)
                 logger.info(f"Deleted all vectors successfully")
                 return True
             except Exception as e:
@@ -195,7 +297,7 @@ class PineconeDataStore(DataStore):
         if pinecone_filter != {}:
             try:
                 logger.info(f"Deleting vectors with filter {pinecone_filter}")
-                self.index.delete(filter=pinecone_filter)
+                await self._call(self.index.delete, filter=pinecone_filter)
                 logger.info(f"Deleted vectors with filter successfully")
             except Exception as e:
                 logger.error(f"Error deleting vectors with filter: {e}")
@@ -206,7 +308,7 @@ class PineconeDataStore(DataStore):
             try:
                 logger.info(f"Deleting vectors with ids {ids}")
                 pinecone_filter = {"document_id": {"$in": ids}}
-                self.index.delete(filter=pinecone_filter)  # type: ignore
+                await self._call(self.index.delete, filter=pinecone_filter)
                 logger.info(f"Deleted vectors with ids successfully")
             except Exception as e:
                 logger.error(f"Error deleting vectors with ids: {e}")
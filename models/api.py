@@ -1,6 +1,7 @@
 from models.models import (
     Document,
     DocumentMetadataFilter,
+    JobStatus,
     Query,
     QueryResult,
 )
@@ -14,6 +15,35 @@ class UpsertRequest(BaseModel):
 
 class UpsertResponse(BaseModel):
     ids: List[str]
+    chunks_embedded: int = 0
+    # unchanged chunks kept from the stored version of the documents
+    chunks_reused: int = 0
+
+
+class FileUpsertResult(BaseModel):
+    filename: str
+    id: Optional[str] = None
+    error: Optional[str] = None
+
+
+class UpsertFilesResponse(BaseModel):
+    results: List[FileUpsertResult]
+    chunks_embedded: int = 0
+    chunks_reused: int = 0
+
+
+class UpsertJobResponse(BaseModel):
+    job_id: str
+
+
+class JobResponse(BaseModel):
+    id: str
+    status: JobStatus
+    chunks_embedded: int = 0
+    chunks_written: int = 0
+    chunks_reused: int = 0
+    ids: List[str] = []
+    error: Optional[str] = None
 
 
 class QueryRequest(BaseModel):
@@ -32,3 +62,20 @@ class DeleteRequest(BaseModel):
 
 class DeleteResponse(BaseModel):
     success: bool
+
+
+class ReindexRequest(BaseModel):
+    # None keeps the current setting of the index
+    similarity: Optional[str] = None
+    replicas: Optional[int] = None
+    shards: Optional[int] = None
+    quantization: Optional[str] = None
+    delete_old_index: bool = True
+
+
+class ReindexResponse(BaseModel):
+    id: str
+    status: JobStatus
+    # the new index, once the reindex has succeeded
+    index: Optional[str] = None
+    error: Optional[str] = None
@@ -9,6 +9,13 @@ class Source(str, Enum):
     chat = "chat"
 
 
+class JobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+
+
 class DocumentMetadata(BaseModel):
     source: Optional[Source] = None
     source_id: Optional[str] = None
@@ -19,6 +26,8 @@ class DocumentMetadata(BaseModel):
 
 class DocumentChunkMetadata(DocumentMetadata):
     document_id: Optional[str] = None
+    chunk_hash: Optional[str] = None  # hash of the chunk text and the document metadata
+    page: Optional[int] = None  # page (or slide) the chunk starts on
 
 
 class DocumentChunk(BaseModel):
@@ -51,10 +60,16 @@ class DocumentMetadataFilter(BaseModel):
     end_date: Optional[str] = None  # any date string format
 
 
+class QueryMode(str, Enum):
+    vector = "vector"
+    hybrid = "hybrid"
+
+
 class Query(BaseModel):
     query: str
     filter: Optional[DocumentMetadataFilter] = None
     top_k: Optional[int] = 3
+    mode: Optional[QueryMode] = None  # None uses the datastore default
 
 
 class QueryWithEmbedding(Query):
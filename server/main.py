@@ -1,8 +1,22 @@
 from curses import meta
+import asyncio
 import os
-from typing import Optional
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional
 import uvicorn
-from fastapi import FastAPI, File, Form, HTTPException, Depends, Body, UploadFile
+from fastapi import (
+    FastAPI,
+    File,
+    Form,
+    HTTPException,
+    Depends,
+    Body,
+    UploadFile,
+    Header,
+    Request,
+)
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
 from loguru import logger
@@ -10,17 +24,36 @@ from loguru import logger
 from models.api import (
     DeleteRequest,
     DeleteResponse,
+    JobResponse,
     QueryRequest,
     QueryResponse,
+    ReindexRequest,
+    ReindexResponse,
+    UpsertFilesResponse,
+    UpsertJobResponse,
     UpsertRequest,
     UpsertResponse,
 )
+from datastore.datastore import UpsertError
 from datastore.factory import get_datastore
-from services.file import get_document_from_file
+from services.bulk_upload import TooManyFilesError, upsert_uploaded_files
+from services.chunks import shutdown_chunking_executor
+from services.file import (
+    FileExtractionError,
+    FileTooLargeError,
+    get_document_from_file,
+    shutdown_extraction_executor,
+)
+from services.gemini import get_embedding_cache, get_embedding_client
+from services.jobs import JobQueue
+from services.ndjson import upsert_ndjson_stream
 
-from models.models import DocumentMetadata, Source
+from models.models import DocumentMetadata, JobStatus, Source
 
 bearer_scheme = HTTPBearer()
+# 서버가 시작된 뒤 요청된 reindex 작업, 한 번에 하나만 실행한다
+reindex_jobs: Dict[str, ReindexResponse] = {}
+reindex_task: Optional[asyncio.Task] = None
 BEARER_TOKEN = os.environ.get("BEARER_TOKEN")
 assert BEARER_TOKEN is not None
 
@@ -31,6 +64,36 @@ def validate_token(credentials: HTTPAuthorizationCredentials = Depends(bearer_sc
     return credentials
 
 
+def use_query_cache(cache_control: Optional[str]) -> bool:
+    # "Cache-Control: no-cache" 헤더가 있으면 쿼리 결과 캐시를 사용하지 않는다
+    return not (cache_control and "no-cache" in cache_control.lower())
+
+
+def parse_file_metadata(metadata: Optional[str]) -> DocumentMetadata:
+    try:
+        return (
+            DocumentMetadata.parse_raw(metadata)
+            if metadata
+            else DocumentMetadata(source=Source.file)
+        )
+    except:
+        return DocumentMetadata(source=Source.file)
+
+
+def upsert_error_detail(error: UpsertError) -> dict:
+    # 일부 문서만 실패한 경우, 저장된 문서 ID와 실패한 문서별 오류를 함께 반환
+    return {"ids": error.ids, "failures": error.failures}
+
+
+class NDJSONStreamingResponse(StreamingResponse):
+    media_type = "application/x-ndjson"
+
+    async def listen_for_disconnect(self, receive) -> None:
+        # The request body is still being read by the response content, so `receive` must not be
+        # consumed here. A client disconnect surfaces as an error while reading the request stream.
+        await asyncio.Event().wait()
+
+
 app = FastAPI(dependencies=[Depends(validate_token)])
 app.mount("/.well-known", StaticFiles(directory=".well-known"), name="static")
 
@@ -53,18 +116,52 @@ async def upsert_file(
     file: UploadFile = File(...),
     metadata: Optional[str] = Form(None),
 ):
+    metadata_obj = parse_file_metadata(metadata)
     try:
-        metadata_obj = (
-            DocumentMetadata.parse_raw(metadata)
-            if metadata
-            else DocumentMetadata(source=Source.file)
+        document = await get_document_from_file(file, metadata_obj)
+    except FileTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=400, detail=f"Could not read file: {e}")
+    try:
+        progress: Counter = Counter()
+        ids = await datastore.upsert(
+            [document], on_progress=lambda stage, count: progress.update({stage: count})
         )
-    except:
-        metadata_obj = DocumentMetadata(source=Source.file)
-    document = await get_document_from_file(file, metadata_obj)
+        return UpsertResponse(
+            ids=ids,
+            chunks_embedded=progress["embedded"],
+            chunks_reused=progress["reused"],
+        )
+    except FileExtractionError as e:
+        logger.error(e)
+        # 추출하다 실패하기 전에 저장된 청크를 지운다
+        await datastore.delete(ids=[document.id])
+        raise HTTPException(status_code=400, detail=str(e))
+    except UpsertError as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=upsert_error_detail(e))
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=f"str({e})")
+
+
+@app.post(
+    "/upsert-files",
+    response_model=UpsertFilesResponse,
+    description="Upserts many files, or the files in zip and tar archives, with shared embedding batches. Returns a document id or an error per file.",
+)
+async def upsert_files(
+    files: List[UploadFile] = File(...),
+    metadata: Optional[str] = Form(None),
+):
     try:
-        ids = await datastore.upsert([document])
-        return UpsertResponse(ids=ids)
+        return await upsert_uploaded_files(
+            datastore, files, parse_file_metadata(metadata)
+        )
+    except TooManyFilesError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=f"str({e})")
@@ -78,23 +175,92 @@ async def upsert(
     request: UpsertRequest = Body(...),
 ):
     try:
-        ids = await datastore.upsert(request.documents)
-        return UpsertResponse(ids=ids)
+        progress: Counter = Counter()
+        ids = await datastore.upsert(
+            request.documents,
+            on_progress=lambda stage, count: progress.update({stage: count}),
+        )
+        return UpsertResponse(
+            ids=ids,
+            chunks_embedded=progress["embedded"],
+            chunks_reused=progress["reused"],
+        )
+    except UpsertError as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=upsert_error_detail(e))
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail="Internal Service Error")
 
 
+@app.post(
+    "/upsert-file/async",
+    response_model=UpsertJobResponse,
+)
+async def upsert_file_async(
+    file: UploadFile = File(...),
+    metadata: Optional[str] = Form(None),
+):
+    try:
+        job_id = await job_queue.submit_file(file, parse_file_metadata(metadata))
+        return UpsertJobResponse(job_id=job_id)
+    except FileTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        # 지원하지 않는 파일 형식
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail="Internal Service Error")
+
+
+@app.post(
+    "/upsert/async",
+    response_model=UpsertJobResponse,
+)
+async def upsert_async(
+    request: UpsertRequest = Body(...),
+):
+    try:
+        job_id = job_queue.submit_documents(request.documents)
+        return UpsertJobResponse(job_id=job_id)
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail="Internal Service Error")
+
+
+@app.post(
+    "/upsert/stream",
+    response_class=NDJSONStreamingResponse,
+    description="Accepts newline-delimited Document JSON and streams back one result line per document.",
+)
+async def upsert_stream(request: Request):
+    return NDJSONStreamingResponse(upsert_ndjson_stream(datastore, request.stream()))
+
+
+@app.get(
+    "/jobs/{job_id}",
+    response_model=JobResponse,
+)
+async def get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
 @app.post(
     "/query",
     response_model=QueryResponse,
 )
 async def query_main(
     request: QueryRequest = Body(...),
+    cache_control: Optional[str] = Header(None),
 ):
     try:
         results = await datastore.query(
             request.queries,
+            use_cache=use_query_cache(cache_control),
         )
         return QueryResponse(results=results)
     except Exception as e:
@@ -110,10 +276,12 @@ async def query_main(
 )
 async def query(
     request: QueryRequest = Body(...),
+    cache_control: Optional[str] = Header(None),
 ):
     try:
         results = await datastore.query(
             request.queries,
+            use_cache=use_query_cache(cache_control),
         )
         return QueryResponse(results=results)
     except Exception as e:
@@ -145,10 +313,86 @@ async def delete(
         raise HTTPException(status_code=500, detail="Internal Service Error")
 
 
+@app.post(
+    "/reindex",
+    response_model=ReindexResponse,
+    status_code=202,
+    description="Starts rebuilding the index with new settings without re-embedding, switching to it once the copy is done. Poll GET /reindex/{reindex_id} for the new index.",
+)
+async def reindex(
+    request: ReindexRequest = Body(...),
+):
+    global reindex_task
+    # 인덱스를 다시 만드는 기능은 Elasticsearch 데이터스토어만 지원한다
+    if not hasattr(datastore, "reindex"):
+        raise HTTPException(
+            status_code=400, detail="The datastore does not support reindexing"
+        )
+    if reindex_task is not None and not reindex_task.done():
+        raise HTTPException(status_code=409, detail="A reindex is already running")
+    job = ReindexResponse(id=str(uuid.uuid4()), status=JobStatus.running)
+    reindex_jobs[job.id] = job
+    reindex_task = asyncio.create_task(run_reindex(job, request))
+    return job
+
+
+async def run_reindex(job: ReindexResponse, request: ReindexRequest) -> None:
+    """reindex 작업을 실행하고 결과를 job에 기록한다. 지원하지 않는 설정도 실패로 기록한다"""
+    try:
+        job.index = await datastore.reindex(
+            similarity=request.similarity,
+            replicas=request.replicas,
+            shards=request.shards,
+            quantization=request.quantization,
+            delete_old_index=request.delete_old_index,
+        )
+        job.status = JobStatus.succeeded
+        logger.info(f"Reindex {job.id} succeeded")
+    except asyncio.CancelledError:
+        job.status = JobStatus.failed
+        job.error = "Cancelled by the server shutdown"
+        raise
+    except Exception as e:
+        logger.error(f"Reindex {job.id} failed: {e}")
+        job.status = JobStatus.failed
+        job.error = str(e)
+
+
+@app.get(
+    "/reindex/{reindex_id}",
+    response_model=ReindexResponse,
+)
+async def get_reindex(reindex_id: str):
+    job = reindex_jobs.get(reindex_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Reindex {reindex_id} not found")
+    return job
+
+
 @app.on_event("startup")
 async def startup():
-    global datastore
+    global datastore, job_queue
+    # 임베딩 클라이언트를 미리 생성하여 요청 간에 연결을 재사용
+    get_embedding_client()
+    get_embedding_cache()
     datastore = await get_datastore()
+    job_queue = JobQueue()
+    await job_queue.start(datastore)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await job_queue.stop()
+    if reindex_task is not None:
+        reindex_task.cancel()
+        await asyncio.gather(reindex_task, return_exceptions=True)
+    logger.info(f"Query cache stats: {datastore.query_cache.stats()}")
+    cache = get_embedding_cache()
+    logger.info(f"Embedding cache stats: {cache.stats()}")
+    cache.close()
+    shutdown_chunking_executor()
+    shutdown_extraction_executor()
+    await datastore.close()
 
 
 def start():
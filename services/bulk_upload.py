@@ -0,0 +1,251 @@
+import asyncio
+import os
+import shutil
+import tarfile
+import tempfile
+import uuid
+import zipfile
+from collections import Counter
+from functools import partial
+from typing import (
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from fastapi import UploadFile
+from loguru import logger
+
+from datastore.datastore import DataStore, UpsertError
+from models.api import FileUpsertResult, UpsertFilesResponse
+from models.models import DocumentMetadata
+from services.chunks import SegmentedDocument
+from services.file import (
+    FILE_UPLOAD_MAX_BYTES,
+    FileTooLargeError,
+    extract_segments_from_upload,
+    get_extraction_executor,
+    get_mimetype,
+    iter_file_segments,
+)
+
+# 여러 파일 업로드 설정
+BULK_UPLOAD_MAX_FILES = int(
+    os.environ.get("BULK_UPLOAD_MAX_FILES", 10000)
+)  # The most files accepted by one /upsert-files request, counting the files in archives
+ARCHIVE_MAX_BYTES = int(
+    os.environ.get("ARCHIVE_MAX_BYTES", 1024 * 1024 * 1024)
+)  # The largest total uncompressed size of the files in an uploaded archive
+
+ZIP_MIMETYPES = ["application/zip", "application/x-zip-compressed"]
+TAR_MIMETYPES = [
+    "application/x-tar",
+    "application/x-gtar",
+    "application/gzip",
+    "application/x-gzip",
+    "application/x-compressed-tar",
+]
+
+# 파일의 텍스트 조각 (iter_file_segments) 을 여는 함수
+SegmentsOpener = Callable[[], Iterator[Tuple[str, Optional[int]]]]
+
+
+class TooManyFilesError(ValueError):
+    """업로드된 파일이 압축 파일 안의 파일을 포함해 BULK_UPLOAD_MAX_FILES 개보다 많을 때 발생"""
+
+
+async def upsert_uploaded_files(
+    datastore: DataStore, files: List[UploadFile], metadata: DocumentMetadata
+) -> UpsertFilesResponse:
+    """
+    업로드된 여러 파일과 압축 파일 (zip, tar) 안의 파일을 파일마다 문서 하나로 한 번에 upsert한다.
+    모든 파일의 청크가 같은 임베딩 배치로 모이고, 파일은 upsert 파이프라인이 청크로 나누기 시작할 때 열리므로
+    동시에 열려 있는 파일과 메모리에 있는 텍스트는 파이프라인이 동시에 나누는 몇 개의 파일 뿐이다.
+    파일마다 문서 ID 또는 오류를 업로드 순서대로 반환하고, 압축 파일 안의 파일 이름은 "압축 파일 이름/경로" 이다.
+    """
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryDirectory(prefix="upsert-files-") as directory:
+        entries: List[Tuple[str, Union[SegmentsOpener, Exception]]] = []
+        for file in files:
+            name = file.filename or ""
+            try:
+                mimetype = get_mimetype(file.filename, file.content_type)
+            except ValueError as e:
+                entries.append((name, e))
+                continue
+            if mimetype not in ZIP_MIMETYPES + TAR_MIMETYPES:
+                entries.append(
+                    (name, partial(extract_segments_from_upload, file.file, mimetype))
+                )
+                continue
+
+            # 압축 파일은 추출 스레드 풀에서 임시 디렉터리에 풀고, 안의 파일을 하나씩 문서로 만든다
+            try:
+                members = await loop.run_in_executor(
+                    get_extraction_executor(),
+                    extract_archive,
+                    file.file,
+                    mimetype,
+                    directory,
+                    BULK_UPLOAD_MAX_FILES - len(entries),
+                )
+            except TooManyFilesError:
+                raise
+            except Exception as e:
+                logger.error(e)
+                entries.append((name, e))
+                continue
+            for member_name, path in members:
+                entries.append(
+                    (f"{name}/{member_name}", _open_member(member_name, path))
+                )
+        if len(entries) > BULK_UPLOAD_MAX_FILES:
+            raise TooManyFilesError(
+                f"More than {BULK_UPLOAD_MAX_FILES} files were uploaded"
+            )
+
+        # 응답에 파일별 ID를 돌려줄 수 있도록 upsert 전에 문서 ID를 정한다
+        results: List[FileUpsertResult] = []
+        documents: List[SegmentedDocument] = []
+        failures: Dict[str, str] = {}
+        for name, opener in entries:
+            if isinstance(opener, Exception):
+                results.append(FileUpsertResult(filename=name, error=str(opener)))
+                continue
+            doc_id = str(uuid.uuid4())
+            documents.append(
+                SegmentedDocument(
+                    id=doc_id,
+                    segments=_read_segments(opener, name, doc_id, failures),
+                    metadata=metadata,
+                )
+            )
+            results.append(FileUpsertResult(filename=name, id=doc_id))
+
+        progress: Counter = Counter()
+        if documents:
+            try:
+                await datastore.upsert(
+                    documents,
+                    on_progress=lambda stage, count: progress.update({stage: count}),
+                )
+            except UpsertError as e:
+                logger.error(e)
+                for doc_id, error in e.failures.items():
+                    failures.setdefault(doc_id, error)
+            if failures:
+                # 실패한 파일의 일부만 저장된 청크를 지운다
+                await datastore.delete(ids=list(failures))
+
+    for result in results:
+        if result.id in failures:
+            result.error = failures[result.id]
+            result.id = None
+    return UpsertFilesResponse(
+        results=results,
+        chunks_embedded=progress["embedded"],
+        chunks_reused=progress["reused"],
+    )
+
+
+def _open_member(
+    member_name: str, path: Union[str, Exception]
+) -> Union[SegmentsOpener, Exception]:
+    if isinstance(path, Exception):
+        return path
+    try:
+        mimetype = get_mimetype(member_name)
+    except ValueError as e:
+        return e
+    return partial(iter_file_segments, path, mimetype)
+
+
+def _read_segments(
+    opener: SegmentsOpener, name: str, doc_id: str, failures: Dict[str, str]
+) -> Iterator[Tuple[str, Optional[int]]]:
+    """
+    파이프라인이 읽기 시작할 때 파일을 열고 텍스트 조각을 반환한다.
+    열거나 추출하다 실패하면 오류를 failures에 기록하고 조각을 끝내서, 다른 파일의 upsert는 계속된다.
+    """
+    try:
+        yield from opener()
+    except Exception as e:
+        logger.error(f"Could not read {name}: {e}")
+        failures[doc_id] = f"Could not read file: {e}"
+
+
+def extract_archive(
+    file: BinaryIO, mimetype: str, directory: str, max_files: int
+) -> List[Tuple[str, Union[str, Exception]]]:
+    """
+    압축 파일 안의 일반 파일을 directory에 하나씩 풀고, (압축 파일 안의 경로, 푼 파일의 경로 또는 오류) 를 반환한다.
+    푼 파일의 이름은 새로 만들므로 압축 파일 안의 경로가 directory 밖을 가리켜도 상관없다.
+    크기는 압축 파일에 기록된 크기로 확인한다 (zipfile과 tarfile은 기록된 크기보다 많이 읽지 않는다).
+    FILE_UPLOAD_MAX_BYTES 보다 큰 파일은 FileTooLargeError가 되고, 크기의 합이 ARCHIVE_MAX_BYTES 보다 크거나
+    파일이 max_files 개보다 많으면 압축을 풀지 않고 예외가 발생한다.
+    """
+    if mimetype in ZIP_MIMETYPES:
+        with zipfile.ZipFile(file) as zip_archive:
+            return _extract_members(
+                [
+                    (info.filename, info.file_size, partial(zip_archive.open, info))
+                    for info in zip_archive.infolist()
+                    if not info.is_dir()
+                ],
+                directory,
+                max_files,
+            )
+    with tarfile.open(fileobj=file, mode="r:*") as tar_archive:
+        return _extract_members(
+            [
+                (member.name, member.size, partial(tar_archive.extractfile, member))
+                for member in tar_archive.getmembers()
+                if member.isfile()
+            ],
+            directory,
+            max_files,
+        )
+
+
+def _extract_members(
+    members: List[Tuple[str, int, Callable[[], Optional[BinaryIO]]]],
+    directory: str,
+    max_files: int,
+) -> List[Tuple[str, Union[str, Exception]]]:
+    if len(members) > max_files:
+        raise TooManyFilesError(
+            f"More than {BULK_UPLOAD_MAX_FILES} files were uploaded"
+        )
+    total_size = sum(size for _, size, _ in members)
+    if total_size > ARCHIVE_MAX_BYTES:
+        raise FileTooLargeError(
+            f"Archive expands to {total_size} bytes, the limit is {ARCHIVE_MAX_BYTES} bytes"
+        )
+
+    extracted: List[Tuple[str, Union[str, Exception]]] = []
+    for name, size, open_member in members:
+        if size > FILE_UPLOAD_MAX_BYTES:
+            extracted.append(
+                (
+                    name,
+                    FileTooLargeError(
+                        f"File is {size} bytes, the limit is {FILE_UPLOAD_MAX_BYTES} bytes"
+                    ),
+                )
+            )
+            continue
+        try:
+            with tempfile.NamedTemporaryFile(
+                dir=directory, delete=False
+            ) as target, open_member() as source:
+                shutil.copyfileobj(source, target)
+        except Exception as e:
+            extracted.append((name, e))
+            continue
+        extracted.append((name, target.name))
+    return extracted
@@ -1,25 +1,126 @@
-from typing import Dict, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from typing import (
+    AsyncIterator,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+import asyncio
+import hashlib
+import json
 import uuid
 import os
-from models.models import Document, DocumentChunk, DocumentChunkMetadata
-
+from models.models import (
+    Document,
+    DocumentChunk,
+    DocumentChunkMetadata,
+    DocumentMetadata,
+)
+
+import regex
 import tiktoken
 
-from services.gemini import get_embeddings
+from services.gemini import EMBEDDINGS_BATCH_SIZE, get_embeddings
 
 # Global variables
 tokenizer = tiktoken.get_encoding(
     "cl100k_base"
 )  # The encoding scheme to use for tokenization
+# The pattern the tokenizer splits a text with before encoding each piece on its own. tiktoken has no
+# public accessor for it, but Encoding._pat_str has been there since the first release. Without it,
+# iter_text_chunks encodes the whole text at the end, which gives the same chunks without streaming.
+_pat_str: Optional[str] = getattr(tokenizer, "_pat_str", None)
+token_pieces = regex.compile(_pat_str) if _pat_str is not None else None
 
 # Constants
 CHUNK_SIZE = 200  # The target size of each text chunk in tokens
 MIN_CHUNK_SIZE_CHARS = 350  # The minimum size of each text chunk in characters
 MIN_CHUNK_LENGTH_TO_EMBED = 5  # Discard chunks shorter than this
-EMBEDDINGS_BATCH_SIZE = int(
-    os.environ.get("GOOGLE_EMBEDDING_BATCH_SIZE", 128)
-)  # The number of embeddings to request at a time
 MAX_NUM_CHUNKS = 10000  # The maximum number of chunks to generate from a text
+CHUNKING_PROCESSES = int(
+    os.environ.get("CHUNKING_PROCESSES", os.cpu_count() or 1)
+)  # The number of worker processes used for chunking, 0 chunks in the server process
+CHUNKING_MIN_PARALLEL_CHARS = int(
+    os.environ.get("CHUNKING_MIN_PARALLEL_CHARS", 100000)
+)  # Requests with less text than this are chunked in the server process
+
+# The process pool used for chunking, created on first use
+_chunking_executor: Optional[ProcessPoolExecutor] = None
+
+
+def _init_chunking_worker() -> None:
+    # Load the tokenizer once per worker process
+    global tokenizer
+    tokenizer = tiktoken.get_encoding("cl100k_base")
+
+
+def get_chunking_executor() -> Optional[ProcessPoolExecutor]:
+    """
+    Return the shared process pool used for chunking, or None if CHUNKING_PROCESSES is 0.
+    """
+    global _chunking_executor
+    if _chunking_executor is None and CHUNKING_PROCESSES > 0:
+        _chunking_executor = ProcessPoolExecutor(
+            max_workers=CHUNKING_PROCESSES, initializer=_init_chunking_worker
+        )
+    return _chunking_executor
+
+
+def shutdown_chunking_executor() -> None:
+    global _chunking_executor
+    if _chunking_executor is not None:
+        _chunking_executor.shutdown(cancel_futures=True)
+        _chunking_executor = None
+
+
+def _cut_chunk(
+    tokens: List[int], start: int, chunk_size: int
+) -> Tuple[Optional[str], int]:
+    """
+    Cut the chunk that starts at tokens[start], based on punctuation and newline boundaries.
+
+    Returns:
+        A tuple of (chunk_text, end), where end is the offset of the first token after the chunk,
+        and chunk_text is the stripped text of the chunk, or None if the chunk is empty or whitespace
+        (such a chunk is skipped and does not count towards MAX_NUM_CHUNKS).
+    """
+    # Take the next chunk_size tokens as a chunk
+    chunk = tokens[start : start + chunk_size]
+
+    # Decode the chunk into text
+    chunk_text = tokenizer.decode(chunk)
+
+    # Skip the chunk if it is empty or whitespace, moving past its tokens
+    if not chunk_text or chunk_text.isspace():
+        return None, start + len(chunk)
+
+    # Find the last period or punctuation mark in the chunk
+    last_punctuation = max(
+        chunk_text.rfind("."),
+        chunk_text.rfind("?"),
+        chunk_text.rfind("!"),
+        chunk_text.rfind("\n"),
+    )
+
+    # If there is a punctuation mark, and the last punctuation index is before MIN_CHUNK_SIZE_CHARS
+    if last_punctuation != -1 and last_punctuation > MIN_CHUNK_SIZE_CHARS:
+        # Truncate the chunk text at the punctuation mark
+        chunk_text = chunk_text[: last_punctuation + 1]
+
+    # Move past the tokens corresponding to the chunk text. The chunk text is
+    # re-encoded (at most chunk_size tokens) because the tokenization of a cut-off
+    # text can differ from the original tokens at the cut.
+    end = start + len(tokenizer.encode(chunk_text, disallowed_special=()))
+
+    # Remove any newline characters and strip any leading or trailing whitespace
+    return chunk_text.replace("\n", " ").strip(), end
 
 
 def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
@@ -39,6 +140,7 @@ def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
 
     # Tokenize the text
     tokens = tokenizer.encode(text, disallowed_special=())
+    num_tokens = len(tokens)
 
     # Initialize an empty list of chunks
     chunks = []
@@ -49,80 +151,212 @@ def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
     # Initialize a counter for the number of chunks
     num_chunks = 0
 
-    # Loop until all tokens are consumed
-    while tokens and num_chunks < MAX_NUM_CHUNKS:
-        # Take the first chunk_size tokens as a chunk
-        chunk = tokens[:chunk_size]
+    # Offset of the first token that has not been consumed yet. Advancing an offset
+    # instead of slicing off the consumed tokens keeps the loop linear in the text length.
+    start = 0
 
-        # Decode the chunk into text
-        chunk_text = tokenizer.decode(chunk)
+    # Loop until all tokens are consumed
+    while start < num_tokens and num_chunks < MAX_NUM_CHUNKS:
+        chunk_text, start = _cut_chunk(tokens, start, chunk_size)
 
         # Skip the chunk if it is empty or whitespace
-        if not chunk_text or chunk_text.isspace():
-            # Remove the tokens corresponding to the chunk text from the remaining tokens
-            tokens = tokens[len(chunk) :]
-            # Continue to the next iteration of the loop
+        if chunk_text is None:
             continue
 
-        # Find the last period or punctuation mark in the chunk
-        last_punctuation = max(
-            chunk_text.rfind("."),
-            chunk_text.rfind("?"),
-            chunk_text.rfind("!"),
-            chunk_text.rfind("\n"),
-        )
-
-        # If there is a punctuation mark, and the last punctuation index is before MIN_CHUNK_SIZE_CHARS
-        if last_punctuation != -1 and last_punctuation > MIN_CHUNK_SIZE_CHARS:
-            # Truncate the chunk text at the punctuation mark
-            chunk_text = chunk_text[: last_punctuation + 1]
-
-        # Remove any newline characters and strip any leading or trailing whitespace
-        chunk_text_to_append = chunk_text.replace("\n", " ").strip()
-
-        if len(chunk_text_to_append) > MIN_CHUNK_LENGTH_TO_EMBED:
+        if len(chunk_text) > MIN_CHUNK_LENGTH_TO_EMBED:
             # Append the chunk text to the list of chunks
-            chunks.append(chunk_text_to_append)
-
-        # Remove the tokens corresponding to the chunk text from the remaining tokens
-        tokens = tokens[len(tokenizer.encode(chunk_text, disallowed_special=())) :]
+            chunks.append(chunk_text)
 
         # Increment the number of chunks
         num_chunks += 1
 
     # Handle the remaining tokens
-    if tokens:
-        remaining_text = tokenizer.decode(tokens).replace("\n", " ").strip()
+    if start < num_tokens:
+        remaining_text = tokenizer.decode(tokens[start:]).replace("\n", " ").strip()
         if len(remaining_text) > MIN_CHUNK_LENGTH_TO_EMBED:
             chunks.append(remaining_text)
 
     return chunks
 
 
+def iter_text_chunks(
+    segments: Iterable[Tuple[str, Optional[int]]], chunk_token_size: Optional[int]
+) -> Iterator[Tuple[str, Optional[int]]]:
+    """
+    Split a text that arrives as a stream of segments into the same chunks as get_text_chunks splits the
+    concatenated text into, while holding only about one chunk of tokens at a time.
+
+    Args:
+        segments: The (text, page) segments of the text, in order. page is the page number of the segment, or None.
+        chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+
+    Yields:
+        A (chunk_text, page) tuple per chunk, where page is the page the chunk text starts on.
+    """
+    chunk_size = chunk_token_size or CHUNK_SIZE
+    num_chunks = 0
+
+    # Tokens of the text read so far, from the offset of the first token that has not been consumed yet.
+    # The tokenizer encodes each piece matched by its pattern on its own. Only the last two pieces of a
+    # text can change when more text is appended (a word cut in two), and trailing whitespace is one
+    # piece at the end of a text but may be two pieces inside it, so the text is encoded up to the end
+    # of an earlier piece that does not end with whitespace and the rest waits for the next segment.
+    # The tokens are then the same as the tokens of the whole text.
+    tokens: List[int] = []
+    start = 0
+    pending_text = ""
+
+    # Byte offsets in the text at which the pages start, and the offset of tokens[offset_index]
+    page_starts: Deque[Tuple[int, Optional[int]]] = deque()
+    text_bytes = 0
+    offset_index = 0
+    offset = 0
+
+    def advance_offset(index: int) -> None:
+        nonlocal offset_index, offset
+        offset += len(tokenizer.decode_bytes(tokens[offset_index:index]))
+        offset_index = index
+
+    def page_at(start: int) -> Optional[int]:
+        # The page of a chunk is the page of its first non-whitespace character
+        advance_offset(start)
+        window = tokenizer.decode_bytes(tokens[start : start + chunk_size])
+        chunk_offset = offset + len(window) - len(window.lstrip())
+        while len(page_starts) > 1 and page_starts[1][0] <= chunk_offset:
+            page_starts.popleft()
+        return page_starts[0][1] if page_starts else None
+
+    def cut_chunks(final: bool) -> Iterator[Tuple[str, Optional[int]]]:
+        nonlocal start, num_chunks
+        # Unless the text is complete, only cut chunks whose whole window of tokens is known
+        while (
+            start < len(tokens) if final else len(tokens) - start >= chunk_size
+        ) and num_chunks < MAX_NUM_CHUNKS:
+            page = page_at(start)
+            chunk_text, start = _cut_chunk(tokens, start, chunk_size)
+            if chunk_text is None:
+                continue
+            if len(chunk_text) > MIN_CHUNK_LENGTH_TO_EMBED:
+                yield chunk_text, page
+            num_chunks += 1
+
+    for text, page in segments:
+        if not text:
+            continue
+        page_starts.append((text_bytes, page))
+        text_bytes += len(text.encode("utf-8"))
+
+        pending_text += text
+        if token_pieces is None:
+            continue
+        piece_ends = [piece.end() for piece in token_pieces.finditer(pending_text)]
+        cut = next(
+            (
+                end
+                for end in reversed(piece_ends[:-2])
+                if not pending_text[end - 1].isspace()
+            ),
+            0,
+        )
+        if not cut:
+            continue
+        tokens.extend(tokenizer.encode(pending_text[:cut], disallowed_special=()))
+        pending_text = pending_text[cut:]
+
+        yield from cut_chunks(final=False)
+
+        # Drop the consumed tokens once they make up most of the buffer. A chunk cut in the middle of
+        # a character can be re-encoded into more tokens than its window, so start may be past the end.
+        if start > chunk_size and start * 2 > len(tokens):
+            consumed = min(start, len(tokens))
+            advance_offset(consumed)
+            del tokens[:consumed]
+            start -= consumed
+            offset_index = 0
+
+    tokens.extend(tokenizer.encode(pending_text, disallowed_special=()))
+    yield from cut_chunks(final=True)
+
+    # Handle the remaining tokens
+    if start < len(tokens):
+        page = page_at(start)
+        remaining_text = tokenizer.decode(tokens[start:]).replace("\n", " ").strip()
+        if len(remaining_text) > MIN_CHUNK_LENGTH_TO_EMBED:
+            yield remaining_text, page
+
+
+def iter_text_chunk_parts(
+    segments: Iterable[Tuple[str, Optional[int]]],
+    chunk_token_size: Optional[int],
+    part_size: int,
+) -> Iterator[List[Tuple[str, Optional[int]]]]:
+    """
+    Split a stream of segments into chunks, see iter_text_chunks, and yield them in lists of at most part_size chunks.
+    The segments are closed when they have all been read, so a generator can release what it holds (e.g. a file).
+    """
+    part: List[Tuple[str, Optional[int]]] = []
+    try:
+        for chunk in iter_text_chunks(segments, chunk_token_size):
+            part.append(chunk)
+            if len(part) == part_size:
+                yield part
+                part = []
+        if part:
+            yield part
+    finally:
+        close = getattr(segments, "close", None)
+        if close is not None:
+            close()
+
+
+@dataclass
+class SegmentedDocument:
+    """
+    A document whose text is read as a stream of (text, page) segments instead of one string,
+    e.g. the pages of a PDF or the rows of a CSV file as they are extracted. It is chunked by
+    iter_document_chunks like a Document, and each chunk gets the page it starts on in metadata.page.
+    The segments can only be read once.
+    """
+
+    segments: Iterable[Tuple[str, Optional[int]]]
+    id: Optional[str] = None
+    metadata: Optional[DocumentMetadata] = None
+
+
 def create_document_chunks(
-    doc: Document, chunk_token_size: Optional[int]
+    doc: Union[Document, SegmentedDocument],
+    chunk_token_size: Optional[int],
+    text_chunks: Optional[List[str]] = None,
+    pages: Optional[List[Optional[int]]] = None,
+    first_index: int = 0,
 ) -> Tuple[List[DocumentChunk], str]:
     """
     Create a list of document chunks from a document object and return the document id.
 
     Args:
         doc: The document object to create chunks from. It should have a text attribute and optionally an id and a metadata attribute.
+            A SegmentedDocument has no text, its text_chunks have to be given.
         chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+        text_chunks: The already split text of the document, or None to split it here.
+        pages: The page each of the text_chunks starts on, stored in the metadata of the chunks.
+        first_index: The sequential number of the first chunk, when the text_chunks are a part of the document.
 
     Returns:
         A tuple of (doc_chunks, doc_id), where doc_chunks is a list of document chunks, each of which is a DocumentChunk object with an id, a document_id, a text, and a metadata attribute,
         and doc_id is the id of the document object, generated if not provided. The id of each chunk is generated from the document id and a sequential number, and the metadata is copied from the document object.
     """
-    # Check if the document text is empty or whitespace
-    if not doc.text or doc.text.isspace():
-        return [], doc.id or str(uuid.uuid4())
+    if text_chunks is None:
+        assert isinstance(doc, Document)
+        # Check if the document text is empty or whitespace
+        if not doc.text or doc.text.isspace():
+            return [], doc.id or str(uuid.uuid4())
+
+        # Split the document text into chunks
+        text_chunks = get_text_chunks(doc.text, chunk_token_size)
 
     # Generate a document id if not provided
     doc_id = doc.id or str(uuid.uuid4())
 
-    # Split the document text into chunks
-    text_chunks = get_text_chunks(doc.text, chunk_token_size)
-
     metadata = (
         DocumentChunkMetadata(**doc.metadata.__dict__)
         if doc.metadata is not None
@@ -136,11 +370,16 @@ def create_document_chunks(
 
     # Assign each chunk a sequential number and create a DocumentChunk object
     for i, text_chunk in enumerate(text_chunks):
-        chunk_id = f"{doc_id}_{i}"
+        chunk_id = f"{doc_id}_{first_index + i}"
+        chunk_metadata = (
+            metadata.copy(update={"page": pages[i]}) if pages is not None else metadata
+        )
         doc_chunk = DocumentChunk(
             id=chunk_id,
             text=text_chunk,
-            metadata=metadata,
+            metadata=chunk_metadata.copy(
+                update={"chunk_hash": get_chunk_hash(text_chunk, chunk_metadata)}
+            ),
         )
         # Append the chunk object to the list of chunks for this document
         doc_chunks.append(doc_chunk)
@@ -149,7 +388,167 @@ def create_document_chunks(
     return doc_chunks, doc_id
 
 
-def get_document_chunks(
+def get_chunk_hash(text: str, metadata: DocumentChunkMetadata) -> str:
+    """
+    Hash of the chunk text and the metadata it is stored with, so a stored chunk with the same hash can be kept as it is.
+    """
+    return hashlib.sha256(
+        json.dumps(
+            [text, metadata.dict(exclude={"chunk_hash"})], sort_keys=True
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def diff_document_chunks(
+    doc_chunks: List[DocumentChunk], stored: Dict[str, Optional[str]]
+) -> Tuple[List[DocumentChunk], List[str]]:
+    """
+    Compare the chunks of a document with the chunks already stored for it.
+
+    Args:
+        doc_chunks: The new chunks of the document.
+        stored: The stored chunks of the document, as chunk id -> chunk hash (None for chunks stored without a hash).
+
+    Returns:
+        A tuple of (changed_chunks, kept_ids), where changed_chunks are the chunks that have to be embedded and written,
+        and kept_ids are the ids of the stored chunks whose hash matches a new chunk, which are kept as they are.
+        A new chunk reuses the stored chunk with its own id if the hashes match, otherwise any stored chunk with the same hash.
+        A changed chunk whose id belongs to a kept chunk (text was added or removed before it) gets its hash appended to the id.
+    """
+    ids_by_hash: Dict[str, List[str]] = {}
+    for chunk_id, chunk_hash in stored.items():
+        if chunk_hash is not None:
+            ids_by_hash.setdefault(chunk_hash, []).append(chunk_id)
+
+    changed_chunks = []
+    kept_ids = []
+    for chunk in doc_chunks:
+        ids = ids_by_hash.get(chunk.metadata.chunk_hash or "")
+        if not ids:
+            changed_chunks.append(chunk)
+        elif chunk.id in ids:
+            ids.remove(chunk.id)
+            kept_ids.append(chunk.id)
+        else:
+            kept_ids.append(ids.pop(0))
+
+    taken_ids = set(kept_ids)
+    for chunk in changed_chunks:
+        if chunk.id in taken_ids:
+            chunk.id = f"{chunk.id}_{chunk.metadata.chunk_hash[:12]}"
+    return changed_chunks, kept_ids
+
+
+async def iter_document_chunks(
+    documents: List[Union[Document, SegmentedDocument]],
+    chunk_token_size: Optional[int],
+) -> AsyncIterator[Tuple[List[DocumentChunk], str, bool]]:
+    """
+    Create the document chunks of many documents, splitting their texts in parallel on the chunking process pool.
+    At most two documents per worker are being split at a time, so the chunks of the whole request are never held in memory at once.
+    The segments of a SegmentedDocument are split on a thread as they are read, since reading them may wait on extraction,
+    and its chunks are yielded in parts of at most EMBEDDINGS_BATCH_SIZE chunks, so neither its text nor all of its chunks
+    are ever held in memory at once.
+
+    Args:
+        documents: The list of documents to create chunks from.
+        chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+
+    Yields:
+        A (doc_chunks, doc_id, last) tuple per document, or per part of a SegmentedDocument, in the same order as the documents,
+        see create_document_chunks. last is False for all but the last part of a document (the last part of a SegmentedDocument is empty).
+    """
+    executor = get_chunking_executor()
+    parallel = (
+        executor is not None
+        and sum(len(doc.text) for doc in documents if isinstance(doc, Document))
+        >= CHUNKING_MIN_PARALLEL_CHARS
+    )
+
+    # Only the texts are sent to the workers; ids and metadata are assigned here, in document order,
+    # so the chunk ids stay deterministic. Documents chunked in the server process have no future,
+    # and the future of a SegmentedDocument is the first part of its chunks.
+    loop = asyncio.get_running_loop()
+    pending: Deque[
+        Tuple[
+            Union[Document, SegmentedDocument],
+            Optional[asyncio.Future],
+            Optional[Iterator[List[Tuple[str, Optional[int]]]]],
+        ]
+    ] = deque()
+
+    async def next_document_chunks():
+        doc, future, parts = pending.popleft()
+        if future is None:
+            yield (*create_document_chunks(doc, chunk_token_size), True)
+        elif isinstance(doc, Document):
+            yield (
+                *create_document_chunks(doc, chunk_token_size, await future),
+                True,
+            )
+        else:
+            doc = replace(doc, id=doc.id or str(uuid.uuid4()))
+            first_index = 0
+            part = await future
+            while part is not None:
+                # Split the next part while this one is being embedded
+                next_part = loop.run_in_executor(None, next, parts, None)
+                doc_chunks, doc_id = create_document_chunks(
+                    doc,
+                    chunk_token_size,
+                    [text for text, _ in part],
+                    [page for _, page in part],
+                    first_index,
+                )
+                first_index += len(part)
+                yield doc_chunks, doc_id, False
+                part = await next_part
+            yield [], doc.id, True
+
+    for doc in documents:
+        parts = None
+        if isinstance(doc, SegmentedDocument):
+            parts = iter_text_chunk_parts(
+                doc.segments, chunk_token_size, EMBEDDINGS_BATCH_SIZE
+            )
+            future = loop.run_in_executor(None, next, parts, None)
+        elif parallel:
+            future = loop.run_in_executor(
+                executor, get_text_chunks, doc.text, chunk_token_size
+            )
+        else:
+            future = None
+        pending.append((doc, future, parts))
+        if len(pending) >= max(2 * CHUNKING_PROCESSES, 1):
+            async for document_chunks in next_document_chunks():
+                yield document_chunks
+
+    while pending:
+        async for document_chunks in next_document_chunks():
+            yield document_chunks
+
+
+async def create_documents_chunks(
+    documents: List[Union[Document, SegmentedDocument]],
+    chunk_token_size: Optional[int],
+) -> List[Tuple[List[DocumentChunk], str]]:
+    """
+    Create the document chunks of many documents, see iter_document_chunks.
+
+    Returns:
+        A list of (doc_chunks, doc_id) tuples in the same order as the documents.
+    """
+    documents_chunks: List[Tuple[List[DocumentChunk], str]] = []
+    doc_chunks: List[DocumentChunk] = []
+    async for part, doc_id, last in iter_document_chunks(documents, chunk_token_size):
+        doc_chunks.extend(part)
+        if last:
+            documents_chunks.append((doc_chunks, doc_id))
+            doc_chunks = []
+    return documents_chunks
+
+
+async def get_document_chunks(
     documents: List[Document], chunk_token_size: Optional[int]
 ) -> Dict[str, List[DocumentChunk]]:
     """
@@ -169,10 +568,10 @@ def get_document_chunks(
     # Initialize an empty list of all chunks
     all_chunks: List[DocumentChunk] = []
 
-    # Loop over each document and create chunks
-    for doc in documents:
-        doc_chunks, doc_id = create_document_chunks(doc, chunk_token_size)
-
+    # Loop over the chunks of each document
+    for doc_chunks, doc_id in await create_documents_chunks(
+        documents, chunk_token_size
+    ):
         # Append the chunks for this document to the list of all chunks
         all_chunks.extend(doc_chunks)
 
@@ -183,17 +582,9 @@ def get_document_chunks(
     if not all_chunks:
         return {}
 
-    # Get all the embeddings for the document chunks in batches, using get_embeddings
-    embeddings: List[List[float]] = []
-    for i in range(0, len(all_chunks), EMBEDDINGS_BATCH_SIZE):
-        # Get the text of the chunks in the current batch
-        batch_texts = [
-            chunk.text for chunk in all_chunks[i : i + EMBEDDINGS_BATCH_SIZE]
-        ]
-        # Get the embeddings for the batch texts
-        batch_embeddings = get_embeddings(batch_texts)
-        # Append the batch embeddings to the embeddings list
-        embeddings.extend(batch_embeddings)
+    # Get all the embeddings for the document chunks, using get_embeddings
+    # (it splits the texts into batches and requests them concurrently)
+    embeddings = await get_embeddings([chunk.text for chunk in all_chunks])
 
     # Update the document chunk objects with the embeddings
     for i, chunk in enumerate(all_chunks):
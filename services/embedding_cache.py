@@ -0,0 +1,176 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+# 임베딩 캐시 설정
+EMBEDDING_CACHE_MEMORY_SIZE = int(
+    os.environ.get("EMBEDDING_CACHE_MEMORY_SIZE", 10000)
+)  # The number of embeddings kept in memory, about 3 KB each for 768 dimensions
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "EMBEDDING_CACHE_PATH"
+)  # SQLite file for the on-disk tier, disabled when not set
+EMBEDDING_CACHE_DISK_SIZE = int(
+    os.environ.get("EMBEDDING_CACHE_DISK_SIZE", 1000000)
+)  # The number of embeddings kept on disk
+
+
+def get_cache_key(model: str, text: str) -> str:
+    """모델 이름과 텍스트 내용으로 캐시 키(sha256)를 만든다"""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    텍스트 내용으로 주소를 지정하는 2단계 임베딩 캐시.
+    메모리 LRU 계층과 SQLite 디스크 계층으로 구성되며, 각 계층은 크기 제한을 넘으면 가장 오래전에 사용된 항목부터 제거한다.
+    """
+
+    def __init__(
+        self,
+        memory_size: int = EMBEDDING_CACHE_MEMORY_SIZE,
+        path: Optional[str] = EMBEDDING_CACHE_PATH,
+        disk_size: int = EMBEDDING_CACHE_DISK_SIZE,
+    ):
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        # 메모리 계층은 임베딩을 float32 배열로 저장한다. float 객체의 리스트보다 8배 가까이 작고,
+        # Gemini 임베딩은 float32 값이므로 손실이 없다
+        self._memory: "OrderedDict[str, array]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        # 디스크 계층의 행 수, put할 때마다 테이블 전체를 세지 않도록 직접 센다
+        self._disk_count = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, embedding BLOB NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_accessed_at ON embeddings (accessed_at)"
+            )
+            self._conn.commit()
+            (self._disk_count,) = self._conn.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()
+            logger.info(f"Embedding cache on disk at {path}")
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """
+        캐시에 있는 키의 임베딩을 반환한다. 디스크 계층에서 찾은 항목은 메모리 계층으로 올린다.
+        """
+        found: Dict[str, List[float]] = {}
+        missing: List[str] = []
+        with self._lock:
+            for key in keys:
+                embedding = self._memory.get(key)
+                if embedding is None:
+                    missing.append(key)
+                    continue
+                self._memory.move_to_end(key)
+                found[key] = embedding.tolist()
+            self.memory_hits += len(found)
+
+            if missing and self._conn is not None:
+                from_disk = self._get_from_disk(missing)
+                for key, embedding in from_disk.items():
+                    self._put_in_memory(key, embedding)
+                found.update(from_disk)
+                self.disk_hits += len(from_disk)
+
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        """임베딩을 두 계층 모두에 저장한다"""
+        if not items:
+            return
+        with self._lock:
+            for key, embedding in items.items():
+                self._put_in_memory(key, embedding)
+            if self._conn is not None:
+                self._put_on_disk(items)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_size": len(self._memory),
+        }
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _put_in_memory(self, key: str, embedding: List[float]) -> None:
+        self._memory[key] = array("f", embedding)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _get_from_disk(self, keys: List[str]) -> Dict[str, List[float]]:
+        assert self._conn is not None
+        found: Dict[str, List[float]] = {}
+        # SQLite의 바인딩 변수 개수 제한을 넘지 않도록 나누어 조회
+        for i in range(0, len(keys), 500):
+            batch = keys[i : i + 500]
+            rows = self._conn.execute(
+                f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                batch,
+            ).fetchall()
+            for key, blob in rows:
+                found[key] = array("d", blob).tolist()
+        if found:
+            now = time.time()
+            self._conn.executemany(
+                "UPDATE embeddings SET accessed_at = ? WHERE key = ?",
+                [(now, key) for key in found],
+            )
+            self._conn.commit()
+        return found
+
+    def _put_on_disk(self, items: Dict[str, List[float]]) -> None:
+        assert self._conn is not None
+        # 이미 있는 키는 교체되므로 새로 추가되는 행만 센다 (기본 키 인덱스로 조회)
+        keys = list(items)
+        existing = 0
+        for i in range(0, len(keys), 500):
+            batch = keys[i : i + 500]
+            (found,) = self._conn.execute(
+                f"SELECT COUNT(*) FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                batch,
+            ).fetchone()
+            existing += found
+        now = time.time()
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, embedding, accessed_at) VALUES (?, ?, ?)",
+            [
+                (key, array("d", embedding).tobytes(), now)
+                for key, embedding in items.items()
+            ],
+        )
+        self._disk_count += len(keys) - existing
+        if self._disk_count > self.disk_size:
+            # 가장 오래전에 사용된 항목부터 제거
+            cursor = self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY accessed_at LIMIT ?)",
+                (self._disk_count - self.disk_size,),
+            )
+            self._disk_count -= cursor.rowcount
+        self._conn.commit()
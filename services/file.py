@@ -1,7 +1,13 @@
+import asyncio
+import codecs
 import csv
 import os
-from io import BufferedReader
-from typing import Optional
+import shutil
+import tempfile
+import uuid
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import BinaryIO, Deque, Iterator, List, Optional, Tuple, Union
 from PyPDF2 import PdfReader
 from fastapi import UploadFile
 import mimetypes
@@ -9,110 +15,325 @@ from loguru import logger
 import docx2txt
 import csv
 import pptx
-from models.models import Document, DocumentMetadata
+from models.models import DocumentMetadata
+from services.chunks import SegmentedDocument
 import re
 from datetime import datetime
 
+# 파일 업로드 설정
+FILE_UPLOAD_MAX_BYTES = int(
+    os.environ.get("FILE_UPLOAD_MAX_BYTES", 100 * 1024 * 1024)
+)  # The largest file accepted by the upload endpoints
+FILE_EXTRACTION_THREADS = int(
+    os.environ.get("FILE_EXTRACTION_THREADS", 4)
+)  # The number of files parsed at a time, off the event loop
+PDF_EXTRACTION_PROCESSES = int(
+    os.environ.get("PDF_EXTRACTION_PROCESSES", os.cpu_count() or 1)
+)  # The number of worker processes extracting PDF pages, 0 extracts them in the server process
+PDF_PAGES_PER_TASK = int(
+    os.environ.get("PDF_PAGES_PER_TASK", 16)
+)  # The number of consecutive pages a worker extracts at a time
+PDF_PARALLEL_MIN_PAGES = int(
+    os.environ.get("PDF_PARALLEL_MIN_PAGES", 32)
+)  # PDFs with fewer pages than this are extracted in the server process
+
+TEXT_READ_SIZE = 64 * 1024  # 텍스트 파일을 한 번에 읽어 한 조각으로 내보내는 바이트 수
+
+# 텍스트 추출을 실행하는 스레드 풀, 처음 사용할 때 생성
+_extraction_executor: Optional[ThreadPoolExecutor] = None
+# PDF 페이지를 추출하는 프로세스 풀, 처음 사용할 때 생성
+_pdf_executor: Optional[ProcessPoolExecutor] = None
+
+
+class FileTooLargeError(ValueError):
+    """업로드 파일이 FILE_UPLOAD_MAX_BYTES 보다 클 때 발생"""
+
+
+class FileExtractionError(ValueError):
+    """upsert 도중 파일의 텍스트를 추출하다 실패했을 때 발생"""
+
+
+def get_extraction_executor() -> ThreadPoolExecutor:
+    """텍스트 추출에 사용하는 공유 스레드 풀을 반환한다"""
+    global _extraction_executor
+    if _extraction_executor is None:
+        _extraction_executor = ThreadPoolExecutor(max_workers=FILE_EXTRACTION_THREADS)
+    return _extraction_executor
+
+
+def get_pdf_executor() -> Optional[ProcessPoolExecutor]:
+    """PDF 페이지 추출에 사용하는 공유 프로세스 풀을 반환한다. PDF_EXTRACTION_PROCESSES가 0이면 None"""
+    global _pdf_executor
+    if _pdf_executor is None and PDF_EXTRACTION_PROCESSES > 0:
+        _pdf_executor = ProcessPoolExecutor(max_workers=PDF_EXTRACTION_PROCESSES)
+    return _pdf_executor
+
+
+def shutdown_extraction_executor() -> None:
+    global _extraction_executor, _pdf_executor
+    if _extraction_executor is not None:
+        _extraction_executor.shutdown(cancel_futures=True)
+        _extraction_executor = None
+    if _pdf_executor is not None:
+        _pdf_executor.shutdown(cancel_futures=True)
+        _pdf_executor = None
+
 
 async def get_document_from_file(
     file: UploadFile, metadata: DocumentMetadata
-) -> Document:
-    """추출한 텍스트를 기반으로 Document를 반환한다"""
-    extracted_text = await extract_text_from_form_file(file)
-    document = Document(text=extracted_text, metadata=metadata)
+) -> SegmentedDocument:
+    """
+    업로드 파일의 텍스트를 조각 단위로 읽는 SegmentedDocument를 반환한다.
+    텍스트는 청크로 나누는 동안 조금씩 추출되므로 큰 파일도 전체 텍스트를 메모리에 올리지 않는다.
+    PDF의 청크에는 페이지 번호, PPTX의 청크에는 슬라이드 번호가 붙는다.
+    읽을 수 없는 파일은 첫 조각을 읽을 때 바로 예외가 발생하고, 그 뒤의 추출 오류는 upsert 도중 FileExtractionError로 발생한다.
+    문서 ID는 일부만 저장된 문서를 지울 수 있도록 미리 정한다.
+    """
+    mimetype = get_mimetype(file.filename, file.content_type)
+    logger.info(f"Extracting text from {file.filename} ({mimetype})")
+    loop = asyncio.get_running_loop()
+    segments = await loop.run_in_executor(
+        get_extraction_executor(), extract_segments_from_upload, file.file, mimetype
+    )
+    try:
+        first = await loop.run_in_executor(
+            get_extraction_executor(), next, segments, None
+        )
+    except Exception:
+        _close_segments(segments)
+        raise
+    return SegmentedDocument(
+        id=str(uuid.uuid4()),
+        segments=_raising_extraction_errors(first, segments),
+        metadata=metadata,
+    )
+
+
+def _raising_extraction_errors(
+    first: Optional[Tuple[str, Optional[int]]],
+    segments: Iterator[Tuple[str, Optional[int]]],
+) -> Iterator[Tuple[str, Optional[int]]]:
+    """먼저 읽은 첫 조각과 나머지 조각을 반환하고, 추출 오류는 FileExtractionError로 바꾼다"""
+    try:
+        if first is not None:
+            yield first
+        yield from segments
+    except Exception as e:
+        raise FileExtractionError(f"Could not read file: {e}") from e
+    finally:
+        _close_segments(segments)
 
-    return document
+
+def _close_segments(segments: Iterator[Tuple[str, Optional[int]]]) -> None:
+    close = getattr(segments, "close", None)
+    if close is not None:
+        close()
+
+
+def get_mimetype(filename: Optional[str], mimetype: Optional[str] = None) -> str:
+    """
+    업로드할 때 지정된 mimetype을 반환한다.
+    mimetype이 없거나 application/octet-stream 이면 파일 이름의 확장자로 추측한다.
+    """
+    if mimetype and mimetype != "application/octet-stream":
+        return mimetype
+
+    # 확장자를 기반으로 파일의 mimetype을 가져온다
+    guessed, _ = mimetypes.guess_type(filename or "")
+    if guessed:
+        return guessed
+    if filename and filename.endswith(".md"):
+        return "text/markdown"
+    raise ValueError("지원하지 않는 파일 형식입니다.")
 
 
 def extract_text_from_filepath(filepath: str, mimetype: Optional[str] = None) -> str:
     """파일 경로가 지정된 파일의 텍스트 내용을 반환"""
-    print(mimetype)
-    if mimetype is None:
-        # 확장자를 기반으로 파일의 mimetype을 가져온다
-        mimetype, _ = mimetypes.guess_type(filepath)
-
-    if not mimetype:
-        if filepath.endswith(".md"):
-            mimetype = "text/markdown"
-        else:
-            raise Exception("지원하지 않는 파일 형식입니다.")
+    mimetype = get_mimetype(filepath, mimetype)
 
     try:
-        with open(filepath, "rb") as file:
-            extracted_text = extract_text_from_file(file, mimetype)
+        extracted_text = "".join(
+            text for text, _ in iter_file_segments(filepath, mimetype)
+        )
     except Exception as e:
         logger.error(e)
         raise e
     return extracted_text
 
 
-def extract_text_from_file(file: BufferedReader, mimetype: str) -> str:
+def extract_text_from_file(file: BinaryIO, mimetype: str) -> str:
+    """파일 객체의 텍스트 내용을 반환한다. iter_file_segments의 조각을 이어 붙인다"""
+    return "".join(text for text, _ in iter_file_segments(file, mimetype))
+
+
+def iter_file_segments(
+    file: Union[str, BinaryIO], mimetype: str
+) -> Iterator[Tuple[str, Optional[int]]]:
+    """
+    파일을 지금 열고 (읽을 수 없는 파일이나 지원하지 않는 형식이면 바로 예외가 발생한다),
+    텍스트를 페이지, 블록, 문단, 행, 슬라이드 단위의 (text, page) 조각으로 순서대로 반환하는 이터레이터를 반환한다.
+    조각을 이어 붙이면 파일의 텍스트가 된다. page는 PDF의 페이지나 PPTX의 슬라이드 번호 (1부터) 이고, 다른 형식은 None 이다.
+    파일 경로가 주어지면 파일을 열고, 조각을 다 읽으면 닫는다.
+    """
     if mimetype == "application/pdf":
-        # Extract text from pdf using PyPDF2
-        reader = PdfReader(file)
-        extracted_text = " ".join([page.extract_text() for page in reader.pages])
-    elif mimetype == "text/plain" or mimetype == "text/markdown":
-        # 텍스트 파일로 부터 텍스트를 읽기
-        extracted_text = file.read().decode("utf-8")
+        # Extract text from pdf using PyPDF2, 파일 경로가 있으면 페이지를 병렬로 추출한다
+        return iter_pdf_pages(file)
+    if isinstance(file, str):
+        opened = open(file, "rb")
+        try:
+            return _closing(iter_file_segments(opened, mimetype), opened)
+        except Exception:
+            opened.close()
+            raise
+
+    if mimetype == "text/plain" or mimetype == "text/markdown":
+        return _iter_text_blocks(file)
     elif (
         mimetype
         == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
     ):
-        # Extract text from docx using docx2txt
-        extracted_text = docx2txt.process(file)
+        # Extract text from docx using docx2txt. 문서를 한 번에 파싱하므로 문단 단위로만 나눈다
+        return _iter_paragraphs(docx2txt.process(file))
     elif mimetype == "text/csv":
-        # Extract text from csv using csv module
-        extracted_text = ""
-        decoded_buffer = (line.decode("utf-8") for line in file)
-        reader = csv.reader(decoded_buffer)
-        for row in reader:
-            extracted_text += " ".join(row) + "\n"
+        return _iter_csv_rows(file)
     elif (
         mimetype
         == "application/vnd.openxmlformats-officedocument.presentationml.presentation"
     ):
         # Extract text from pptx using python-pptx
-        extracted_text = ""
-        presentation = pptx.Presentation(file)
-        for slide in presentation.slides:
-            for shape in slide.shapes:
-                if shape.has_text_frame:
-                    for paragraph in shape.text_frame.paragraphs:
-                        for run in paragraph.runs:
-                            extracted_text += run.text + " "
-                    extracted_text += "\n"
+        return _iter_pptx_slides(pptx.Presentation(file))
     else:
         # 지원하지 않는 파일 형식
         raise ValueError("Unsupported file type: {}".format(mimetype))
-    return extracted_text
 
 
-# mimetype에 따라 파일에서 텍스트 추출
-async def extract_text_from_form_file(file: UploadFile):
-    """파일의 텍스트 내용을 반환"""
-    # 업로드 파일 개체에서 파일 내용 가져오기
-    mimetype = file.content_type
-    logger.info(f"mimetype: {mimetype}")
-    logger.info(f"file.file: {file.file}")
-    logger.info("file: ", file)
+def _iter_text_blocks(file: BinaryIO) -> Iterator[Tuple[str, Optional[int]]]:
+    # 텍스트 파일로 부터 TEXT_READ_SIZE 바이트씩 텍스트를 읽기.
+    # 블록 경계에서 잘린 UTF-8 문자는 다음 블록과 함께 디코딩된다
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    while block := file.read(TEXT_READ_SIZE):
+        yield decoder.decode(block), None
+    yield decoder.decode(b"", final=True), None
+
+
+def _iter_paragraphs(text: str) -> Iterator[Tuple[str, Optional[int]]]:
+    for paragraph in re.finditer(r"[^\n]*\n|[^\n]+", text):
+        yield paragraph.group(), None
+
+
+def _iter_csv_rows(file: BinaryIO) -> Iterator[Tuple[str, Optional[int]]]:
+    # Extract text from csv using csv module
+    decoded_buffer = (line.decode("utf-8") for line in file)
+    reader = csv.reader(decoded_buffer)
+    for row in reader:
+        yield " ".join(row) + "\n", None
 
-    file_stream = await file.read()
-    temp_file_path = "/tmp/temp_file"
 
-    # 파일을 임시 위치에 쓰기
-    with open(temp_file_path, "wb") as f:
-        f.write(file_stream)
+def _iter_pptx_slides(presentation) -> Iterator[Tuple[str, Optional[int]]]:
+    # 슬라이드 하나가 한 조각이고, 슬라이드 번호가 페이지 번호가 된다
+    for number, slide in enumerate(presentation.slides, start=1):
+        texts = []
+        for shape in slide.shapes:
+            if shape.has_text_frame:
+                for paragraph in shape.text_frame.paragraphs:
+                    for run in paragraph.runs:
+                        texts.append(run.text + " ")
+                texts.append("\n")
+        yield "".join(texts), number
+
+
+def _closing(
+    segments: Iterator[Tuple[str, Optional[int]]], file: BinaryIO
+) -> Iterator[Tuple[str, Optional[int]]]:
+    """조각을 다 읽거나 이터레이터를 닫으면 파일을 닫는다"""
     try:
-        extracted_text = extract_text_from_filepath(temp_file_path, mimetype)
-    except Exception as e:
-        logger.error(e)
-        os.remove(temp_file_path)
-        raise e
+        yield from segments
+    finally:
+        file.close()
 
-    # 임시 파일 제거
-    os.remove(temp_file_path)
 
-    return extracted_text
+def extract_segments_from_upload(
+    file: BinaryIO, mimetype: str
+) -> Iterator[Tuple[str, Optional[int]]]:
+    """
+    크기를 확인한 뒤 업로드 파일 객체의 텍스트 조각을 반환한다 (iter_file_segments).
+    PDF는 워커 프로세스가 경로로 열 수 있도록 이름 있는 임시 파일에 복사하고,
+    임시 파일은 페이지를 다 읽거나 반환된 이터레이터가 사라질 때 지워진다.
+    """
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    if size > FILE_UPLOAD_MAX_BYTES:
+        raise FileTooLargeError(
+            f"File is {size} bytes, the limit is {FILE_UPLOAD_MAX_BYTES} bytes"
+        )
+    file.seek(0)
+    if mimetype != "application/pdf":
+        return iter_file_segments(file, mimetype)
+
+    temp_file = tempfile.NamedTemporaryFile(suffix=".pdf")
+    try:
+        shutil.copyfileobj(file, temp_file)
+        temp_file.flush()
+        temp_file.seek(0)
+        return _closing(iter_pdf_pages(temp_file), temp_file)
+    except Exception:
+        temp_file.close()
+        raise
+
+
+def iter_pdf_pages(file: Union[str, BinaryIO]) -> Iterator[Tuple[str, int]]:
+    """
+    PDF를 지금 열고 (읽을 수 없으면 바로 예외가 발생한다), 페이지의 (text, page) 를 순서대로 반환하는 이터레이터를 반환한다.
+    page는 1부터 시작하고, 예전처럼 페이지 사이에 공백을 넣어 두 번째 페이지부터 text 앞에 공백이 붙는다.
+    경로가 있는 파일의 페이지가 PDF_PARALLEL_MIN_PAGES 개 이상이면 PDF_PAGES_PER_TASK 페이지씩 프로세스 풀에서 병렬로 추출한다.
+    """
+    reader = PdfReader(file)
+    return _iter_pdf_pages(reader, file)
+
+
+def _iter_pdf_pages(
+    reader: PdfReader, file: Union[str, BinaryIO]
+) -> Iterator[Tuple[str, int]]:
+    path = file if isinstance(file, str) else getattr(file, "name", None)
+    num_pages = len(reader.pages)
+    executor = get_pdf_executor()
+    if (
+        executor is None
+        or num_pages < PDF_PARALLEL_MIN_PAGES
+        or not isinstance(path, str)
+    ):
+        texts: Iterator[str] = (page.extract_text() for page in reader.pages)
+    else:
+        texts = _extract_pdf_pages_in_parallel(executor, path, num_pages)
+    for i, text in enumerate(texts):
+        yield (text if i == 0 else " " + text), i + 1
+
+
+def _extract_pdf_pages_in_parallel(
+    executor: ProcessPoolExecutor, path: str, num_pages: int
+) -> Iterator[str]:
+    """
+    페이지 범위를 워커 프로세스에 나눠 추출하고 페이지 텍스트를 순서대로 반환한다.
+    워커마다 두 범위까지만 미리 추출해서, 추출한 페이지가 청크로 나누는 것보다 많이 쌓이지 않는다.
+    """
+    pending: Deque[Future] = deque()
+    try:
+        for start in range(0, num_pages, PDF_PAGES_PER_TASK):
+            end = min(start + PDF_PAGES_PER_TASK, num_pages)
+            pending.append(executor.submit(extract_pdf_page_range, path, start, end))
+            if len(pending) >= 2 * PDF_EXTRACTION_PROCESSES:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def extract_pdf_page_range(path: str, start: int, end: int) -> List[str]:
+    """PDF 파일의 start 부터 end 전까지 페이지의 텍스트를 반환한다. 워커 프로세스에서 실행된다"""
+    reader = PdfReader(path)
+    return [reader.pages[i].extract_text() for i in range(start, end)]
 
 
 def extract_messages(input_file, target_people):
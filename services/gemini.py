@@ -1,13 +1,71 @@
-from typing import List
+from typing import Dict, List, Optional
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
+import asyncio
 import os
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 
+from services.embedding_cache import EmbeddingCache, get_cache_key
+
+# 임베딩 모델 설정
+EMBEDDING_MODEL = (
+    os.environ.get("GOOGLE_EMBEDDINGMODEL_DEPLOYMENTID") or "models/embedding-001"
+)
+EMBEDDINGS_BATCH_SIZE = int(
+    os.environ.get("GOOGLE_EMBEDDING_BATCH_SIZE", 128)
+)  # The number of embeddings to request at a time
+EMBEDDINGS_CONCURRENCY = int(
+    os.environ.get("GOOGLE_EMBEDDING_CONCURRENCY", 4)
+)  # The maximum number of embedding requests in flight at once
+EMBEDDING_DIMENSION = os.environ.get(
+    "GOOGLE_EMBEDDING_DIMENSION"
+)  # The embedding dimension, probed from the model when not set
+
+# 프로세스 전체에서 공유하는 임베딩 클라이언트와 동시 요청 제한
+_client: Optional[GoogleGenerativeAIEmbeddings] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+_cache: Optional[EmbeddingCache] = None
+_dimension: Optional[int] = None
+
+
+def get_embedding_client() -> GoogleGenerativeAIEmbeddings:
+    """
+    공유 임베딩 클라이언트를 반환합니다. 처음 호출될 때 한 번만 생성되며 이후 연결을 재사용합니다.
+    """
+    global _client
+    if _client is None:
+        _client = GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL)
+    return _client
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """
+    공유 임베딩 캐시를 반환합니다. 키는 (임베딩 모델, 텍스트 해시)입니다.
+    """
+    global _cache
+    if _cache is None:
+        _cache = EmbeddingCache()
+    return _cache
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(EMBEDDINGS_CONCURRENCY)
+    return _semaphore
+
 
 @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(3))
-def get_embeddings(texts: List[str]) -> List[List[float]]:
+async def _embed_batch(texts: List[str]) -> List[List[float]]:
+    # 동시 요청 수를 EMBEDDINGS_CONCURRENCY로 제한하며 한 배치를 임베딩합니다.
+    # 재시도 대기 시간에는 세마포어를 잡고 있지 않습니다.
+    async with _get_semaphore():
+        return await get_embedding_client().aembed_documents(texts)
+
+
+async def get_embeddings(texts: List[str]) -> List[List[float]]:
     """
     google bard models/embedding-001 모델을 사용하여 텍스트를 임베딩합니다.
+    임베딩 캐시에 없는 텍스트만 EMBEDDINGS_BATCH_SIZE 크기의 배치로 나누어 동시에 요청하고, 입력 순서대로 결과를 반환합니다.
 
     Args:
         텍스트: 임베드할 텍스트 목록입니다.
@@ -18,19 +76,49 @@ def get_embeddings(texts: List[str]) -> List[List[float]]:
     Raises:
         예외: gemini-pro API 호출이 실패한 경우.
     """
-    # gemini-pro API를 호출하여 임베딩 가져오기
-    deployment = os.environ.get("GOOGLE_EMBEDDINGMODEL_DEPLOYMENTID")
-    response = {}
-    if deployment == None:
-        embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-        response = embeddings.embed_documents(texts=texts)
-    else:
-        embeddings = GoogleGenerativeAIEmbeddings(model=deployment)
-        response = embeddings.embed_documents(texts=texts)
-
-    # # 응답에서 임베딩 데이터 추출하기
-    # data = response["data"]
-
-    # # 임베딩을 플로트 리스트 목록으로 반환합니다.
-    # return [result["embedding"] for result in data]
-    return response
+    if not texts:
+        return []
+
+    cache = get_embedding_cache()
+    keys = [get_cache_key(EMBEDDING_MODEL, text) for text in texts]
+    # 디스크 계층 조회는 이벤트 루프를 막지 않도록 스레드에서 실행
+    cached = await asyncio.to_thread(cache.get_many, keys)
+
+    # 캐시에 없는 텍스트는 중복을 제거하여 한 번씩만 요청
+    missing: Dict[str, str] = {}
+    for key, text in zip(keys, texts):
+        if key not in cached:
+            missing.setdefault(key, text)
+
+    if missing:
+        missing_keys = list(missing.keys())
+        missing_texts = list(missing.values())
+        batches = [
+            missing_texts[i : i + EMBEDDINGS_BATCH_SIZE]
+            for i in range(0, len(missing_texts), EMBEDDINGS_BATCH_SIZE)
+        ]
+        responses = await asyncio.gather(*[_embed_batch(batch) for batch in batches])
+        embedded = dict(
+            zip(
+                missing_keys,
+                [embedding for response in responses for embedding in response],
+            )
+        )
+        await asyncio.to_thread(cache.put_many, embedded)
+        cached.update(embedded)
+
+    return [cached[key] for key in keys]
+
+
+async def get_embedding_dimension() -> int:
+    """
+    임베딩 모델의 차원을 반환합니다. GOOGLE_EMBEDDING_DIMENSION이 없으면 처음 한 번 텍스트를 임베딩하여 확인합니다.
+    """
+    global _dimension
+    if _dimension is None:
+        if EMBEDDING_DIMENSION:
+            _dimension = int(EMBEDDING_DIMENSION)
+        else:
+            (embedding,) = await get_embeddings(["embedding dimension probe"])
+            _dimension = len(embedding)
+    return _dimension
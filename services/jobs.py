@@ -0,0 +1,333 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import uuid
+from typing import BinaryIO, Dict, List, Optional
+
+from fastapi import UploadFile
+from loguru import logger
+
+from datastore.datastore import DataStore, UpsertError
+from models.api import JobResponse
+from models.models import Document, DocumentMetadata, JobStatus
+from services.chunks import SegmentedDocument
+from services.file import (
+    FILE_UPLOAD_MAX_BYTES,
+    FileTooLargeError,
+    get_extraction_executor,
+    get_mimetype,
+    iter_file_segments,
+)
+
+# 백그라운드 upsert 작업 설정
+JOBS_DIR = os.environ.get(
+    "JOBS_DIR", ".jobs"
+)  # Directory holding the job database and the uploaded files of pending jobs
+JOBS_WORKERS = int(
+    os.environ.get("JOBS_WORKERS", 2)
+)  # The number of jobs processed at a time
+JOBS_CHECKPOINT_DOCUMENTS = int(
+    os.environ.get("JOBS_CHECKPOINT_DOCUMENTS", 100)
+)  # The number of documents upserted between two saved checkpoints of a job
+UPLOAD_READ_SIZE = 1024 * 1024  # 업로드 파일을 디스크에 쓸 때 한 번에 읽는 바이트 수
+
+
+class JobQueue:
+    """
+    upsert 작업을 로컬 SQLite 데이터베이스에 저장하고 백그라운드 워커 풀로 처리하는 큐.
+    서버가 재시작되면 대기 중이거나 실행 중이던 작업을 마지막 체크포인트부터 다시 처리한다.
+    """
+
+    def __init__(self, path: str = JOBS_DIR, workers: int = JOBS_WORKERS):
+        self.path = path
+        self.files_path = os.path.join(path, "files")
+        self.workers = workers
+        os.makedirs(self.files_path, exist_ok=True)
+
+        self._conn = sqlite3.connect(
+            os.path.join(path, "jobs.sqlite3"), check_same_thread=False
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT NOT NULL, kind TEXT NOT NULL, payload TEXT NOT NULL, "
+            "chunks_embedded INTEGER NOT NULL DEFAULT 0, chunks_written INTEGER NOT NULL DEFAULT 0, "
+            "ids TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, "
+            "documents_done INTEGER NOT NULL DEFAULT 0, chunks_reused INTEGER NOT NULL DEFAULT 0, "
+            "failures TEXT)"
+        )
+        # 이전 버전에서 만든 데이터베이스에 체크포인트, 재사용 청크 수, 실패한 문서 컬럼 추가
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        for column, definition in [
+            ("documents_done", "INTEGER NOT NULL DEFAULT 0"),
+            ("chunks_reused", "INTEGER NOT NULL DEFAULT 0"),
+            ("failures", "TEXT"),
+        ]:
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+        self._conn.commit()
+
+        # 실행 중인 작업의 진행 상황은 메모리에 기록하고, 체크포인트와 작업이 끝날 때 저장한다
+        self._progress: Dict[str, Dict[str, int]] = {}
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+        self._datastore: Optional[DataStore] = None
+
+    async def start(self, datastore: DataStore) -> None:
+        """워커를 시작하고, 이전 실행에서 끝나지 않은 작업을 다시 큐에 넣는다"""
+        self._datastore = datastore
+        self._conn.execute(
+            "UPDATE jobs SET status = ? WHERE status = ?",
+            (JobStatus.queued.value, JobStatus.running.value),
+        )
+        self._conn.commit()
+        pending = self._conn.execute(
+            "SELECT id FROM jobs WHERE status = ? ORDER BY created_at",
+            (JobStatus.queued.value,),
+        ).fetchall()
+        for (job_id,) in pending:
+            self._queue.put_nowait(job_id)
+        if pending:
+            logger.info(f"Resuming {len(pending)} upsert jobs")
+
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._conn.close()
+
+    def submit_documents(self, documents: List[Document]) -> str:
+        """문서 목록을 upsert하는 작업을 등록하고 작업 ID를 반환한다"""
+        # 재시작 후 다시 처리해도 같은 문서를 덮어쓰도록 문서 ID를 미리 정한다
+        for document in documents:
+            document.id = document.id or str(uuid.uuid4())
+        payload = json.dumps([json.loads(document.json()) for document in documents])
+        return self._submit("documents", payload)
+
+    async def submit_file(self, file: UploadFile, metadata: DocumentMetadata) -> str:
+        """
+        업로드 파일을 작업 디렉토리에 저장하고, 파일을 upsert하는 작업을 등록한 뒤 작업 ID를 반환한다.
+        지원하지 않는 파일 형식이면 ValueError, 파일이 FILE_UPLOAD_MAX_BYTES 보다 크면 FileTooLargeError를 발생시킨다.
+        """
+        mimetype = get_mimetype(file.filename, file.content_type)
+        file_path = os.path.join(self.files_path, str(uuid.uuid4()))
+        # 디스크에 쓰는 동안 이벤트 루프를 막지 않도록 스레드에서 복사한다
+        await asyncio.to_thread(self._save_upload, file.file, file_path)
+        payload = json.dumps(
+            {
+                "path": file_path,
+                "document_id": str(uuid.uuid4()),
+                "mimetype": mimetype,
+                "metadata": json.loads(metadata.json()),
+            }
+        )
+        return self._submit("file", payload)
+
+    def _save_upload(self, file: BinaryIO, file_path: str) -> None:
+        """업로드 파일 객체를 file_path에 복사한다. FILE_UPLOAD_MAX_BYTES 보다 크면 파일을 지우고 FileTooLargeError를 발생시킨다"""
+        file.seek(0)
+        size = 0
+        with open(file_path, "wb") as f:
+            while data := file.read(UPLOAD_READ_SIZE):
+                size += len(data)
+                if size > FILE_UPLOAD_MAX_BYTES:
+                    break
+                f.write(data)
+        if size > FILE_UPLOAD_MAX_BYTES:
+            os.remove(file_path)
+            raise FileTooLargeError(
+                f"File is larger than {FILE_UPLOAD_MAX_BYTES} bytes"
+            )
+
+    def get(self, job_id: str) -> Optional[JobResponse]:
+        row = self._conn.execute(
+            "SELECT id, status, chunks_embedded, chunks_written, chunks_reused, ids, error "
+            "FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        id, status, chunks_embedded, chunks_written, chunks_reused, ids, error = row
+        progress = self._progress.get(job_id, {})
+        return JobResponse(
+            id=id,
+            status=status,
+            chunks_embedded=progress.get("embedded", chunks_embedded),
+            chunks_written=progress.get("written", chunks_written),
+            chunks_reused=progress.get("reused", chunks_reused),
+            ids=json.loads(ids) if ids else [],
+            error=error,
+        )
+
+    def _submit(self, kind: str, payload: str) -> str:
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        self._conn.execute(
+            "INSERT INTO jobs (id, status, kind, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, JobStatus.queued.value, kind, payload, now, now),
+        )
+        self._conn.commit()
+        self._queue.put_nowait(job_id)
+        logger.info(f"Queued {kind} upsert job {job_id}")
+        return job_id
+
+    def _update(self, job_id: str, **fields) -> None:
+        fields["updated_at"] = time.time()
+        self._conn.execute(
+            f"UPDATE jobs SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+            (*fields.values(), job_id),
+        )
+        self._conn.commit()
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except asyncio.CancelledError:
+                raise
+            except UpsertError as e:
+                # 일부 문서만 실패한 경우 저장된 문서 ID도 함께 기록
+                logger.error(f"Upsert job {job_id} failed: {e}")
+                self._update(
+                    job_id,
+                    status=JobStatus.failed.value,
+                    ids=json.dumps(e.ids),
+                    error=str(e),
+                    **self._saved_progress(job_id),
+                )
+            except Exception as e:
+                logger.error(f"Upsert job {job_id} failed: {e}")
+                self._update(
+                    job_id,
+                    status=JobStatus.failed.value,
+                    error=str(e),
+                    **self._saved_progress(job_id),
+                )
+            finally:
+                self._progress.pop(job_id, None)
+
+    async def _run(self, job_id: str) -> None:
+        assert self._datastore is not None
+        row = self._conn.execute(
+            "SELECT kind, payload, chunks_embedded, chunks_written, chunks_reused, ids, documents_done, "
+            "failures FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        (
+            kind,
+            payload,
+            chunks_embedded,
+            chunks_written,
+            chunks_reused,
+            saved_ids,
+            documents_done,
+            saved_failures,
+        ) = row
+        self._update(job_id, status=JobStatus.running.value)
+        progress = self._progress[job_id] = {
+            "embedded": chunks_embedded,
+            "written": chunks_written,
+            "reused": chunks_reused,
+        }
+
+        def on_progress(stage: str, count: int) -> None:
+            progress[stage] += count
+
+        if kind == "file":
+            ids = await self._run_file(json.loads(payload), on_progress)
+        else:
+            ids = await self._run_documents(
+                job_id,
+                json.loads(payload),
+                json.loads(saved_ids) if saved_ids else [],
+                documents_done,
+                json.loads(saved_failures) if saved_failures else {},
+                on_progress,
+            )
+
+        self._update(
+            job_id,
+            status=JobStatus.succeeded.value,
+            ids=json.dumps(ids),
+            **self._saved_progress(job_id),
+        )
+        logger.info(f"Upsert job {job_id} succeeded")
+
+    async def _run_file(self, file: Dict, on_progress) -> List[str]:
+        assert self._datastore is not None
+        try:
+            # 텍스트를 추출하는 대로 청크로 나눈다
+            segments = await asyncio.get_running_loop().run_in_executor(
+                get_extraction_executor(),
+                iter_file_segments,
+                file["path"],
+                file["mimetype"],
+            )
+            document = SegmentedDocument(
+                id=file["document_id"],
+                segments=segments,
+                metadata=DocumentMetadata.parse_obj(file["metadata"]),
+            )
+            ids = await self._datastore.upsert([document], on_progress=on_progress)
+        except asyncio.CancelledError:
+            # 서버 종료로 취소된 작업은 재시작 후 다시 처리하므로 업로드 파일을 남긴다
+            raise
+        except Exception:
+            # 실패한 작업은 다시 실행하지 않으므로 업로드 파일을 지운다
+            os.remove(file["path"])
+            raise
+        os.remove(file["path"])
+        return ids
+
+    async def _run_documents(
+        self,
+        job_id: str,
+        documents: List[Dict],
+        ids: List[str],
+        documents_done: int,
+        failures: Dict[str, str],
+        on_progress,
+    ) -> List[str]:
+        """
+        문서를 JOBS_CHECKPOINT_DOCUMENTS 개씩 upsert하고, 묶음이 끝날 때마다 진행 위치와 실패한 문서를 저장한다.
+        재시작 후에는 마지막으로 저장한 위치부터 이어서 처리하고, 이전에 실패한 문서도 마지막에 보고한다.
+        """
+        assert self._datastore is not None
+        if documents_done:
+            logger.info(
+                f"Resuming upsert job {job_id} at document {documents_done}/{len(documents)}"
+            )
+        for start in range(documents_done, len(documents), JOBS_CHECKPOINT_DOCUMENTS):
+            batch = [
+                Document.parse_obj(document)
+                for document in documents[start : start + JOBS_CHECKPOINT_DOCUMENTS]
+            ]
+            try:
+                ids += await self._datastore.upsert(batch, on_progress=on_progress)
+            except UpsertError as e:
+                # 다른 묶음은 계속 처리하고 실패한 문서는 마지막에 보고한다
+                ids += e.ids
+                failures.update(e.failures)
+            self._update(
+                job_id,
+                documents_done=start + len(batch),
+                ids=json.dumps(ids),
+                failures=json.dumps(failures),
+                **self._saved_progress(job_id),
+            )
+
+        if failures:
+            raise UpsertError(failures, ids=ids)
+        return ids
+
+    def _saved_progress(self, job_id: str) -> Dict[str, int]:
+        progress = self._progress.get(job_id, {})
+        return {
+            "chunks_embedded": progress.get("embedded", 0),
+            "chunks_written": progress.get("written", 0),
+            "chunks_reused": progress.get("reused", 0),
+        }
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import os
+import uuid
+from typing import AsyncIterator, List, Optional, Tuple
+
+from loguru import logger
+from pydantic import ValidationError
+
+from datastore.datastore import DataStore, UpsertError
+from models.models import Document
+
+NDJSON_BATCH_SIZE = int(
+    os.environ.get("NDJSON_BATCH_SIZE", 100)
+)  # The number of documents upserted at a time from a stream
+NDJSON_MAX_LINE_BYTES = int(
+    os.environ.get("NDJSON_MAX_LINE_BYTES", 64 * 1024 * 1024)
+)  # The maximum size of a single document line
+
+
+async def iter_ndjson_lines(
+    stream: AsyncIterator[bytes],
+) -> AsyncIterator[Tuple[int, bytes]]:
+    """
+    요청 본문 스트림을 줄 단위로 나누어 (줄 번호, 줄) 을 반환한다. 빈 줄은 건너뛴다.
+    한 줄이 NDJSON_MAX_LINE_BYTES 보다 길면 ValueError를 발생시킨다.
+    """
+    buffer = bytearray()
+    line_number = 0
+    async for data in stream:
+        buffer.extend(data)
+        start = 0
+        while (end := buffer.find(b"\n", start)) != -1:
+            line_number += 1
+            line = bytes(buffer[start:end]).strip()
+            if line:
+                yield line_number, line
+            start = end + 1
+        del buffer[:start]
+        if len(buffer) > NDJSON_MAX_LINE_BYTES:
+            raise ValueError(
+                f"Line {line_number + 1} is longer than {NDJSON_MAX_LINE_BYTES} bytes"
+            )
+
+    line = bytes(buffer).strip()
+    if line:
+        yield line_number + 1, line
+
+
+async def upsert_ndjson_stream(
+    datastore: DataStore, stream: AsyncIterator[bytes]
+) -> AsyncIterator[str]:
+    """
+    줄마다 Document JSON이 하나씩 있는 스트림을 읽어 NDJSON_BATCH_SIZE 개씩 upsert한다.
+    한 배치를 upsert하는 동안 다음 배치를 읽으며, 메모리에는 최대 두 배치만 유지한다.
+    문서마다 {"line": n, "id": ...} 또는 {"line": n, "error": ...} 줄을 반환한다.
+    """
+    batch: List[Tuple[int, Document]] = []
+    pending: Optional[Tuple[List[Tuple[int, Document]], asyncio.Task]] = None
+
+    async def flush() -> AsyncIterator[str]:
+        # 이전 배치의 upsert가 끝나기를 기다린 뒤 결과를 반환한다
+        nonlocal pending
+        if pending is None:
+            return
+        documents, task = pending
+        pending = None
+        try:
+            await task
+            for line_number, document in documents:
+                yield json.dumps({"line": line_number, "id": document.id}) + "\n"
+        except UpsertError as e:
+            logger.error(e)
+            for line_number, document in documents:
+                if document.id in e.failures:
+                    result = {"line": line_number, "error": e.failures[document.id]}
+                else:
+                    result = {"line": line_number, "id": document.id}
+                yield json.dumps(result) + "\n"
+        except Exception as e:
+            logger.error(e)
+            for line_number, _ in documents:
+                yield json.dumps({"line": line_number, "error": str(e)}) + "\n"
+
+    async def start(documents: List[Tuple[int, Document]]) -> AsyncIterator[str]:
+        nonlocal pending
+        async for result in flush():
+            yield result
+        pending = (
+            documents,
+            asyncio.create_task(
+                datastore.upsert([document for _, document in documents])
+            ),
+        )
+
+    try:
+        async for line_number, line in iter_ndjson_lines(stream):
+            try:
+                document = Document.parse_raw(line)
+            except ValidationError as e:
+                yield json.dumps({"line": line_number, "error": str(e)}) + "\n"
+                continue
+            # 응답에 ID를 돌려줄 수 있도록 upsert 전에 문서 ID를 정한다
+            document.id = document.id or str(uuid.uuid4())
+            batch.append((line_number, document))
+            if len(batch) >= NDJSON_BATCH_SIZE:
+                async for result in start(batch):
+                    yield result
+                batch = []
+
+        if batch:
+            async for result in start(batch):
+                yield result
+        async for result in flush():
+            yield result
+    except ValueError as e:
+        # 너무 긴 줄: 진행 중인 배치를 마무리하고 스트림을 멈춘다
+        async for result in flush():
+            yield result
+        yield json.dumps({"error": str(e)}) + "\n"
+    finally:
+        if pending is not None:
+            pending[1].cancel()
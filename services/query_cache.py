@@ -0,0 +1,82 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from models.models import Query, QueryResult
+
+# 쿼리 결과 캐시 설정
+QUERY_CACHE_SIZE = int(
+    os.environ.get("QUERY_CACHE_SIZE", 1000)
+)  # The number of query results kept in memory, 0 disables the cache
+QUERY_CACHE_TTL = float(
+    os.environ.get("QUERY_CACHE_TTL", 300)
+)  # Seconds a cached query result stays valid
+
+
+def get_query_cache_key(query: Query) -> str:
+    """쿼리 텍스트, 정규화한 필터, top_k, 검색 모드로 캐시 키를 만든다"""
+    filter = (
+        {
+            field: value
+            for field, value in query.filter.dict().items()
+            if value is not None
+        }
+        if query.filter is not None
+        else {}
+    )
+    return json.dumps([query.query, filter, query.top_k, query.mode], sort_keys=True)
+
+
+class QueryCache:
+    """
+    QueryResult의 TTL + LRU 캐시.
+    upsert/delete가 성공하면 세대(generation) 번호를 올려 전체를 무효화한다.
+    """
+
+    def __init__(self, size: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.generation = 0
+        self._entries: "OrderedDict[str, Tuple[float, QueryResult]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[QueryResult]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, result = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key: str, result: QueryResult, generation: int) -> None:
+        """
+        결과를 저장한다. 조회를 시작한 뒤에 무효화가 일어났다면 (generation이 바뀌었다면) 오래된 결과이므로 저장하지 않는다.
+        """
+        if self.size <= 0 or generation != self.generation:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self) -> None:
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "generation": self.generation,
+        }
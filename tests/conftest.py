@@ -0,0 +1,42 @@
+import hashlib
+from typing import List
+
+import pytest
+
+import datastore.datastore
+import services.chunks
+
+DIMENSION = 8
+
+
+def fake_embedding(text: str) -> List[float]:
+    """A deterministic embedding of the text, so equal texts get equal vectors."""
+    digest = hashlib.sha256(text.encode("utf-8")).digest()
+    return [byte / 255 - 0.5 for byte in digest[:DIMENSION]]
+
+
+@pytest.fixture
+def dimension() -> int:
+    """The dimension of the fake embeddings, for datastores that are created with one."""
+    return DIMENSION
+
+
+@pytest.fixture
+def embedded(monkeypatch) -> List[str]:
+    """Replaces the embedding model with fake_embedding, and returns the list of texts it embedded."""
+    texts: List[str] = []
+
+    async def get_embeddings(batch: List[str]) -> List[List[float]]:
+        texts.extend(batch)
+        return [fake_embedding(text) for text in batch]
+
+    monkeypatch.setattr(datastore.datastore, "get_embeddings", get_embeddings)
+    return texts
+
+
+@pytest.fixture
+def small_batches(monkeypatch) -> int:
+    """Embeds and writes chunks in batches of 4, so a few documents make several batches."""
+    monkeypatch.setattr(datastore.datastore, "EMBEDDINGS_BATCH_SIZE", 4)
+    monkeypatch.setattr(services.chunks, "EMBEDDINGS_BATCH_SIZE", 4)
+    return 4
@@ -0,0 +1,355 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+import pytest
+
+pytest.importorskip("elasticsearch")
+
+from datastore.datastore import UpsertError
+from datastore.providers import elasticsearch_datastore
+from datastore.providers.elasticsearch_datastore import (
+    FILTER_FIELDS,
+    ElasticsearchDataStore,
+    get_filter_fields,
+)
+from models.models import DocumentChunk, DocumentChunkMetadata, DocumentMetadataFilter
+
+
+@pytest.fixture
+def store(monkeypatch) -> ElasticsearchDataStore:
+    """A datastore whose bulk requests are scripted, so it never connects to Elasticsearch."""
+
+    async def sleep(seconds):
+        pass
+
+    # no backoff between bulk retries
+    monkeypatch.setattr(elasticsearch_datastore.asyncio, "sleep", sleep)
+    return ElasticsearchDataStore(index_name="test")
+
+
+def make_chunks(*doc_ids: str) -> Dict[str, List[DocumentChunk]]:
+    return {
+        doc_id: [
+            DocumentChunk(
+                id=f"{doc_id}_{i}",
+                text=f"{doc_id} chunk {i}",
+                metadata=DocumentChunkMetadata(document_id=doc_id),
+                embedding=[0.1] * 4,
+            )
+            for i in range(2)
+        ]
+        for doc_id in doc_ids
+    }
+
+
+def script_bulk_index(
+    store: ElasticsearchDataStore, attempts: List[Dict[str, Tuple[int, str]]]
+) -> List[List[str]]:
+    """Makes each bulk attempt fail with the next failures of attempts, and returns the chunk ids sent on each attempt."""
+    sent: List[List[str]] = []
+
+    async def bulk_index(chunks: List[DocumentChunk]) -> Dict[str, Tuple[int, str]]:
+        sent.append([chunk.id for chunk in chunks])
+        failures = attempts[len(sent) - 1] if len(sent) <= len(attempts) else {}
+        return {
+            chunk_id: failure
+            for chunk_id, failure in failures.items()
+            if chunk_id in sent[-1]
+        }
+
+    store._bulk_index = bulk_index
+    return sent
+
+
+async def test_upsert_without_failures(store):
+    sent = script_bulk_index(store, [])
+    assert await store._upsert(make_chunks("a", "b")) == ["a", "b"]
+    assert sent == [["a_0", "a_1", "b_0", "b_1"]]
+
+
+async def test_upsert_retries_retryable_failures(store):
+    sent = script_bulk_index(store, [{"b_1": (429, "rejected")}])
+    assert await store._upsert(make_chunks("a", "b")) == ["a", "b"]
+    assert sent == [["a_0", "a_1", "b_0", "b_1"], ["b_1"]]
+
+
+async def test_upsert_retries_only_retryable_failures(store):
+    sent = script_bulk_index(
+        store,
+        [{"a_0": (400, "mapper_parsing_exception"), "b_1": (429, "rejected")}],
+    )
+    with pytest.raises(UpsertError) as error:
+        await store._upsert(make_chunks("a", "b"))
+
+    assert error.value.failures == {"a": "mapper_parsing_exception"}
+    assert error.value.ids == ["b"]
+    assert sent == [["a_0", "a_1", "b_0", "b_1"], ["b_1"]]
+
+
+async def test_upsert_reports_failures_of_every_attempt(store, monkeypatch):
+    monkeypatch.setattr(elasticsearch_datastore, "ELASTICSEARCH_BULK_MAX_RETRIES", 3)
+    sent = script_bulk_index(
+        store,
+        [
+            {"a_0": (429, "rejected"), "b_0": (503, "unavailable")},
+            {"a_0": (400, "mapper_parsing_exception"), "b_0": (503, "unavailable")},
+        ],
+    )
+    with pytest.raises(UpsertError) as error:
+        await store._upsert(make_chunks("a", "b"))
+
+    # a_0 failed for good on the second attempt, and is not forgotten once b_0 goes through
+    assert error.value.failures == {"a": "mapper_parsing_exception"}
+    assert error.value.ids == ["b"]
+    assert sent == [["a_0", "a_1", "b_0", "b_1"], ["a_0", "b_0"], ["b_0"]]
+
+
+async def test_upsert_gives_up_on_persistent_retryable_failures(store, monkeypatch):
+    monkeypatch.setattr(elasticsearch_datastore, "ELASTICSEARCH_BULK_MAX_RETRIES", 2)
+    sent = script_bulk_index(store, [{"a_1": (429, "rejected")}] * 3)
+    with pytest.raises(UpsertError) as error:
+        await store._upsert(make_chunks("a", "b"))
+
+    assert error.value.failures == {"a": "rejected"}
+    assert error.value.ids == ["b"]
+    assert len(sent) == 3
+
+
+async def test_bulk_index_collects_failed_items(store, monkeypatch):
+    async def async_streaming_bulk(client, actions, **kwargs):
+        for action in actions:
+            if action["_id"] == "a_1":
+                yield False, {
+                    "index": {"_id": "a_1", "status": 400, "error": "bad vector"}
+                }
+            elif action["_id"] == "b_0":
+                # a connection error has no status
+                yield False, {"index": {"_id": "b_0", "exception": "timed out"}}
+            else:
+                yield True, {"index": {"_id": action["_id"], "status": 201}}
+
+    monkeypatch.setattr(
+        elasticsearch_datastore.helpers, "async_streaming_bulk", async_streaming_bulk
+    )
+    chunks = [
+        chunk for chunk_list in make_chunks("a", "b").values() for chunk in chunk_list
+    ]
+    assert await store._bulk_index(chunks) == {
+        "a_1": (400, "bad vector"),
+        "b_0": (500, "timed out"),
+    }
+
+
+async def test_new_index_maps_filter_fields_as_keyword(store, monkeypatch):
+    created = {}
+
+    async def create(index, mappings, settings):
+        created.update(index=index, mappings=mappings)
+
+    monkeypatch.setattr(store.client.indices, "create", create)
+    await store._create_index("test_v1", "cosine", 4, 1, 1, "none")
+
+    metadata = created["mappings"]["properties"]["metadata"]["properties"]
+    assert all(metadata[field] == {"type": "keyword"} for field in FILTER_FIELDS)
+    assert get_filter_fields(created["mappings"]["properties"]) == {}
+
+
+def test_dynamic_text_fields_are_filtered_on_their_keyword_subfield(store):
+    # the mapping Elasticsearch infers for strings when an index has no explicit one
+    dynamic = {"type": "text", "fields": {"keyword": {"type": "keyword"}}}
+    store._filter_fields = get_filter_fields(
+        {
+            "metadata": {
+                "properties": {
+                    "document_id": dynamic,
+                    "source": {"type": "keyword"},
+                    "url": dynamic,
+                }
+            }
+        }
+    )
+
+    assert store._filter_fields == {"document_id": "metadata.document_id.keyword"}
+    assert store._get_es_filters(
+        DocumentMetadataFilter(document_id="doc-1", source="email")
+    ) == {
+        "bool": {
+            "must": [
+                {"term": {"metadata.document_id.keyword": "doc-1"}},
+                {"term": {"metadata.source": "email"}},
+            ]
+        }
+    }
+
+
+class FakeCluster:
+    """Just enough of the Elasticsearch APIs reindex() uses, with indices kept in memory."""
+
+    def __init__(self, indices: Dict[str, Dict[str, dict]]):
+        self.indices = indices
+        self.aliases: Dict[str, List[str]] = {}
+        # called with the query of each reindex task, between its snapshot of the source and the copy
+        self.on_reindex = None
+
+    def resolve(self, name: str) -> List[str]:
+        return [
+            index
+            for part in name.split(",")
+            for index in self.aliases.get(part, [part])
+            if index in self.indices
+        ]
+
+    def matches(self, source: dict, query: Optional[dict]) -> bool:
+        if query is None or "match_all" in query:
+            return True
+        if "terms" in query:
+            return (
+                source["metadata"]["document_id"]
+                in query["terms"]["metadata.document_id"]
+            )
+        return source.get("updated_at", 0) >= query["range"]["updated_at"]["gte"]
+
+    def install(self, store: ElasticsearchDataStore, monkeypatch) -> None:
+        client = store.client
+
+        async def get(index):
+            if index.endswith("*"):
+                return {
+                    name: {} for name in self.indices if name.startswith(index[:-1])
+                }
+            return {name: {} for name in self.resolve(index)}
+
+        async def exists_alias(name):
+            return name in self.aliases
+
+        async def get_mapping(index):
+            mapping = {"similarity": "cosine", "dims": 4, "type": "dense_vector"}
+            return {
+                self.resolve(index)[0]: {
+                    "mappings": {"properties": {"embedding": mapping}}
+                }
+            }
+
+        async def create(index, mappings, settings):
+            self.indices[index] = {}
+
+        async def noop(**kwargs):
+            pass
+
+        async def update_aliases(actions):
+            for action in actions:
+                ((kind, args),) = action.items()
+                if kind == "add":
+                    self.aliases.setdefault(args["alias"], []).append(args["index"])
+                elif kind == "remove":
+                    self.aliases[args["alias"]].remove(args["index"])
+                else:
+                    del self.indices[args["index"]]
+
+        async def reindex(source, dest, **kwargs):
+            snapshot = {
+                _id: dict(document)
+                for index in self.resolve(source["index"])
+                for _id, document in self.indices[index].items()
+                if self.matches(document, source.get("query"))
+            }
+            if self.on_reindex is not None:
+                await self.on_reindex(source.get("query"))
+            self.indices[dest["index"]].update(snapshot)
+            return {"task": "task"}
+
+        async def get_task(task_id):
+            return {"completed": True, "response": {"failures": []}}
+
+        async def delete_by_query(index, query, **kwargs):
+            for name in self.resolve(index):
+                self.indices[name] = {
+                    _id: document
+                    for _id, document in self.indices[name].items()
+                    if not self.matches(document, query)
+                }
+
+        async def async_streaming_bulk(client, actions, **kwargs):
+            for action in actions:
+                (index,) = self.resolve(action["_index"])
+                self.indices[index][action["_id"]] = action["_source"]
+                yield True, {"index": {"_id": action["_id"], "status": 201}}
+
+        for name, function in [
+            ("get", get),
+            ("exists_alias", exists_alias),
+            ("get_mapping", get_mapping),
+            ("create", create),
+            ("put_settings", noop),
+            ("refresh", noop),
+            ("update_aliases", update_aliases),
+        ]:
+            monkeypatch.setattr(client.indices, name, function)
+        monkeypatch.setattr(client, "reindex", reindex)
+        monkeypatch.setattr(client, "delete_by_query", delete_by_query)
+        monkeypatch.setattr(client.tasks, "get", get_task)
+        monkeypatch.setattr(
+            elasticsearch_datastore.helpers,
+            "async_streaming_bulk",
+            async_streaming_bulk,
+        )
+
+
+def stored_texts(cluster: FakeCluster, index: str) -> Dict[str, str]:
+    (name,) = cluster.resolve(index)
+    return {_id: source["text"] for _id, source in cluster.indices[name].items()}
+
+
+async def test_reindex_catches_up_with_the_writes_during_the_copy(store, monkeypatch):
+    old_chunks = {
+        chunk.id: {
+            "text": chunk.text,
+            "metadata": chunk.metadata.dict(),
+            "updated_at": 0,
+        }
+        for chunk_list in make_chunks("a", "b", "c").values()
+        for chunk in chunk_list
+    }
+    cluster = FakeCluster({"test": old_chunks})
+    cluster.install(store, monkeypatch)
+    new_a = {
+        "a": [
+            chunk.copy(update={"text": f"new {chunk.text}"})
+            for chunk in make_chunks("a")["a"]
+        ]
+    }
+    blocked_upsert = None
+
+    async def on_reindex(query):
+        nonlocal blocked_upsert
+        if query is None:
+            # written to the old index while it is copied
+            await store._upsert(new_a)
+            await store.delete(ids=["b"])
+        else:
+            # writes wait while the new index catches up
+            blocked_upsert = asyncio.create_task(store._upsert(make_chunks("d")))
+            # asyncio.sleep is patched out by the store fixture
+            done, _ = await asyncio.wait([blocked_upsert], timeout=0.1)
+            assert not done
+
+    cluster.on_reindex = on_reindex
+    assert await store.reindex() == "test_v1"
+
+    assert cluster.aliases == {"test": ["test_v1"]}
+    assert "test" not in cluster.indices
+    assert stored_texts(cluster, "test") == {
+        "a_0": "new a chunk 0",
+        "a_1": "new a chunk 1",
+        "c_0": "c chunk 0",
+        "c_1": "c chunk 1",
+    }
+    await blocked_upsert
+    assert sorted(stored_texts(cluster, "test")) == [
+        "a_0",
+        "a_1",
+        "c_0",
+        "c_1",
+        "d_0",
+        "d_1",
+    ]
@@ -0,0 +1,140 @@
+import os
+from typing import List, Set
+
+import pytest
+
+pytest.importorskip("hnswlib")
+
+import datastore.datastore
+from datastore.providers import hnsw_datastore, local_datastore
+from datastore.providers.hnsw_datastore import HnswDataStore
+from datastore.providers.local_datastore import LocalDataStore
+from models.models import Document, DocumentMetadataFilter, Query, QueryResult
+
+
+@pytest.fixture
+async def store(tmp_path, dimension, embedded) -> HnswDataStore:
+    store = HnswDataStore(dimension=dimension, path=str(tmp_path / "hnsw"))
+    await store.setup()
+    return store
+
+
+def make_documents(count: int, version: int = 0) -> List[Document]:
+    return [
+        Document(
+            id=f"doc{i}",
+            text=" ".join(
+                f"Sentence {j} of document {i}, version {version}." for j in range(30)
+            ),
+        )
+        for i in range(count)
+    ]
+
+
+QUERIES = [f"Question {i} about the documents?" for i in range(20)]
+
+
+async def query(store: LocalDataStore, **filter) -> List[QueryResult]:
+    return await store.query(
+        [
+            Query(
+                query=query,
+                filter=DocumentMetadataFilter(**filter) if filter else None,
+                top_k=5,
+            )
+            for query in QUERIES
+        ],
+        use_cache=False,
+    )
+
+
+async def search(store: LocalDataStore, **filter) -> List[Set[str]]:
+    """Returns the ids of the top chunks for each of QUERIES."""
+    return [
+        {chunk.id for chunk in result.results}
+        for result in await query(store, **filter)
+    ]
+
+
+async def scores(store: LocalDataStore, **filter) -> List[List[float]]:
+    """Returns the scores of the top chunks for each of QUERIES, which unlike their ids do not depend on how ties are broken."""
+    return [
+        [chunk.score for chunk in result.results]
+        for result in await query(store, **filter)
+    ]
+
+
+async def test_search_matches_exact_search(store, tmp_path, dimension):
+    exact = LocalDataStore(dimension=dimension, path=str(tmp_path / "local"))
+    await exact.setup()
+    documents = make_documents(5)
+    await store.upsert(documents, chunk_token_size=20)
+    await exact.upsert(documents, chunk_token_size=20)
+
+    # the graph of a few hundred rows is searched exhaustively
+    for hnsw, expected in zip(await scores(store), await scores(exact)):
+        assert hnsw == pytest.approx(expected, abs=1e-5)
+    for hnsw, expected in zip(
+        await scores(store, document_id="doc2"),
+        await scores(exact, document_id="doc2"),
+    ):
+        assert hnsw == pytest.approx(expected, abs=1e-5)
+
+
+async def test_filtered_search_through_the_graph(store, monkeypatch):
+    monkeypatch.setattr(hnsw_datastore, "HNSW_EXACT_FILTER_ROWS", 0)
+    await store.upsert(make_documents(5), chunk_token_size=20)
+
+    for ids in await search(store, document_id="doc3"):
+        assert ids
+        assert all(id.startswith("doc3_") for id in ids)
+
+
+async def test_replaced_rows_are_not_returned(store, monkeypatch):
+    monkeypatch.setattr(datastore.datastore, "UPSERT_MODE", "overwrite")
+    await store.upsert(make_documents(3), chunk_token_size=20)
+    await store.upsert(make_documents(3, version=1), chunk_token_size=20)
+
+    for ids in await search(store):
+        assert len(ids) == 5
+        assert all(id in store._rows for id in ids)
+        assert all("version 0." not in store._texts[store._rows[id]] for id in ids)
+
+
+@pytest.mark.parametrize("mode", ["replace", "overwrite"])
+async def test_compaction_rebuilds_the_graph(store, monkeypatch, mode):
+    monkeypatch.setattr(datastore.datastore, "UPSERT_MODE", mode)
+    for version in range(8):
+        await store.upsert(make_documents(3, version), chunk_token_size=20)
+
+    # tombstones are dropped with the rows they mark
+    assert store._index.get_current_count() == store.count
+    assert store.count - len(store._rows) < (
+        local_datastore.LOCAL_DATASTORE_COMPACT_RATIO * store.count
+    )
+
+
+async def test_reload_uses_the_saved_graph(store, dimension):
+    await store.upsert(make_documents(3), chunk_token_size=20)
+    await store.close()
+    assert os.path.exists(os.path.join(store.path, "hnsw.bin"))
+    expected = await search(store)
+
+    reopened = HnswDataStore(dimension=dimension, path=store.path)
+    await reopened.setup()
+    assert reopened._indexed == store.count
+    assert await search(reopened) == expected
+
+
+async def test_reload_marks_rows_deleted_after_the_graph_was_saved(store, dimension):
+    await store.upsert(make_documents(5), chunk_token_size=20)
+    await store.close()
+    # too few rows to compact, so the graph on disk still has the rows of doc1
+    await store.delete(ids=["doc1"])
+    assert store.count > len(store._rows)
+
+    reopened = HnswDataStore(dimension=dimension, path=store.path)
+    await reopened.setup()
+    for ids in await search(reopened):
+        assert ids
+        assert not any(id.startswith("doc1_") for id in ids)
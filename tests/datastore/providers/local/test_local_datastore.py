@@ -0,0 +1,218 @@
+import os
+from typing import List, Set
+
+import pytest
+
+import datastore.datastore
+from datastore.providers import local_datastore
+from datastore.providers.local_datastore import LocalDataStore
+from models.models import (
+    Document,
+    DocumentChunkWithScore,
+    DocumentMetadataFilter,
+    Query,
+)
+from services.chunks import get_text_chunks
+
+
+@pytest.fixture
+async def store(tmp_path, dimension, embedded) -> LocalDataStore:
+    store = LocalDataStore(dimension=dimension, path=str(tmp_path))
+    await store.setup()
+    return store
+
+
+def make_documents(count: int, version: int = 0) -> List[Document]:
+    return [
+        Document(
+            id=f"doc{i}",
+            text=" ".join(
+                f"Sentence {j} of document {i}, version {version}." for j in range(30)
+            ),
+        )
+        for i in range(count)
+    ]
+
+
+def stored_chunks(store: LocalDataStore) -> List[str]:
+    """Returns the texts of the live chunks, in row order."""
+    return [store._texts[row] for row in sorted(store._rows.values())]
+
+
+def stored_documents(store: LocalDataStore) -> Set[str]:
+    """Returns the ids of the documents that have live chunks."""
+    codes = store._codes["document_id"]
+    return {store._values["document_id"][codes[row]] for row in store._rows.values()}
+
+
+async def query(
+    store: LocalDataStore, text: str, **filter
+) -> List[DocumentChunkWithScore]:
+    results = await store.query(
+        [
+            Query(
+                query=text,
+                filter=DocumentMetadataFilter(**filter) if filter else None,
+                top_k=3,
+            )
+        ],
+        use_cache=False,
+    )
+    return results[0].results
+
+
+def expected_chunks(documents: List[Document]) -> List[str]:
+    return sorted(
+        text for document in documents for text in get_text_chunks(document.text, 20)
+    )
+
+
+async def test_query_finds_the_upserted_chunk(store):
+    await store.upsert(make_documents(3), chunk_token_size=20)
+    texts = stored_chunks(store)
+
+    for text in texts[::5]:
+        results = await query(store, text)
+        assert results[0].text == text
+        assert results[0].score == pytest.approx(1, abs=1e-5)
+    results = await query(store, texts[0], document_id="doc1")
+    assert len(results) == 3
+    assert {result.metadata.document_id for result in results} == {"doc1"}
+
+
+async def test_upsert_replaces_the_stored_document(store):
+    await store.upsert(make_documents(2), chunk_token_size=20)
+    shorter = Document(id="doc0", text="A much shorter document.")
+    await store.upsert([shorter], chunk_token_size=20)
+
+    assert sorted(stored_chunks(store)) == expected_chunks(
+        [shorter, make_documents(2)[1]]
+    )
+
+
+@pytest.mark.parametrize("mode", ["replace", "overwrite"])
+async def test_repeated_upserts_are_compacted(store, monkeypatch, mode):
+    monkeypatch.setattr(datastore.datastore, "UPSERT_MODE", mode)
+    for version in range(8):
+        await store.upsert(make_documents(3, version), chunk_token_size=20)
+
+    live = len(store._rows)
+    assert sorted(stored_chunks(store)) == expected_chunks(make_documents(3, 7))
+    # deleted rows are dropped once they are LOCAL_DATASTORE_COMPACT_RATIO of all rows
+    assert (
+        store.count - live < local_datastore.LOCAL_DATASTORE_COMPACT_RATIO * store.count
+    )
+    # replaced files are removed
+    assert len(os.listdir(store.path)) == 4
+
+
+async def test_overwrite_removes_the_tail_of_a_shortened_document(store, monkeypatch):
+    monkeypatch.setattr(datastore.datastore, "UPSERT_MODE", "overwrite")
+    await store.upsert(make_documents(1), chunk_token_size=20)
+    shorter = Document(id="doc0", text="Sentence 0 of document 0.")
+    await store.upsert([shorter], chunk_token_size=20)
+
+    assert sorted(stored_chunks(store)) == expected_chunks([shorter])
+
+
+async def test_delete(store):
+    await store.upsert(make_documents(3), chunk_token_size=20)
+    await store.delete(ids=["doc0"])
+    assert stored_documents(store) == {"doc1", "doc2"}
+
+    await store.delete(filter=DocumentMetadataFilter(document_id="doc1"))
+    assert stored_documents(store) == {"doc2"}
+
+    await store.delete(delete_all=True)
+    assert stored_chunks(store) == []
+    assert await query(store, "Sentence 0 of document 2, version 0.") == []
+
+
+async def test_reload_from_disk(store, dimension):
+    await store.upsert(make_documents(3), chunk_token_size=20)
+    await store.delete(ids=["doc1"])
+    await store.upsert(make_documents(1, version=1), chunk_token_size=20)
+    texts = stored_chunks(store)
+    await store.close()
+
+    reopened = LocalDataStore(dimension=dimension, path=store.path)
+    await reopened.setup()
+    assert stored_chunks(reopened) == texts
+    assert (await query(reopened, texts[-1]))[0].text == texts[-1]
+    # only the alive file state.json points at is kept
+    assert [file for file in os.listdir(store.path) if file.startswith("alive")] == [
+        reopened._alive_file
+    ]
+
+
+async def test_reload_drops_rows_written_after_the_last_state(store, dimension):
+    await store.upsert(make_documents(2), chunk_token_size=20)
+    texts = stored_chunks(store)
+    # a crash after the metadata lines were appended but before state.json was replaced
+    with open(os.path.join(store.path, store._metadata_file), "a") as f:
+        f.write('{"id": "torn", "text": "torn", "meta')
+
+    reopened = LocalDataStore(dimension=dimension, path=store.path)
+    await reopened.setup()
+    assert stored_chunks(reopened) == texts
+    await reopened.upsert(
+        [Document(id="doc2", text="Written after the crash.")], chunk_token_size=20
+    )
+    assert stored_chunks(reopened) == texts + ["Written after the crash."]
+
+
+async def test_upsert_rejects_embeddings_of_another_dimension(tmp_path, embedded):
+    store = LocalDataStore(dimension=3, path=str(tmp_path))
+    await store.setup()
+    with pytest.raises(ValueError, match="dimension"):
+        await store.upsert(make_documents(1), chunk_token_size=20)
+
+
+async def test_incremental_upsert_embeds_only_changed_chunks(
+    store, monkeypatch, embedded
+):
+    monkeypatch.setattr(datastore.datastore, "UPSERT_MODE", "incremental")
+    documents = make_documents(3)
+    await store.upsert(documents, chunk_token_size=20)
+    old_chunks = expected_chunks(documents)
+
+    # an edit of the same length keeps the boundaries of the other chunks
+    changed = Document(
+        id="doc1", text=documents[1].text.replace("Sentence 15 ", "Sentence 51 ")
+    )
+    embedded.clear()
+    progress = {}
+    await store.upsert(
+        [documents[0], changed],
+        chunk_token_size=20,
+        on_progress=lambda stage, count: progress.update(
+            {stage: progress.get(stage, 0) + count}
+        ),
+    )
+
+    new_chunks = expected_chunks([changed])
+    assert sorted(embedded) == [text for text in new_chunks if text not in old_chunks]
+    assert 0 < len(embedded) < len(new_chunks)
+    assert progress["reused"] == len(expected_chunks([documents[0], changed])) - len(
+        embedded
+    )
+    # the same chunks as a fresh upsert of the new versions
+    assert sorted(stored_chunks(store)) == expected_chunks(
+        [documents[0], changed, documents[2]]
+    )
+    text = new_chunks[0]
+    assert (await query(store, text))[0].text == text
+
+
+async def test_incremental_upsert_of_a_shortened_document(store, monkeypatch, embedded):
+    monkeypatch.setattr(datastore.datastore, "UPSERT_MODE", "incremental")
+    document = make_documents(1)[0]
+    await store.upsert([document], chunk_token_size=20)
+
+    # dropping the last sentences keeps the boundaries of the chunks before them
+    shortened = Document(id="doc0", text=document.text.split(" Sentence 20")[0])
+    embedded.clear()
+    await store.upsert([shortened], chunk_token_size=20)
+
+    assert sorted(stored_chunks(store)) == expected_chunks([shortened])
+    assert len(embedded) <= 1
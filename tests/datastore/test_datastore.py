@@ -0,0 +1,163 @@
+import asyncio
+from typing import Dict, List, Optional
+
+import pytest
+
+import datastore.datastore
+from datastore.datastore import DataStore, UpsertError
+from models.models import (
+    Document,
+    DocumentChunk,
+    DocumentMetadataFilter,
+    QueryResult,
+    QueryWithEmbedding,
+)
+from services.chunks import SegmentedDocument
+
+# Fails the upsert as soon as a stage hangs instead of finishing or failing
+TIMEOUT = 10
+
+
+class MemoryDataStore(DataStore):
+    """Keeps the written chunks in a dict. fail maps document ids to the exception _upsert raises for them."""
+
+    def __init__(self, fail: Optional[Dict[str, Exception]] = None):
+        self.chunks: Dict[str, DocumentChunk] = {}
+        self.batches: List[int] = []
+        self.fail = fail or {}
+
+    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+        self.batches.append(sum(len(chunk_list) for chunk_list in chunks.values()))
+        failures = {}
+        for doc_id, chunk_list in chunks.items():
+            if doc_id in self.fail:
+                if not isinstance(self.fail[doc_id], UpsertError):
+                    raise self.fail[doc_id]
+                failures[doc_id] = str(self.fail[doc_id])
+                continue
+            for chunk in chunk_list:
+                self.chunks[chunk.id] = chunk
+        if failures:
+            raise UpsertError(
+                failures, ids=[doc_id for doc_id in chunks if doc_id not in failures]
+            )
+        return list(chunks)
+
+    async def _query(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
+        return [QueryResult(query=query.query, results=[]) for query in queries]
+
+    async def _delete(
+        self,
+        ids: Optional[List[str]] = None,
+        filter: Optional[DocumentMetadataFilter] = None,
+        delete_all: Optional[bool] = None,
+    ) -> bool:
+        self.chunks = {
+            chunk_id: chunk
+            for chunk_id, chunk in self.chunks.items()
+            if not delete_all and chunk.metadata.document_id not in (ids or [])
+        }
+        return True
+
+
+def make_documents(count: int) -> List[Document]:
+    return [
+        Document(id=f"doc{i}", text=f"Document {i} has a sentence. " * 40)
+        for i in range(count)
+    ]
+
+
+async def test_upsert_embeds_and_writes_every_chunk(embedded, small_batches):
+    store = MemoryDataStore()
+    progress: Dict[str, int] = {}
+    ids = await asyncio.wait_for(
+        store.upsert(
+            make_documents(3),
+            chunk_token_size=20,
+            on_progress=lambda stage, count: progress.update(
+                {stage: progress.get(stage, 0) + count}
+            ),
+        ),
+        TIMEOUT,
+    )
+
+    assert ids == ["doc0", "doc1", "doc2"]
+    assert len(store.chunks) == len(embedded) == progress["embedded"]
+    assert progress["written"] == len(store.chunks)
+    assert all(size <= small_batches for size in store.batches)
+    assert {chunk.metadata.document_id for chunk in store.chunks.values()} == set(ids)
+
+
+async def test_upsert_reports_failed_documents_and_writes_the_others(
+    embedded, small_batches
+):
+    store = MemoryDataStore(fail={"doc1": UpsertError({"doc1": "mapping error"})})
+    with pytest.raises(UpsertError) as error:
+        await asyncio.wait_for(
+            store.upsert(make_documents(3), chunk_token_size=20), TIMEOUT
+        )
+
+    assert list(error.value.failures) == ["doc1"]
+    assert error.value.ids == ["doc0", "doc2"]
+    assert {chunk.metadata.document_id for chunk in store.chunks.values()} == {
+        "doc0",
+        "doc2",
+    }
+
+
+async def test_write_error_fails_the_upsert(embedded, small_batches):
+    store = MemoryDataStore(fail={"doc1": ConnectionError("datastore is down")})
+    with pytest.raises(ConnectionError):
+        await asyncio.wait_for(
+            store.upsert(make_documents(3), chunk_token_size=20), TIMEOUT
+        )
+
+
+async def test_embedding_error_fails_the_upsert(monkeypatch, small_batches):
+    calls = 0
+
+    async def get_embeddings(texts: List[str]) -> List[List[float]]:
+        nonlocal calls
+        calls += 1
+        if calls == 2:
+            raise RuntimeError("embedding model is down")
+        return [[1.0, 0.0] for _ in texts]
+
+    monkeypatch.setattr(datastore.datastore, "get_embeddings", get_embeddings)
+    store = MemoryDataStore()
+    with pytest.raises(RuntimeError, match="embedding model is down"):
+        await asyncio.wait_for(
+            store.upsert(make_documents(5), chunk_token_size=20), TIMEOUT
+        )
+
+
+async def test_segment_error_fails_the_upsert(embedded, small_batches):
+    def segments():
+        yield "The first page of the file. " * 40, 1
+        raise ValueError("corrupt page")
+
+    store = MemoryDataStore()
+    with pytest.raises(ValueError, match="corrupt page"):
+        await asyncio.wait_for(
+            store.upsert(
+                [SegmentedDocument(id="file", segments=segments())],
+                chunk_token_size=20,
+            ),
+            TIMEOUT,
+        )
+
+
+async def test_write_batch_size_gathers_embedded_batches(
+    embedded, small_batches, monkeypatch
+):
+    monkeypatch.setattr(MemoryDataStore, "write_batch_size", 10)
+    store = MemoryDataStore()
+    await asyncio.wait_for(
+        store.upsert(make_documents(3), chunk_token_size=20), TIMEOUT
+    )
+
+    assert sum(store.batches) == len(store.chunks)
+    # every write but the last of each writer holds at least write_batch_size chunks
+    assert sum(size < 10 for size in store.batches) <= (
+        datastore.datastore.UPSERT_WRITE_CONCURRENCY
+    )
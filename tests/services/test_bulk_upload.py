@@ -0,0 +1,185 @@
+import io
+import os
+import tarfile
+import tempfile
+import zipfile
+from typing import Dict, List
+
+import pytest
+from fastapi import UploadFile
+
+from datastore.providers.local_datastore import LocalDataStore
+from models.models import DocumentMetadata
+from services import bulk_upload
+from services.bulk_upload import TooManyFilesError, upsert_uploaded_files
+
+
+@pytest.fixture
+async def store(tmp_path, dimension, embedded) -> LocalDataStore:
+    store = LocalDataStore(dimension=dimension, path=str(tmp_path / "datastore"))
+    await store.setup()
+    return store
+
+
+@pytest.fixture(autouse=True)
+def temp_dir(tmp_path, monkeypatch) -> str:
+    """Extracts the archives in a directory of the test, to check that nothing is left behind."""
+    directory = tmp_path / "tmp"
+    directory.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(directory))
+    return str(directory)
+
+
+def make_zip(files: Dict[str, str]) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, text in files.items():
+            archive.writestr(name, text)
+    return buffer.getvalue()
+
+
+def make_tar(files: Dict[str, str]) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for name, text in files.items():
+            data = text.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def upload(filename: str, data: bytes) -> UploadFile:
+    return UploadFile(io.BytesIO(data), filename=filename)
+
+
+def stored_documents(store: LocalDataStore) -> List[str]:
+    codes = store._codes["document_id"]
+    return sorted(
+        {store._values["document_id"][codes[row]] for row in store._rows.values()}
+    )
+
+
+async def test_upsert_files_and_archives(store, temp_dir):
+    response = await upsert_uploaded_files(
+        store,
+        [
+            upload("notes.txt", b"Some notes."),
+            upload("docs.zip", make_zip({"a.txt": "File a.", "dir/b.md": "File b."})),
+            upload("docs.tar.gz", make_tar({"c.txt": "File c."})),
+        ],
+        DocumentMetadata(),
+    )
+
+    assert [result.filename for result in response.results] == [
+        "notes.txt",
+        "docs.zip/a.txt",
+        "docs.zip/dir/b.md",
+        "docs.tar.gz/c.txt",
+    ]
+    assert all(result.error is None for result in response.results)
+    assert stored_documents(store) == sorted(result.id for result in response.results)
+    assert response.chunks_embedded == 4
+    assert os.listdir(temp_dir) == []
+
+
+async def test_too_many_files(store, monkeypatch):
+    monkeypatch.setattr(bulk_upload, "BULK_UPLOAD_MAX_FILES", 2)
+    with pytest.raises(TooManyFilesError):
+        await upsert_uploaded_files(
+            store,
+            [upload("docs.zip", make_zip({"a.txt": "a", "b.txt": "b", "c.txt": "c"}))],
+            DocumentMetadata(),
+        )
+    with pytest.raises(TooManyFilesError):
+        await upsert_uploaded_files(
+            store,
+            [
+                upload("notes.txt", b"Some notes."),
+                upload("docs.zip", make_zip({"a.txt": "a", "b.txt": "b"})),
+            ],
+            DocumentMetadata(),
+        )
+    assert stored_documents(store) == []
+
+
+async def test_archive_larger_than_archive_max_bytes(store, monkeypatch, temp_dir):
+    monkeypatch.setattr(bulk_upload, "ARCHIVE_MAX_BYTES", 100)
+    response = await upsert_uploaded_files(
+        store,
+        [
+            upload("big.zip", make_zip({"a.txt": "a" * 60, "b.txt": "b" * 60})),
+            upload("small.zip", make_zip({"c.txt": "File c."})),
+        ],
+        DocumentMetadata(),
+    )
+
+    big, small = response.results
+    assert big.filename == "big.zip"
+    assert big.id is None
+    assert "120 bytes" in big.error
+    assert small.error is None
+    assert stored_documents(store) == [small.id]
+    assert os.listdir(temp_dir) == []
+
+
+async def test_archive_member_larger_than_file_upload_max_bytes(store, monkeypatch):
+    monkeypatch.setattr(bulk_upload, "FILE_UPLOAD_MAX_BYTES", 50)
+    response = await upsert_uploaded_files(
+        store,
+        [
+            upload(
+                "docs.zip", make_zip({"big.txt": "a" * 60, "small.txt": "File small."})
+            )
+        ],
+        DocumentMetadata(),
+    )
+
+    big, small = response.results
+    assert big.id is None
+    assert big.error == "File is 60 bytes, the limit is 50 bytes"
+    assert small.error is None
+    assert stored_documents(store) == [small.id]
+
+
+async def test_archive_member_paths_stay_in_the_temporary_directory(store, tmp_path):
+    response = await upsert_uploaded_files(
+        store,
+        [
+            upload(
+                "docs.tar.gz",
+                make_tar(
+                    {"../../escaped.txt": "Escaped.", "/tmp/absolute.txt": "Absolute."}
+                ),
+            )
+        ],
+        DocumentMetadata(),
+    )
+
+    assert [result.filename for result in response.results] == [
+        "docs.tar.gz/../../escaped.txt",
+        "docs.tar.gz//tmp/absolute.txt",
+    ]
+    assert all(result.error is None for result in response.results)
+    assert len(stored_documents(store)) == 2
+    assert not os.path.exists(tmp_path.parent / "escaped.txt")
+    assert not os.path.exists(tmp_path / "escaped.txt")
+
+
+async def test_unreadable_files_are_reported_per_file(store):
+    response = await upsert_uploaded_files(
+        store,
+        [
+            upload("docs.zip", make_zip({"a.txt": "File a.", "image.unknown": "?"})),
+            upload("broken.zip", b"not a zip file"),
+        ],
+        DocumentMetadata(),
+    )
+
+    a, unknown, broken = response.results
+    assert a.error is None
+    assert unknown.filename == "docs.zip/image.unknown"
+    assert unknown.id is None and unknown.error
+    assert broken.filename == "broken.zip"
+    assert broken.id is None and broken.error
+    assert stored_documents(store) == [a.id]
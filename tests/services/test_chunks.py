@@ -0,0 +1,100 @@
+import random
+
+import pytest
+
+import benchmarks.bench_chunks
+import services.chunks
+from benchmarks.bench_chunks import PARAGRAPH, legacy_get_text_chunks, make_text
+from models.models import DocumentChunk, DocumentChunkMetadata
+from services.chunks import diff_document_chunks, get_text_chunks
+
+WORDS = [
+    "the",
+    "chunk",
+    "don't",
+    "123456",
+    "안녕하세요",
+    "日本語のテキスト",
+    "é",
+    "—",
+    "😀",
+    "x" * 30,
+    ".",
+    "?",
+    "!",
+    "\n",
+    "\n\n",
+    "   ",
+]
+
+
+def random_text(rng: random.Random, words: int) -> str:
+    return "".join(
+        rng.choice(WORDS) + rng.choice(["", " ", " ", "\n"]) for _ in range(words)
+    )
+
+
+@pytest.mark.parametrize("chunk_token_size", [None, 20, 50, 200])
+@pytest.mark.parametrize("size", [0, 100, 10 * 1024, 100 * 1024])
+def test_get_text_chunks_matches_legacy_chunker(size, chunk_token_size):
+    text = make_text(size)
+    assert get_text_chunks(text, chunk_token_size) == legacy_get_text_chunks(
+        text, chunk_token_size
+    )
+
+
+def test_get_text_chunks_matches_legacy_chunker_on_random_text():
+    rng = random.Random(0)
+    for _ in range(50):
+        text = random_text(rng, rng.randint(0, 3000))
+        chunk_token_size = rng.choice([None, 20, 50])
+        assert get_text_chunks(text, chunk_token_size) == legacy_get_text_chunks(
+            text, chunk_token_size
+        )
+
+
+def test_get_text_chunks_stops_at_max_num_chunks(monkeypatch):
+    monkeypatch.setattr(services.chunks, "MAX_NUM_CHUNKS", 3)
+    monkeypatch.setattr(benchmarks.bench_chunks, "MAX_NUM_CHUNKS", 3)
+    text = PARAGRAPH * 50
+    chunks = get_text_chunks(text, 20)
+    assert chunks == legacy_get_text_chunks(text, 20)
+    # the remaining text after MAX_NUM_CHUNKS chunks becomes one last chunk
+    assert len(chunks) == 4
+
+
+@pytest.mark.parametrize("text", ["", "   ", "\n\n\n"])
+def test_get_text_chunks_of_empty_text(text):
+    assert get_text_chunks(text, None) == []
+
+
+def make_chunk(chunk_id: str, chunk_hash: str) -> DocumentChunk:
+    return DocumentChunk(
+        id=chunk_id,
+        text=chunk_hash,
+        metadata=DocumentChunkMetadata(document_id="doc", chunk_hash=chunk_hash),
+    )
+
+
+def test_diff_document_chunks_keeps_unchanged_chunks():
+    changed, kept = diff_document_chunks(
+        [make_chunk("doc_0", "a"), make_chunk("doc_1", "x"), make_chunk("doc_2", "c")],
+        {"doc_0": "a", "doc_1": "b", "doc_2": "c"},
+    )
+    assert [chunk.id for chunk in changed] == ["doc_1"]
+    assert kept == ["doc_0", "doc_2"]
+
+
+def test_diff_document_chunks_reuses_moved_chunks():
+    # a chunk inserted at the start shifts the ids of the unchanged chunks after it
+    changed, kept = diff_document_chunks(
+        [
+            make_chunk("doc_0", "new"),
+            make_chunk("doc_1", "a"),
+            make_chunk("doc_2", "b"),
+        ],
+        {"doc_0": "a", "doc_1": "b", "doc_2": None},
+    )
+    assert kept == ["doc_0", "doc_1"]
+    # the new chunk may not overwrite the kept chunk stored under its id
+    assert [chunk.id for chunk in changed] == ["doc_0_new"]
@@ -0,0 +1,41 @@
+from array import array
+
+from services.embedding_cache import EmbeddingCache
+
+# float32 values, like the embeddings returned by Gemini
+EMBEDDINGS = {f"key{i}": array("f", [i / 3, -i / 7, 0.5]).tolist() for i in range(10)}
+
+
+def test_memory_tier_returns_lists_and_evicts_least_recently_used():
+    cache = EmbeddingCache(memory_size=3, path=None)
+    cache.put_many({key: EMBEDDINGS[key] for key in ["key0", "key1", "key2"]})
+    assert cache.get_many(["key0"]) == {"key0": EMBEDDINGS["key0"]}
+    assert isinstance(cache.get_many(["key0"])["key0"], list)
+
+    cache.put_many({"key3": EMBEDDINGS["key3"]})
+    # key1 was the least recently used once key0 was read
+    assert cache.get_many(["key0", "key1", "key2", "key3"]) == {
+        key: EMBEDDINGS[key] for key in ["key0", "key2", "key3"]
+    }
+    assert cache.stats()["memory_size"] == 3
+
+
+def test_disk_tier_survives_reopening_and_evicts_to_its_size(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+    cache = EmbeddingCache(memory_size=2, path=path, disk_size=5)
+    cache.put_many(EMBEDDINGS)
+    cache.put_many({"key9": EMBEDDINGS["key9"]})
+    cache.close()
+
+    reopened = EmbeddingCache(memory_size=2, path=path, disk_size=5)
+    assert reopened._disk_count == 5
+    found = reopened.get_many(list(EMBEDDINGS))
+    assert found == {key: EMBEDDINGS[key] for key in found}
+    assert len(found) == 5
+    assert reopened.stats()["disk_hits"] == 5
+    # the entries read from disk are moved to the memory tier
+    assert reopened.get_many(list(found)[-2:]) == {
+        key: EMBEDDINGS[key] for key in list(found)[-2:]
+    }
+    assert reopened.stats()["memory_hits"] == 2
+    reopened.close()